@@ -1,15 +1,14 @@
-from PIL import Image
 import streamlit as st
 import services.supabase_client as supabase_client
+import services.metrics as metrics
 
-im = Image.open("images/favicon.png")
+# The login page only loads Streamlit and the Supabase client (on sign in);
+# OCR and OpenAI dependencies are imported by the pages that use them
 st.set_page_config(
     page_title="Palavra Mestra",
-    page_icon=im,
+    page_icon="images/favicon.png",
 )
 
-supabase = supabase_client.get_supabase_connection()
-
 # Inicialização das variáveis de sessão
 if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
@@ -21,10 +20,12 @@ if "role" not in st.session_state:
 # Função para logar o usuário
 def login_user(email, password):
     try:
-        response = supabase.auth.sign_in_with_password({
-            "email": email,
-            "password": password
-        })
+        supabase = supabase_client.get_supabase_connection()
+        with metrics.timed("supabase", query="auth.sign_in"):
+            response = supabase.auth.sign_in_with_password({
+                "email": email,
+                "password": password
+            })
         st.session_state.user = response.user
         st.session_state.logged_in = True
         st.session_state.role = 'admin'
@@ -34,7 +35,7 @@ def login_user(email, password):
         return False
 
 def logout_user():
-    supabase.auth.sign_out()
+    supabase_client.get_supabase_connection().auth.sign_out()
     st.session_state.logged_in = False
     st.session_state.user = None
     st.session_state.role = None
@@ -76,10 +77,15 @@ def main_page():
         title="Avaliação de Redação",
         icon=":material/description:",
     )
+    lote = st.Page(
+        "views/lote.py",
+        title="Correção em Lote",
+        icon=":material/library_books:",
+    )
     settings = st.Page("services/settings.py", title="Configurações", icon=":material/settings:")
     logout_page = st.Page(logout_user, title="Sair", icon=":material/logout:")
 
-    user_pages = [dashboard, pre_processamento, avaliacao]
+    user_pages = [dashboard, pre_processamento, avaliacao, lote]
     #admin_pages = [admin]
     account_pages = [settings, logout_page]
 
@@ -0,0 +1,334 @@
+"""
+Offline benchmarks for image preprocessing and Vision response parsing.
+
+Usage (from the project root):
+
+    python -m benchmarks.run                                  # run and save JSON results
+    python -m benchmarks.run --compare benchmarks/results/baseline.json
+    python -m benchmarks.run record essay.jpg fixture_name    # record a real Vision response
+
+Preprocessing is timed step by step (decode, each filter, PNG encode) for
+every distinct preprocess_image flag combination on synthetic pages at
+several resolutions. The tiled group runs each tileable step with and
+without tiling on the largest page and fails if the outputs differ by more
+than --tile-tolerance. The quality group times the image-quality measurement
+behind the automatic preprocessing. The crop group deskews and crops
+synthetic forms (printed header, rotated page), small phone sizes included,
+and fails if the ruled area isn't found within CROP_TOLERANCE_DEGREES of the
+page rotation. The bands group times splitting a page into bands for
+concurrent extraction. The preview group times making the preview proxy
+(once per image), the default filters on it (every toggle) and the same
+filters at full resolution. The Vision parse benchmark walks
+full_text_annotation fixtures: every JSON file in benchmarks/fixtures (see
+"record") plus synthetic documents. No recorded fixtures are shipped, since
+they would hold students' essays: until some are recorded locally only the
+synthetic documents are timed, and the run says so. With --compare, timings
+more than --threshold slower than the baseline are reported as regressions
+and the exit code is 1.
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks import synthetic
+from services import image_preprocess, image_quality, page_bands
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), 'results', 'latest.json')
+
+# Ignore differences below this many seconds when comparing runs
+MIN_REGRESSION_SECONDS = 0.001
+
+# Rotation of the synthetic forms of the crop group and the error accepted
+CROP_ANGLE_DEGREES = 3.0
+CROP_TOLERANCE_DEGREES = 0.2
+# Small phone photos, where thin lines and small letters are hardest to tell
+# apart, are always part of the crop group
+CROP_SMALL_RESOLUTIONS = [(800, 600), (1000, 750)]
+
+FLAG_NAMES = ("use_grayscale", "use_threshold", "use_denoising", "use_contrast_enhancement", "use_morphological")
+
+def _best_of(repeat, fn, *args):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def distinct_plans(denoise_methods):
+    """Return every distinct step plan preprocess_image can run"""
+    plans = []
+    for values in itertools.product((False, True), repeat=len(FLAG_NAMES)):
+        flags = dict(zip(FLAG_NAMES, values))
+        for method in denoise_methods if flags["use_denoising"] else denoise_methods[:1]:
+            steps = tuple(image_preprocess.plan_steps(**flags, denoise_method=method))
+            if steps not in plans:
+                plans.append(steps)
+    return plans
+
+def plan_label(steps):
+    if not steps:
+        return "original"
+    return "+".join(name if not params else f"{name}({','.join(str(v) for _, v in params)})"
+                    for name, params in steps)
+
+def bench_preprocess(resolutions, denoise_methods, repeat):
+    results = {}
+    for height, width in resolutions:
+        image_bytes = synthetic.encoded_page(height, width)
+        prefix = f"preprocess/{height}x{width}"
+        decode_time, decoded = _best_of(
+            repeat, lambda: cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR))
+        results[f"{prefix}/decode"] = decode_time
+
+        for steps in distinct_plans(denoise_methods):
+            label = plan_label(steps)
+            img, total = decoded, decode_time
+            for index, (name, params) in enumerate(steps):
+                step = image_preprocess.STEP_FUNCTIONS[name]
+                step_time, img = _best_of(repeat, lambda i=img: step(i, **dict(params)))
+                results[f"{prefix}/{label}/{index}_{name}"] = step_time
+                total += step_time
+            encode_time, _ = _best_of(repeat, cv2.imencode, '.png', img)
+            results[f"{prefix}/{label}/encode"] = encode_time
+            results[f"{prefix}/{label}/total"] = total + encode_time
+            print(f"{prefix}/{label}: {total + encode_time:.3f}s", flush=True)
+    return results
+
+def bench_tiled(resolutions, denoise_methods, repeat, tolerance):
+    """
+    Time every tileable step with and without tiling and check the outputs match.
+
+    Returns:
+        tuple: (timings dict, list of (key, max pixel difference) above tolerance)
+    """
+    results, mismatches = {}, []
+    for height, width in resolutions:
+        image, _ = synthetic.handwritten_page(height, width)
+        gray = image_preprocess.STEP_FUNCTIONS["grayscale"](image)
+        binary = image_preprocess.STEP_FUNCTIONS["threshold"](gray)
+        cases = [("threshold", (), gray), ("morphological", (), binary)]
+        for method in denoise_methods:
+            cases += [("denoise", (("method", method),), gray), ("denoise", (("method", method),), binary)]
+        for name, params, src in cases:
+            label = f"tiled/{height}x{width}/{plan_label([(name, params)])}/{'binary' if src is binary else 'gray'}"
+            plain_time, plain = _best_of(repeat, image_preprocess._apply_step, name, params, src, False)
+            tiled_time, tiled = _best_of(repeat, image_preprocess._apply_step, name, params, src, True)
+            diff = int(np.abs(plain.astype(np.int16) - tiled.astype(np.int16)).max())
+            results[f"{label}/untiled"] = plain_time
+            results[f"{label}/tiled"] = tiled_time
+            if diff > tolerance:
+                mismatches.append((label, diff))
+            print(f"{label}: {plain_time:.3f}s -> {tiled_time:.3f}s, max diff {diff}", flush=True)
+    return results, mismatches
+
+def bench_quality(resolutions, repeat):
+    results = {}
+    for height, width in resolutions:
+        image, _ = synthetic.handwritten_page(height, width)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        seconds, quality = _best_of(repeat, image_quality.measure, gray)
+        results[f"quality/{height}x{width}/measure"] = seconds
+        print(f"quality/{height}x{width}: {seconds * 1000:.2f}ms "
+              f"(traço {quality['stroke_width']:.1f}px, ruído {quality['noise_sigma']:.1f})", flush=True)
+    return results
+
+def bench_crop(resolutions, repeat):
+    """Return (timings, failure messages) of the essay-region crop"""
+    results, failures = {}, []
+    for height, width in resolutions:
+        image, area = synthetic.form_page(height, width, angle=CROP_ANGLE_DEGREES)
+        label = f"crop/{height}x{width}"
+        seconds, region = _best_of(repeat, image_preprocess.find_writing_region, image)
+        results[f"{label}/find_writing_region"] = seconds
+        if region is None or abs(region[0] + CROP_ANGLE_DEGREES) > CROP_TOLERANCE_DEGREES:
+            failures.append(f"{label}: área da redação não encontrada ({region})")
+            continue
+        # The ruled area must be kept, give or take a few pixels at the line ends
+        margin = width // 100
+        x0, y0, x1, y1 = region[1]
+        if x0 > area[0] + margin or y0 > area[1] + margin or x1 < area[2] - margin or y1 < area[3] - margin:
+            failures.append(f"{label}: recorte {region[1]} não contém a área pautada {area}")
+        seconds, cropped = _best_of(repeat, image_preprocess.STEP_FUNCTIONS["crop"], image)
+        results[f"{label}/crop"] = seconds
+        print(f"{label}: {seconds * 1000:.2f}ms, {cropped.size / image.size:.0%} da imagem mantida", flush=True)
+    return results, failures
+
+def bench_bands(resolutions, repeat):
+    results = {}
+    for height, width in resolutions:
+        encoded = synthetic.encoded_page(height, width)
+        label = f"bands/{height}x{width}"
+        seconds, bands = _best_of(repeat, page_bands.split_image, encoded)
+        results[f"{label}/split_image"] = seconds
+        cuts = page_bands.find_cuts(cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_GRAYSCALE))
+        print(f"{label}: {seconds * 1000:.2f}ms, {len(bands)} faixas, "
+              f"{sum(clean for _, clean in cuts)}/{len(cuts)} cortes entre linhas", flush=True)
+    return results
+
+def bench_preview(resolutions, repeat):
+    results = {}
+    for height, width in resolutions:
+        image, _ = synthetic.handwritten_page(height, width)
+        label = f"preview/{height}x{width}"
+        # The proxy is made once per image; a filter toggle only reruns the steps on it
+        downscale_seconds, proxy = _best_of(repeat, image_preprocess.downscale, image,
+                                            image_preprocess.PREVIEW_MAX_SIDE)
+        options = image_preprocess.scale_options({}, proxy.shape[0] / height)
+        preview_seconds, _ = _best_of(repeat, lambda: image_preprocess.preprocess_array(proxy, **options))
+        full_seconds, _ = _best_of(repeat, image_preprocess.preprocess_array, image)
+        results[f"{label}/downscale"] = downscale_seconds
+        results[f"{label}/preview"] = preview_seconds
+        results[f"{label}/full"] = full_seconds
+        print(f"{label}: redução {downscale_seconds * 1000:.2f}ms, prévia {preview_seconds * 1000:.2f}ms, "
+              f"resolução completa {full_seconds * 1000:.2f}ms", flush=True)
+    return results
+
+def _load_documents():
+    from google.cloud import vision
+
+    documents = {}
+    paths = sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.json')))
+    if not paths:
+        print(f"Nenhuma fixture gravada em {FIXTURES_DIR}; apenas documentos sintéticos "
+              "(grave uma com: python -m benchmarks.run record redacao.jpg nome)", flush=True)
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            documents[os.path.splitext(os.path.basename(path))[0]] = vision.TextAnnotation.from_json(f.read())
+    for paragraphs in (30, 120):
+        document = synthetic.vision_document(paragraphs=paragraphs)
+        documents[f"synthetic_{paragraphs}p"] = vision.TextAnnotation.from_json(json.dumps(document))
+    return documents
+
+def bench_vision_parse(repeat):
+    from services import visionai_client
+
+    results = {}
+    for name, document in _load_documents().items():
+        parse_time, text = _best_of(repeat, visionai_client.document_to_text, document)
+        lines = text.split('\n')
+        clean_time, _ = _best_of(repeat, lambda: [visionai_client.clean_text_formatting(line) for line in lines])
+        results[f"vision_parse/{name}/document_to_text"] = parse_time
+        results[f"vision_parse/{name}/clean_text_formatting"] = clean_time
+        print(f"vision_parse/{name}: {parse_time * 1000:.2f}ms", flush=True)
+    return results
+
+def compare(results, baseline, threshold):
+    """Return (key, baseline seconds, current seconds) for every regression"""
+    regressions = []
+    for key, seconds in sorted(results.items()):
+        old = baseline.get(key)
+        if old is None:
+            continue
+        if seconds > old * (1 + threshold) and seconds - old > MIN_REGRESSION_SECONDS:
+            regressions.append((key, old, seconds))
+    return regressions
+
+def record(image_path, name):
+    """Save the full_text_annotation of a real Vision response as a fixture"""
+    from google.cloud import vision
+    from services import visionai_client
+
+    with open(image_path, 'rb') as f:
+        image_content = f.read()
+    response = visionai_client.get_vision_client().document_text_detection(
+        image=vision.Image(content=image_content),
+        image_context=vision.ImageContext(language_hints=['pt-BR'])
+    )
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    path = os.path.join(FIXTURES_DIR, f"{name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(vision.TextAnnotation.to_json(response.full_text_annotation))
+    print(f"Fixture salva em {path}")
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'record':
+        parser = argparse.ArgumentParser(prog="benchmarks.run record")
+        parser.add_argument("image")
+        parser.add_argument("name")
+        args = parser.parse_args(argv[1:])
+        record(args.image, args.name)
+        return 0
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help="Arquivo JSON de resultados")
+    parser.add_argument("--compare", help="Resultados anteriores para detectar regressões")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Tolerância relativa (0.15 = 15%%)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetições por medição (vale a melhor)")
+    parser.add_argument("--resolutions", nargs='+', default=[f"{h}x{w}" for h, w in synthetic.RESOLUTIONS],
+                        help="Resoluções das páginas sintéticas, como 1600x1200")
+    parser.add_argument("--include-nlmeans", action="store_true",
+                        help="Inclui a redução de ruído NL-means (muito lenta em imagens grandes)")
+    parser.add_argument("--only", choices=("preprocess", "tiled", "quality", "crop", "bands", "preview",
+                                                 "vision_parse"), help="Executa apenas um grupo")
+    parser.add_argument("--tile-tolerance", type=int, default=0,
+                        help="Diferença máxima por pixel aceita entre o processamento em blocos e o direto")
+    args = parser.parse_args(argv)
+
+    resolutions = [tuple(int(v) for v in r.split('x')) for r in args.resolutions]
+    denoise_methods = image_preprocess.DENOISE_METHODS if args.include_nlmeans else ("fast",)
+
+    results, mismatches = {}, []
+    if args.only in (None, "preprocess"):
+        results.update(bench_preprocess(resolutions, denoise_methods, args.repeat))
+    if args.only in (None, "tiled"):
+        tiled_results, mismatches = bench_tiled(resolutions[-1:], denoise_methods, args.repeat, args.tile_tolerance)
+        results.update(tiled_results)
+    if args.only in (None, "quality"):
+        results.update(bench_quality(resolutions, args.repeat))
+    crop_failures = []
+    if args.only in (None, "crop"):
+        crop_results, crop_failures = bench_crop(sorted(set(resolutions) | set(CROP_SMALL_RESOLUTIONS)), args.repeat)
+        results.update(crop_results)
+    if args.only in (None, "bands"):
+        results.update(bench_bands(resolutions, args.repeat))
+    if args.only in (None, "preview"):
+        results.update(bench_preview(resolutions, args.repeat))
+    if args.only in (None, "vision_parse"):
+        results.update(bench_vision_parse(args.repeat))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            "meta": {
+                "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "python": platform.python_version(),
+                "opencv": cv2.__version__,
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    print(f"Resultados salvos em {args.output}")
+
+    for label, diff in mismatches:
+        print(f"DIVERGÊNCIA {label}: diferença máxima de {diff} entre o processamento em blocos e o direto")
+    for message in crop_failures:
+        print(f"FALHA {message}")
+    if mismatches or crop_failures:
+        return 1
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new in regressions:
+            print(f"REGRESSÃO {key}: {old * 1000:.2f}ms -> {new * 1000:.2f}ms ({new / old - 1:+.0%})")
+        if regressions:
+            return 1
+        print("Nenhuma regressão encontrada.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
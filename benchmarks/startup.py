@@ -0,0 +1,145 @@
+"""
+Cold start report: import time of the app, each page and each backend.
+
+Usage (from the project root):
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --output benchmarks/results/startup.json
+
+Every measurement runs in a fresh interpreter with `python -X importtime`,
+so nothing is already cached in sys.modules. For each page, the modules it
+imports at the top are imported together and the heaviest packages are
+listed. The login page (app.py run with Streamlit's AppTest and no session)
+is also checked: it must not load any module in LOGIN_FORBIDDEN_MODULES,
+otherwise the exit code is 1.
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIEWS = ["views/dashboard.py", "views/pre_processamento.py", "views/avaliacao.py", "views/lote.py",
+         "services/settings.py"]
+# Heavy backends, loaded lazily by the code that uses them
+BACKENDS = ["cv2", "numpy", "PIL", "google.cloud.vision", "openai", "supabase", "pypdfium2", "pytesseract"]
+# PIL is not listed: Streamlit itself loads it to serve an image favicon
+LOGIN_FORBIDDEN_MODULES = ["cv2", "google.cloud.vision", "openai", "services.image_preprocess"]
+TOP_PACKAGES = 8
+
+_LOGIN_CHECK = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+app = AppTest.from_file("app.py", default_timeout=60)
+app.run()
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "exceptions": [e.message for e in app.exception],
+    "loaded": [name for name in sys.argv[1:] if name in sys.modules],
+}))
+"""
+
+def _run(args):
+    return subprocess.run([sys.executable] + args, cwd=ROOT, capture_output=True, text=True)
+
+def _top_level_imports(stderr):
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Only top-level entries (nested imports are indented further): their
+        # cumulative time includes everything they import
+        if len(name) - len(name.lstrip()) == 1:
+            yield name.strip(), int(cumulative) / 1e6
+
+_startup_modules = None
+
+def import_time(modules):
+    """
+    Import modules in a fresh interpreter and return the -X importtime breakdown.
+
+    Modules the interpreter itself loads at startup (site, encodings...) are left out.
+
+    Returns:
+        dict: {"seconds": total, "packages": {top-level package: seconds}} or {"error": message}
+    """
+    global _startup_modules
+    if _startup_modules is None:
+        _startup_modules = {name for name, _ in _top_level_imports(_run(["-X", "importtime", "-c", "pass"]).stderr)}
+
+    code = "\n".join(f"import {module}" for module in modules)
+    result = _run(["-X", "importtime", "-c", code])
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "falhou"}
+    packages = {}
+    for name, seconds in _top_level_imports(result.stderr):
+        if name not in _startup_modules:
+            package = name if name.startswith("services.") else name.split(".")[0]
+            packages[package] = packages.get(package, 0.0) + seconds
+    return {"seconds": sum(packages.values()), "packages": packages}
+
+def page_imports(path):
+    """Return the modules a page imports at its top level"""
+    with open(os.path.join(ROOT, path), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules += [f"{node.module}.{alias.name}" if node.module == "services" else node.module
+                        for alias in node.names]
+    return list(dict.fromkeys(modules))
+
+def check_login():
+    """Run the login page and return its time, exceptions and any forbidden module it loaded"""
+    result = _run(["-c", _LOGIN_CHECK] + LOGIN_FORBIDDEN_MODULES)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "falhou"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def _format(measure):
+    if "error" in measure:
+        return f"erro: {measure['error']}"
+    heaviest = sorted(measure["packages"].items(), key=lambda item: -item[1])[:TOP_PACKAGES]
+    return f"{measure['seconds'] * 1000:7.0f}ms  (" + ", ".join(
+        f"{name} {seconds * 1000:.0f}ms" for name, seconds in heaviest) + ")"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="Salva o relatório em JSON")
+    args = parser.parse_args(argv)
+
+    report = {"app": import_time(page_imports("app.py")), "pages": {}, "backends": {}}
+    print(f"app.py {_format(report['app'])}", flush=True)
+    for path in VIEWS:
+        report["pages"][path] = import_time(page_imports(path))
+        print(f"{path} {_format(report['pages'][path])}", flush=True)
+    for module in BACKENDS:
+        report["backends"][module] = import_time([module])
+        print(f"{module} {_format(report['backends'][module])}", flush=True)
+
+    login = report["login"] = check_login()
+    if "error" in login:
+        print(f"Página de login: erro ao executar ({login['error']})")
+        failed = True
+    else:
+        print(f"Página de login: {login['seconds'] * 1000:.0f}ms")
+        for message in login["exceptions"]:
+            print(f"  exceção: {message}")
+        failed = bool(login["loaded"] or login["exceptions"])
+        if login["loaded"]:
+            print(f"FALHA: a página de login carregou {', '.join(login['loaded'])}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Relatório salvo em {args.output}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
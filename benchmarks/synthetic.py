@@ -0,0 +1,130 @@
+"""
+Deterministic synthetic inputs for the benchmarks.
+
+Pages imitate a scanned handwritten essay: ruled lines, cursive-like words
+and scanner noise. Documents imitate a Vision full_text_annotation in its
+JSON form, as returned by vision.TextAnnotation.to_json.
+"""
+import random
+import string
+
+import cv2
+import numpy as np
+
+# (height, width) of the benchmarked pages, from a small phone photo to a 12 MP one
+RESOLUTIONS = [(1600, 1200), (2800, 2100), (4000, 3000)]
+
+def _random_word(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+
+def handwritten_page(height, width, seed=0, noise_sigma=12):
+    """
+    Return a synthetic BGR essay page and its noise-free grayscale version.
+
+    Returns:
+        tuple: (noisy BGR image, clean grayscale image)
+    """
+    rng = random.Random(seed)
+    clean = np.full((height, width), 235, np.uint8)
+    line_step = max(height // 30, 20)
+    for y in range(line_step * 2, height - line_step, line_step):
+        cv2.line(clean, (width // 12, y), (width - width // 20, y), 180, max(1, height // 1500))
+        x = width // 10
+        while x < width - width // 6:
+            word = _random_word(rng)
+            cv2.putText(clean, word, (x, y - line_step // 5), cv2.FONT_HERSHEY_SCRIPT_SIMPLEX,
+                        line_step / 45, 40, max(1, line_step // 18), cv2.LINE_AA)
+            x += int(len(word) * line_step * 0.45) + line_step // 2
+
+    noise = np.random.default_rng(seed).normal(0, noise_sigma, clean.shape)
+    noisy = np.clip(clean.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(noisy, cv2.COLOR_GRAY2BGR), clean
+
+def form_page(height, width, seed=0, noise_sigma=12, angle=0.0):
+    """
+    Return a synthetic essay form photographed slightly rotated.
+
+    The handwritten ruled area takes the lower part of the page, under a
+    printed header with a barcode, like the forms the essays are written on.
+
+    Returns:
+        tuple: (noisy BGR image, (x0, y0, x1, y1) of the ruled area before rotation)
+    """
+    rng = random.Random(seed)
+    header_height = height // 5
+    page, clean = handwritten_page(height - header_height, width, seed, noise_sigma)
+    header = np.full((header_height, width), 235, np.uint8)
+    scale = header_height / 300
+    for row, text in enumerate(["REDACAO - FOLHA DE RESPOSTA", "NOME DO PARTICIPANTE: ____________",
+                                "NAO ESCREVA NESTE ESPACO"]):
+        cv2.putText(header, text, (width // 12, int((60 + row * 80) * scale)), cv2.FONT_HERSHEY_SIMPLEX,
+                    scale * 1.5, 20, max(1, int(scale * 3)), cv2.LINE_AA)
+    x = width - width // 3
+    while x < width - width // 12:
+        bar = rng.randint(1, 4) * max(1, width // 600)
+        cv2.rectangle(header, (x, int(40 * scale)), (x + bar, int(200 * scale)), 0, -1)
+        x += bar + rng.randint(1, 3) * max(1, width // 600)
+    header = np.clip(header + np.random.default_rng(seed + 1).normal(0, noise_sigma, header.shape), 0, 255)
+    image = np.vstack([cv2.cvtColor(header.astype(np.uint8), cv2.COLOR_GRAY2BGR), page])
+
+    line_step = max((height - header_height) // 30, 20)
+    first_line, last_line = line_step * 2, (height - header_height) - line_step - 1
+    last_line -= (last_line - first_line) % line_step
+    area = (width // 12, header_height + first_line - line_step, width - width // 20, header_height + last_line)
+    if angle:
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        image = cv2.warpAffine(image, rotation, (width, height), borderValue=(235, 235, 235))
+    return image, area
+
+def encoded_page(height, width, seed=0, ext='.jpg'):
+    """Return a synthetic page encoded like an uploaded photo"""
+    image, _ = handwritten_page(height, width, seed)
+    success, encoded = cv2.imencode(ext, image)
+    if not success:
+        raise Exception("Failed to encode synthetic page")
+    return encoded.tobytes()
+
+def _box(x0, y0, x1, y1):
+    return {"vertices": [{"x": x0, "y": y0}, {"x": x1, "y": y0}, {"x": x1, "y": y1}, {"x": x0, "y": y1}]}
+
+def vision_document(paragraphs=30, words_per_paragraph=12, seed=0):
+    """
+    Return a synthetic full_text_annotation dict (Vision JSON field names).
+
+    Words carry per-symbol text, confidences and bounding boxes like a real
+    document_text_detection response, with occasional punctuation symbols.
+    """
+    rng = random.Random(seed)
+    blocks = []
+    texts = []
+    y = 100
+    for _ in range(paragraphs):
+        words = []
+        x = 80
+        for _ in range(words_per_paragraph):
+            word = _random_word(rng)
+            if rng.random() < 0.1:
+                word += rng.choice(",.;:!?")
+            symbols = [{"text": char, "confidence": round(rng.uniform(0.5, 1.0), 3)} for char in word]
+            words.append({
+                "boundingBox": _box(x, y, x + 18 * len(word), y + 40),
+                "confidence": round(rng.uniform(0.5, 1.0), 3),
+                "symbols": symbols,
+            })
+            texts.append(word)
+            x += 18 * len(word) + 20
+        blocks.append({
+            "boundingBox": _box(80, y, x, y + 40),
+            "confidence": round(rng.uniform(0.6, 1.0), 3),
+            "blockType": "TEXT",
+            "paragraphs": [{
+                "boundingBox": _box(80, y, x, y + 40),
+                "confidence": round(rng.uniform(0.6, 1.0), 3),
+                "words": words,
+            }],
+        })
+        y += 60
+    return {
+        "pages": [{"width": 2100, "height": y + 100, "confidence": 0.9, "blocks": blocks}],
+        "text": ' '.join(texts),
+    }
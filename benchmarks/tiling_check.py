@@ -0,0 +1,84 @@
+"""
+Check that tiled preprocessing gives exactly the same pixels as untiled.
+
+Usage (from the project root):
+
+    python -m benchmarks.tiling_check
+    python -m benchmarks.tiling_check --resolution 4000x3000
+
+Every distinct step plan preprocess_image can run, NL-means included, plus
+plans with a larger threshold block and morphological kernel (as chosen by
+the automatic mode), runs on the same synthetic page with tiled=False and
+tiled=True. The page is larger than one tile in both directions, so every
+seam is crossed. Any pixel that differs fails the check with exit code 1.
+Intermediate results are shared between plans with a common prefix, so
+each step runs once per mode.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.run import distinct_plans, plan_label
+from services import image_preprocess
+
+DEFAULT_RESOLUTION = (2 * image_preprocess.TILE_SIZE + 300, 2 * image_preprocess.TILE_SIZE - 200)
+# Parameters the automatic mode picks that widen a step's halo
+EXTRA_PLANS = [
+    dict(use_grayscale=True, use_threshold=True, use_morphological=True, use_denoising=True,
+         threshold_block_size=31, threshold_c=15, morphological_kernel_size=3),
+    dict(use_grayscale=True, use_threshold=True, use_morphological=True, use_denoising=True,
+         denoise_method="nlmeans", threshold_block_size=31, threshold_c=15, morphological_kernel_size=3),
+]
+
+def check_plans(image, plans):
+    """
+    Run every plan tiled and untiled on image.
+
+    Returns:
+        list: (plan label, step index, number of differing pixels) of every divergence
+    """
+    outputs = {False: {(): image}, True: {(): image}}
+    failures = []
+    for steps in plans:
+        for index in range(len(steps)):
+            prefix = tuple(steps[:index + 1])
+            if prefix in outputs[False]:
+                continue
+            name, params = steps[index]
+            for tiled in (False, True):
+                start = time.perf_counter()
+                outputs[tiled][prefix] = image_preprocess._apply_step(name, params, outputs[tiled][prefix[:-1]],
+                                                                      tiled)
+                elapsed = time.perf_counter() - start
+                print(f"{plan_label(prefix)} ({'em blocos' if tiled else 'direto'}): {elapsed:.3f}s", flush=True)
+            plain, tiled_output = outputs[False][prefix], outputs[True][prefix]
+            differing = plain.size if plain.shape != tiled_output.shape else int(np.count_nonzero(plain != tiled_output))
+            if differing:
+                failures.append((plan_label(steps), index, differing))
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolution", default="x".join(str(v) for v in DEFAULT_RESOLUTION),
+                        help="Resolução da página sintética, como 2348x1848")
+    args = parser.parse_args(argv)
+
+    height, width = (int(v) for v in args.resolution.split('x'))
+    image, _ = synthetic.handwritten_page(height, width)
+    plans = distinct_plans(image_preprocess.DENOISE_METHODS)
+    plans += [tuple(image_preprocess.plan_steps(**options)) for options in EXTRA_PLANS]
+
+    failures = check_plans(image, plans)
+    for label, index, differing in failures:
+        print(f"DIVERGÊNCIA {label}, etapa {index + 1}: {differing} pixel(s) diferentes entre o processamento "
+              f"em blocos e o direto")
+    if failures:
+        return 1
+    print(f"{len(plans)} planos idênticos com e sem blocos em {height}x{width}.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
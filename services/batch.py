@@ -0,0 +1,247 @@
+"""
+Batch pipeline to grade a whole class at once.
+
+Essay images are read from a ZIP archive or a folder and go through two
+bounded concurrent stages: preprocessing + OCR, then evaluation. Results are
+yielded as soon as each essay finishes and can be exported as CSV or ZIP.
+
+Headless usage (from the project root, so that .streamlit/secrets.toml is found):
+
+    python -m services.batch turma.zip -o resultados.zip --workers 4 --api "Vision API"
+"""
+import argparse
+import contextvars
+import csv
+import io
+import os
+import sys
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from services import evaluation_cache, image_preprocess, image_quality, ocr, ocr_cache, openai_client
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+DEFAULT_WORKERS = 4
+
+# Preprocessing applied to every essay when none is given (same defaults as the view)
+DEFAULT_PREPROCESS_OPTIONS = {
+    "use_grayscale": True,
+    "use_threshold": True,
+    "use_denoising": True,
+    "use_contrast_enhancement": False,
+    "use_morphological": False,
+    "denoise_method": "fast",
+}
+
+CSV_FIELDS = ["arquivo", "texto", "avaliacao", "erro"]
+NOT_EVALUATED_MESSAGE = "Nenhum texto manuscrito detectado; a redação não foi avaliada."
+
+def _is_image(name):
+    base = os.path.basename(name)
+    return name.lower().endswith(IMAGE_EXTENSIONS) and not base.startswith('.') and '__MACOSX' not in name
+
+def iter_images(source):
+    """
+    Yield (name, image_bytes) for every image in a ZIP archive or folder.
+
+    Args:
+        source: Folder path, ZIP path, ZIP bytes or a file-like object holding a ZIP
+
+    Yields:
+        tuple: File name and raw image bytes, in name order
+    """
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        for entry in sorted(os.listdir(source)):
+            path = os.path.join(source, entry)
+            if os.path.isfile(path) and _is_image(entry):
+                with open(path, 'rb') as f:
+                    yield entry, f.read()
+        return
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with zipfile.ZipFile(source) as archive:
+        for info in sorted(archive.infolist(), key=lambda i: i.filename):
+            if not info.is_dir() and _is_image(info.filename):
+                yield info.filename, archive.read(info)
+
+def count_images(source):
+    """Count the images iter_images would yield, without reading them"""
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        return sum(1 for entry in os.listdir(source)
+                   if os.path.isfile(os.path.join(source, entry)) and _is_image(entry))
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with zipfile.ZipFile(source) as archive:
+        return sum(1 for info in archive.infolist() if not info.is_dir() and _is_image(info.filename))
+
+def _extract_stage(name, image_bytes, api_option, preprocess_options):
+    result = {"arquivo": name, "texto": "", "avaliacao": "", "erro": ""}
+    try:
+        # Look up the cache before preprocessing so repeated essays skip it too
+        cache_key = ocr_cache.make_key(image_bytes, preprocess_options, api_option)
+        text = ocr.cached_text(cache_key, api_option)
+        if text is None:
+            image = image_bytes
+            if preprocess_options is not None:
+                # Kept as an array, so it is encoded only once, for the upload
+                image = image_preprocess.decode_image(image_bytes)
+                options = image_quality.resolve_options(image, preprocess_options)
+                image = image_preprocess.preprocess_array(image, **options)
+            text = ocr.extract_text(image, api_option, cache_key=cache_key, lookup=False)
+        result["texto"] = text
+    except Exception as e:
+        result["erro"] = str(e)
+    return result
+
+def _has_text(text):
+    # The OCR backends answer with a placeholder instead of an empty text
+    text = text.strip()
+    return bool(text) and text != openai_client.NO_TEXT_MESSAGE
+
+def _evaluate_stage(result):
+    try:
+        # Resubmitted (or near-identical) essays reuse their earlier evaluation
+        result["avaliacao"], _ = evaluation_cache.evaluate(result["texto"], openai_client.evaluate_essay)
+    except Exception as e:
+        result["erro"] = str(e)
+    return result
+
+def run_batch(images, api_option, preprocess_options=DEFAULT_PREPROCESS_OPTIONS, evaluate=True,
+              workers=DEFAULT_WORKERS, eval_workers=None):
+    """
+    Run preprocessing, OCR and evaluation over many essays concurrently.
+
+    Each stage has its own thread pool and at most `workers + eval_workers`
+    essays are held in memory at a time, so big classes don't load every
+    image upfront. A failure on one essay is reported in its "erro" field
+    and doesn't stop the batch.
+
+    Args:
+        images (iterable): (name, image_bytes) pairs, e.g. from iter_images
+        api_option (str): Text extraction API, one of ocr.API_OPTIONS
+        preprocess_options (dict): Keyword arguments for preprocess_image, image_quality.AUTO to choose
+            them for each essay, or None to skip it
+        evaluate (bool): Whether to evaluate the extracted text
+        workers (int): Number of concurrent preprocessing/OCR workers
+        eval_workers (int): Number of concurrent evaluation workers (defaults to workers)
+
+    Yields:
+        dict: One result per essay with the keys in CSV_FIELDS, in completion order
+    """
+    eval_workers = eval_workers or workers
+    images = iter(images)
+    limit = workers + eval_workers
+
+    with ThreadPoolExecutor(workers, thread_name_prefix='ocr') as ocr_pool, \
+            ThreadPoolExecutor(eval_workers, thread_name_prefix='avaliacao') as eval_pool:
+        in_flight = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < limit:
+                try:
+                    name, image_bytes = next(images)
+                except StopIteration:
+                    exhausted = True
+                    break
+                # Each task runs in a copy of the caller's context, so OpenAI calls keep its rate_limit.user_scope
+                future = ocr_pool.submit(contextvars.copy_context().run, _extract_stage,
+                                         name, image_bytes, api_option, preprocess_options)
+                in_flight[future] = 'ocr'
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = in_flight.pop(future)
+                result = future.result()
+                if stage == 'ocr' and evaluate and not result["erro"]:
+                    if _has_text(result["texto"]):
+                        in_flight[eval_pool.submit(contextvars.copy_context().run, _evaluate_stage,
+                                                   result)] = 'avaliacao'
+                        continue
+                    # Nothing to grade, so the paid evaluation is skipped
+                    result["erro"] = NOT_EVALUATED_MESSAGE
+                yield result
+
+def results_to_csv(results, fields=CSV_FIELDS):
+    """Return the results as CSV text"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for result in sorted(results, key=lambda r: r["arquivo"]):
+        writer.writerow({field: result.get(field, "") for field in fields})
+    return buffer.getvalue()
+
+def results_to_zip(results, fields=CSV_FIELDS):
+    """
+    Bundle the results in a ZIP with the CSV summary, one transcript per essay
+    (transcricoes/*.txt) and one evaluation per essay (avaliacoes/*.md).
+
+    Essays whose names differ only by extension (redacao.png, redacao.jpg)
+    get a numbered suffix, so no entry overwrites another.
+    """
+    buffer = io.BytesIO()
+    used = set()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("resultados.csv", results_to_csv(results, fields))
+        for result in results:
+            base = stem = os.path.splitext(result["arquivo"])[0].replace('/', '_')
+            suffix = 1
+            while stem in used:
+                suffix += 1
+                stem = f"{base}_{suffix}"
+            used.add(stem)
+            if result["texto"]:
+                archive.writestr(f"transcricoes/{stem}.txt", result["texto"])
+            if result["avaliacao"]:
+                archive.writestr(f"avaliacoes/{stem}.md", result["avaliacao"])
+    return buffer.getvalue()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extração e avaliação de redações em lote")
+    parser.add_argument("input", help="Arquivo ZIP ou pasta com as imagens das redações")
+    parser.add_argument("-o", "--output", default="resultados.zip", help="Arquivo de saída (.zip ou .csv)")
+    parser.add_argument("--api", default=ocr.API_OPTIONS[0], choices=ocr.API_OPTIONS,
+                        help="API utilizada para extrair o texto")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Workers de extração")
+    parser.add_argument("--eval-workers", type=int, default=None, help="Workers de avaliação")
+    parser.add_argument("--sem-avaliacao", action="store_true", help="Apenas extrai o texto")
+    parser.add_argument("--sem-preprocessamento", action="store_true", help="Envia as imagens originais")
+    parser.add_argument("--auto", action="store_true",
+                        help="Escolhe o pré-processamento de cada imagem pela sua qualidade")
+    parser.add_argument("--recortar", action="store_true",
+                        help="Endireita cada imagem e recorta a área com as linhas da redação")
+    args = parser.parse_args(argv)
+
+    preprocess_options = None
+    if not args.sem_preprocessamento:
+        preprocess_options = {"auto": True} if args.auto else dict(DEFAULT_PREPROCESS_OPTIONS)
+        if args.recortar:
+            preprocess_options["use_crop"] = True
+
+    results = []
+    for result in run_batch(
+        iter_images(args.input),
+        args.api,
+        preprocess_options=preprocess_options,
+        evaluate=not args.sem_avaliacao,
+        workers=args.workers,
+        eval_workers=args.eval_workers,
+    ):
+        results.append(result)
+        status = f"ERRO: {result['erro']}" if result["erro"] else "ok"
+        print(f"[{len(results)}] {result['arquivo']}: {status}", flush=True)
+
+    if args.output.lower().endswith('.csv'):
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            f.write(results_to_csv(results))
+    else:
+        with open(args.output, 'wb') as f:
+            f.write(results_to_zip(results))
+    print(f"Resultados salvos em {args.output}")
+    return 1 if any(r["erro"] for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""
+Offline evaluation of many essays through the OpenAI Batch API.
+
+Instead of one assistant run per essay (thread creation, run, status polls
+and a messages fetch), the essays are written to a JSONL file of
+/v1/chat/completions requests carrying the assistant's own model and
+instructions, uploaded once, and the results are downloaded once when the
+batch completes (within 24h, at a lower price). A manifest saved next to the
+JSONL file maps each request's custom_id back to its essay file and student.
+
+Essays come from a CSV with "arquivo" and "texto" columns (and optionally
+"aluno"), such as the one written by `python -m services.batch
+--sem-avaliacao -o transcricoes.csv`. Essays already in the evaluation cache
+given by --cache are not sent again, and importar stores the new evaluations
+in it. Usage (from the project root):
+
+    python -m services.batch_evaluation preparar transcricoes.csv -o lote.jsonl
+    python -m services.batch_evaluation enviar lote.jsonl           # prints the batch id
+    python -m services.batch_evaluation status <batch id>
+    python -m services.batch_evaluation baixar <batch id> -o saida.jsonl
+    python -m services.batch_evaluation importar saida.jsonl lote.manifest.json -o avaliacoes.zip
+
+Tools attached to the assistant (e.g. file search) are not available in
+batch requests; only its model and instructions are used. Their evaluations
+are therefore kept in a cache of their own (BATCH_CACHE_PATH), apart from the
+assistant evaluations the app reuses.
+
+FakeBatchProvider stands in for the API, e.g. `enviar lote.jsonl --fake`.
+With --fake, preparar and importar default to a cache kept next to the fake
+batches, so simulated evaluations never reach a real cache. Calls to the real
+API go through the shared rate limiter and are retried like the app's.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+from services import batch, evaluation_cache, rate_limit
+
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# The Batch API accepts up to 50,000 requests and 200 MB per file
+MAX_REQUESTS_PER_FILE = 50_000
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+RESULT_FIELDS = ["aluno"] + batch.CSV_FIELDS
+
+BATCH_CACHE_PATH = os.environ.get('BATCH_EVALUATION_CACHE_PATH',
+                                  os.path.join('.cache', 'batch_evaluation_cache.sqlite3'))
+FAKE_DIRECTORY = os.path.join('.cache', 'fake_batches')
+FAKE_CACHE_PATH = os.path.join(FAKE_DIRECTORY, 'evaluation_cache.sqlite3')
+
+def read_essays(path):
+    """
+    Read the essays of a transcription CSV.
+
+    Returns:
+        list: {"arquivo", "aluno", "texto"} dicts, skipping rows without text
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    return [
+        {"arquivo": row.get("arquivo", ""), "aluno": row.get("aluno", ""), "texto": row["texto"]}
+        for row in rows if row.get("texto", "").strip()
+    ]
+
+def get_assistant_settings(client, assistant_id, limiter=None):
+    """Return the model, instructions and sampling settings of the pre-created assistant"""
+    limiter = limiter or rate_limit.get_limiter()
+    assistant = limiter.call(lambda: client.beta.assistants.retrieve(assistant_id))
+    settings = {"model": assistant.model, "instructions": assistant.instructions or ""}
+    if assistant.temperature is not None:
+        settings["temperature"] = assistant.temperature
+    if assistant.top_p is not None:
+        settings["top_p"] = assistant.top_p
+    return settings
+
+def _custom_id(index, essay_text):
+    digest = hashlib.sha1(essay_text.encode('utf-8')).hexdigest()[:12]
+    return f"redacao-{index}-{digest}"
+
+def build_request(custom_id, essay_text, settings):
+    """Return one Batch API request line (as a dict) evaluating essay_text"""
+    body = {
+        "model": settings["model"],
+        "messages": [
+            {"role": "system", "content": settings["instructions"]},
+            {"role": "user", "content": essay_text},
+        ],
+    }
+    for name in ("temperature", "top_p"):
+        if name in settings:
+            body[name] = settings[name]
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": body}
+
+def manifest_path(jsonl_path):
+    return os.path.splitext(jsonl_path)[0] + '.manifest.json'
+
+def open_cache(path=None, fake=False):
+    """Return the evaluation cache at path, by default the batch evaluations' one (or the fake batches' one)"""
+    if path is None:
+        path = FAKE_CACHE_PATH if fake else BATCH_CACHE_PATH
+    return evaluation_cache.EvaluationCache(path)
+
+def prepare(essays, settings, jsonl_path, cache):
+    """
+    Write the batch file and its manifest for the essays not yet evaluated.
+
+    Essays with a reusable evaluation in the cache are recorded in the
+    manifest with that evaluation and left out of the batch file.
+
+    Args:
+        essays (list): {"arquivo", "aluno", "texto"} dicts, e.g. from read_essays
+        settings (dict): Model and instructions, e.g. from get_assistant_settings
+        jsonl_path (str): Batch file to write; the manifest goes next to it
+        cache (EvaluationCache): Cache of the evaluations to reuse, e.g. from open_cache
+
+    Returns:
+        tuple: (number of requests written, number of essays reused from the cache)
+    """
+    manifest = {"created": time.time(), "model": settings["model"], "essays": {}}
+    written = reused = 0
+    with open(jsonl_path, 'w', encoding='utf-8') as f:
+        for index, essay in enumerate(essays):
+            custom_id = _custom_id(index, essay["texto"])
+            entry = dict(essay)
+            match = cache.lookup(essay["texto"])
+            if match is not None and match["reuse"]:
+                entry["avaliacao"] = match["evaluation"]
+                reused += 1
+            else:
+                if written == MAX_REQUESTS_PER_FILE:
+                    raise Exception(f"O arquivo de lote aceita no máximo {MAX_REQUESTS_PER_FILE} redações.")
+                f.write(json.dumps(build_request(custom_id, essay["texto"], settings), ensure_ascii=False) + '\n')
+                written += 1
+            manifest["essays"][custom_id] = entry
+    with open(manifest_path(jsonl_path), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return written, reused
+
+def _response_text(line):
+    if line.get("error"):
+        return None, line["error"].get("message", str(line["error"]))
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        body = response.get("body") or {}
+        message = (body.get("error") or {}).get("message", f"HTTP {response.get('status_code')}")
+        return None, message
+    return response["body"]["choices"][0]["message"]["content"], None
+
+def ingest(output_lines, manifest, cache):
+    """
+    Map the batch output back to the essays of the manifest.
+
+    Evaluations are also stored in cache.
+
+    Args:
+        output_lines (iterable): Lines of the batch output (and error) files
+        manifest (dict): The manifest written by prepare
+        cache (EvaluationCache): Where the new evaluations are stored, e.g. from open_cache
+
+    Returns:
+        list: One result per essay with the keys in RESULT_FIELDS, in the original order
+    """
+    outputs = {}
+    for raw in output_lines:
+        raw = raw.strip()
+        if raw:
+            line = json.loads(raw)
+            outputs[line["custom_id"]] = _response_text(line)
+
+    results = []
+    for custom_id, essay in manifest["essays"].items():
+        result = {"aluno": essay.get("aluno", ""), "arquivo": essay["arquivo"], "texto": essay["texto"],
+                  "avaliacao": essay.get("avaliacao", ""), "erro": ""}
+        if not result["avaliacao"]:
+            evaluation, error = outputs.get(custom_id, (None, "Sem resposta no resultado do lote"))
+            if evaluation:
+                result["avaliacao"] = evaluation
+                cache.put(essay["texto"], evaluation)
+            else:
+                result["erro"] = error or "Avaliação vazia"
+        results.append(result)
+    return results
+
+class OpenAIBatchProvider:
+    """
+    Submits batch files to the OpenAI Batch API.
+
+    Every request waits for the shared rate limiter, which also retries rate
+    limits and server errors (the client itself is built without retries).
+    """
+
+    def __init__(self, client, limiter=None):
+        self.client = client
+        self.limiter = limiter or rate_limit.get_limiter()
+
+    def _upload(self, jsonl_path):
+        # Opened on every attempt, so a retried upload sends the whole file again
+        with open(jsonl_path, 'rb') as f:
+            return self.client.files.create(file=f, purpose="batch")
+
+    def submit(self, jsonl_path, metadata=None):
+        uploaded = self.limiter.call(lambda: self._upload(jsonl_path))
+        options = {"metadata": metadata} if metadata else {}
+        created = self.limiter.call(lambda: self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+            **options
+        ))
+        return created.id
+
+    def status(self, batch_id):
+        """Return {"status", "completed", "failed", "total"} for a batch"""
+        info = self.limiter.call(lambda: self.client.batches.retrieve(batch_id))
+        counts = info.request_counts
+        return {
+            "status": info.status,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+            "total": counts.total if counts else 0,
+        }
+
+    def download(self, batch_id):
+        """Return the lines of the output and error files of a finished batch"""
+        info = self.limiter.call(lambda: self.client.batches.retrieve(batch_id))
+        if info.status not in TERMINAL_STATUSES:
+            raise Exception(f"O lote {batch_id} ainda não terminou (status: {info.status}).")
+        lines = []
+        for file_id in (info.output_file_id, info.error_file_id):
+            if file_id:
+                lines += self.limiter.call(lambda: self.client.files.content(file_id)).text.splitlines()
+        return lines
+
+class FakeBatchProvider:
+    """
+    Local stand-in for the Batch API that answers every request on submit.
+
+    Batches are kept as JSONL files in directory, so the status and download
+    steps work across separate CLI invocations.
+
+    Args:
+        directory (str): Where the fake batch outputs are kept
+        respond (callable): Returns the evaluation text for a request body
+        fail_on (callable): Returns an error message for the request bodies that should fail
+    """
+
+    def __init__(self, directory=FAKE_DIRECTORY, respond=None, fail_on=None):
+        self.directory = directory
+        self.respond = respond or (lambda body: f"Avaliação simulada ({len(body['messages'][-1]['content'])} caracteres)")
+        self.fail_on = fail_on or (lambda body: None)
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id):
+        return os.path.join(self.directory, f"{batch_id}.jsonl")
+
+    def submit(self, jsonl_path, metadata=None):
+        batch_id = f"batch_fake_{uuid.uuid4().hex[:16]}"
+        with open(jsonl_path, encoding='utf-8') as f, open(self._path(batch_id), 'w', encoding='utf-8') as out:
+            for raw in f:
+                if not raw.strip():
+                    continue
+                request = json.loads(raw)
+                if request.get("url") != ENDPOINT:
+                    raise Exception(f"Endpoint não suportado no lote: {request.get('url')}")
+                error = self.fail_on(request["body"])
+                if error:
+                    response = {"status_code": 400, "body": {"error": {"message": error}}}
+                else:
+                    response = {"status_code": 200, "body": {
+                        "model": request["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant",
+                                                             "content": self.respond(request["body"])}}],
+                    }}
+                out.write(json.dumps({"id": f"req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"],
+                                      "response": response, "error": None}, ensure_ascii=False) + '\n')
+        return batch_id
+
+    def status(self, batch_id):
+        with open(self._path(batch_id), encoding='utf-8') as f:
+            total = sum(1 for raw in f if raw.strip())
+        return {"status": "completed", "completed": total, "failed": 0, "total": total}
+
+    def download(self, batch_id):
+        with open(self._path(batch_id), encoding='utf-8') as f:
+            return f.read().splitlines()
+
+def get_provider(fake=False):
+    if fake:
+        return FakeBatchProvider()
+    from services import openai_client
+    return OpenAIBatchProvider(openai_client.get_openai_client())
+
+def write_results(results, path):
+    """Save the results as CSV, or as ZIP with one transcript and evaluation per essay"""
+    if path.lower().endswith('.csv'):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            f.write(batch.results_to_csv(results, fields=RESULT_FIELDS))
+    else:
+        with open(path, 'wb') as f:
+            f.write(batch.results_to_zip(results, fields=RESULT_FIELDS))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Avaliação de redações em lote pela Batch API da OpenAI")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("preparar", help="Gera o arquivo JSONL do lote e o manifesto")
+    command.add_argument("input", help="CSV com as colunas arquivo, texto e opcionalmente aluno")
+    command.add_argument("-o", "--output", default="lote.jsonl", help="Arquivo JSONL do lote")
+    command.add_argument("--fake", action="store_true",
+                         help="Usa um modelo e instruções fictícios e o cache do provedor simulado")
+    command.add_argument("--cache", help="Arquivo do cache de avaliações a reaproveitar")
+
+    command = commands.add_parser("enviar", help="Envia o arquivo do lote e mostra o id do lote")
+    command.add_argument("jsonl")
+    command.add_argument("--fake", action="store_true", help="Usa o provedor local simulado")
+
+    command = commands.add_parser("status", help="Mostra o andamento de um lote")
+    command.add_argument("batch_id")
+    command.add_argument("--fake", action="store_true")
+
+    command = commands.add_parser("baixar", help="Baixa o resultado de um lote concluído")
+    command.add_argument("batch_id")
+    command.add_argument("-o", "--output", default="saida.jsonl")
+    command.add_argument("--fake", action="store_true")
+
+    command = commands.add_parser("importar", help="Associa o resultado do lote às redações")
+    command.add_argument("output_jsonl")
+    command.add_argument("manifest")
+    command.add_argument("-o", "--output", default="avaliacoes.zip", help="Arquivo de saída (.zip ou .csv)")
+    command.add_argument("--fake", action="store_true", help="Salva as avaliações no cache do provedor simulado")
+    command.add_argument("--cache", help="Arquivo do cache onde as avaliações são salvas")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "preparar":
+        if args.fake:
+            settings = {"model": "gpt-4o-mini", "instructions": "Avalie a redação."}
+        else:
+            from services import openai_client
+            settings = get_assistant_settings(openai_client.get_openai_client(), openai_client._get_assistant_id())
+        written, reused = prepare(read_essays(args.input), settings, args.output,
+                                  open_cache(args.cache, args.fake))
+        print(f"{written} redação(ões) no lote {args.output}, {reused} reaproveitada(s) do cache")
+        print(f"Manifesto salvo em {manifest_path(args.output)}")
+    elif args.command == "enviar":
+        if os.path.getsize(args.jsonl) == 0:
+            print("O lote está vazio: todas as redações já foram avaliadas.")
+            return 0
+        print(get_provider(args.fake).submit(args.jsonl, metadata={"origem": os.path.basename(args.jsonl)}))
+    elif args.command == "status":
+        status = get_provider(args.fake).status(args.batch_id)
+        print(f"{status['status']}: {status['completed']} concluída(s), {status['failed']} com erro, "
+              f"{status['total']} no total")
+    elif args.command == "baixar":
+        lines = get_provider(args.fake).download(args.batch_id)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        print(f"Resultado salvo em {args.output}")
+    elif args.command == "importar":
+        with open(args.manifest, encoding='utf-8') as f:
+            manifest = json.load(f)
+        with open(args.output_jsonl, encoding='utf-8') as f:
+            results = ingest(f, manifest, open_cache(args.cache, args.fake))
+        write_results(results, args.output)
+        errors = sum(1 for result in results if result["erro"])
+        print(f"{len(results) - errors} avaliação(ões) salva(s) em {args.output}, {errors} com erro")
+        return 1 if errors else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
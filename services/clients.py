@@ -0,0 +1,65 @@
+"""
+Process-wide registry of long-lived API clients.
+
+The Vision and OpenAI clients keep a gRPC channel / HTTP connection pool and
+are thread-safe, so one instance per process is shared by every Streamlit
+session and worker thread instead of being rebuilt (and re-handshaking) on
+each call.
+"""
+import threading
+import time
+
+_clients = {}
+_lock = threading.Lock()
+
+def get_client(name, factory):
+    """
+    Return the client registered under name, creating it with factory on first use.
+
+    Args:
+        name (str): Registry key, e.g. "vision" or "openai"
+        factory (callable): Builds the client; called at most once per process
+
+    Returns:
+        The shared client instance
+    """
+    with _lock:
+        entry = _clients.get(name)
+        if entry is None:
+            start = time.perf_counter()
+            client = factory()
+            entry = {
+                "client": client,
+                "construction_seconds": time.perf_counter() - start,
+                "created_at": time.time(),
+                "uses": 0,
+            }
+            _clients[name] = entry
+        entry["uses"] += 1
+        return entry["client"]
+
+def reset(name=None):
+    """Drop one client (or all of them) so the next call rebuilds it, e.g. after rotating keys"""
+    with _lock:
+        if name is None:
+            _clients.clear()
+        else:
+            _clients.pop(name, None)
+
+def stats():
+    """
+    Return construction time and reuse counts for every registered client.
+
+    Returns:
+        dict: name -> {"construction_seconds", "created_at", "uses", "reuses"}
+    """
+    with _lock:
+        return {
+            name: {
+                "construction_seconds": entry["construction_seconds"],
+                "created_at": entry["created_at"],
+                "uses": entry["uses"],
+                "reuses": entry["uses"] - 1,
+            }
+            for name, entry in _clients.items()
+        }
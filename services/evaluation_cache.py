@@ -0,0 +1,286 @@
+"""
+Persistent cache of essay evaluations with near-duplicate detection.
+
+Evaluations are keyed by the hash of the normalized essay text (Unicode
+NFKC, case-folded, whitespace collapsed), so resubmitting the same essay
+never costs another assistant run. Each entry also stores a MinHash
+signature of the essay's character shingles, indexed with LSH bands, so an
+essay that differs by a handful of characters (an OCR fix, a comma) is found
+as well:
+
+- similarity >= reuse_threshold: the earlier evaluation is returned as is;
+- similarity >= flag_threshold: the match is only reported, so the view can
+  warn that a very similar essay was already evaluated.
+
+Similarity is the MinHash estimate of the Jaccard similarity of the two
+essays' shingle sets. Entries live in a local SQLite file, expire after a
+TTL and the least recently used are evicted past max_entries.
+
+Entries are scoped by user (rate_limit.user_scope's, unless given): one
+teacher never gets, nor is warned about, another teacher's evaluations.
+Headless runs outside any user scope share the "" scope.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from services import rate_limit
+
+DEFAULT_PATH = os.environ.get('EVALUATION_CACHE_PATH', os.path.join('.cache', 'evaluation_cache.sqlite3'))
+DEFAULT_TTL_SECONDS = 90 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 20_000
+DEFAULT_REUSE_THRESHOLD = float(os.environ.get('EVALUATION_REUSE_THRESHOLD', '0.95'))
+DEFAULT_FLAG_THRESHOLD = float(os.environ.get('EVALUATION_FLAG_THRESHOLD', '0.8'))
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 128
+# 16 bands of 8 rows: pairs above ~0.7 similarity almost always share a band
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+
+# Universal hashing (a * x + b) mod p over 32-bit shingle hashes; a, b < 2**31
+# keep every product inside uint64, and p, the largest prime below 2**32,
+# keeps every result inside the uint32 signature
+_PRIME = np.uint64(4294967291)
+_rng = np.random.default_rng(20240611)
+_PERM_A = _rng.integers(1, 2**31, NUM_PERMUTATIONS, dtype=np.uint64)[:, None]
+_PERM_B = _rng.integers(0, 2**31, NUM_PERMUTATIONS, dtype=np.uint64)[:, None]
+_SHINGLE_BASE = np.uint64(1099511628211)
+
+# Bumped whenever keys or signatures change; older cache files are emptied.
+# 2: signatures no longer truncated to 32 bits, entries scoped by user
+SCHEMA_VERSION = 2
+
+def normalize(text):
+    """Return the essay text with Unicode, case and whitespace differences removed"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return re.sub(r'\s+', ' ', text).strip()
+
+def text_key(normalized_text, scope=""):
+    return hashlib.sha256(f"{scope}\n{normalized_text}".encode('utf-8')).hexdigest()
+
+def shingle_hashes(normalized_text, size=SHINGLE_SIZE):
+    """Return the unique 32-bit hashes of every character shingle of the text"""
+    codes = np.frombuffer(normalized_text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < size:
+        codes = np.pad(codes, (0, size - len(codes)))
+    # Polynomial rolling hash over every window, computed for all windows at once
+    hashes = np.zeros(len(codes) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        hashes = hashes * _SHINGLE_BASE + codes[offset:len(codes) - size + 1 + offset]
+    return np.unique((hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xFFFFFFFF))
+
+def minhash(normalized_text):
+    """Return the MinHash signature (NUM_PERMUTATIONS uint32 values) of the text"""
+    shingles = shingle_hashes(normalized_text)
+    return ((_PERM_A * shingles + _PERM_B) % _PRIME).min(axis=1).astype(np.uint32)
+
+def _scope(user):
+    user = rate_limit.current_user() if user is None else user
+    return "" if user is None else str(user)
+
+def similarity(signature, other):
+    """Estimate the Jaccard similarity of two essays from their signatures"""
+    return float(np.count_nonzero(signature == other)) / len(signature)
+
+def _band_keys(signature):
+    return [hashlib.blake2b(band.tobytes(), digest_size=8).hexdigest()
+            for band in signature.reshape(LSH_BANDS, LSH_ROWS)]
+
+class EvaluationCache:
+    """SQLite-backed evaluation cache with exact and near-duplicate lookups"""
+
+    def __init__(self, path=DEFAULT_PATH, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES,
+                 reuse_threshold=DEFAULT_REUSE_THRESHOLD, flag_threshold=DEFAULT_FLAG_THRESHOLD):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.reuse_threshold = reuse_threshold
+        self.flag_threshold = min(flag_threshold, reuse_threshold)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Older entries can't be found by the current keys and signatures
+            self._conn.executescript("""
+                DROP TABLE IF EXISTS evaluations;
+                DROP TABLE IF EXISTS evaluation_bands;
+            """)
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                evaluation TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS evaluations_accessed ON evaluations (accessed);
+            CREATE TABLE IF NOT EXISTS evaluation_bands (
+                band INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS evaluation_bands_bucket ON evaluation_bands (band, bucket);
+            CREATE INDEX IF NOT EXISTS evaluation_bands_key ON evaluation_bands (key);
+        """)
+        self._conn.commit()
+
+    def lookup(self, essay_text, user=None):
+        """
+        Find the evaluation of this essay or of a near-duplicate evaluated for the same user.
+
+        Args:
+            essay_text (str): The essay
+            user: Whose evaluations to search; defaults to rate_limit.user_scope's
+
+        Returns:
+            dict: {"evaluation", "similarity", "exact", "reuse", "created"} for the most
+                  similar evaluated essay at or above flag_threshold, or None
+        """
+        normalized = normalize(essay_text)
+        scope = _scope(user)
+        key = text_key(normalized, scope)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT evaluation, created FROM evaluations WHERE key = ? AND created >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is not None:
+                self._touch(key, now)
+                self.hits += 1
+                return {"evaluation": row[0], "similarity": 1.0, "exact": True, "reuse": True, "created": row[1]}
+
+            signature = minhash(normalized)
+            best = self._best_candidate(signature, scope, now)
+            if best is None or best[1] < self.flag_threshold:
+                self.misses += 1
+                return None
+            candidate, score, evaluation, created = best
+            reuse = score >= self.reuse_threshold
+            if reuse:
+                self._touch(candidate, now)
+                self.near_hits += 1
+            else:
+                self.misses += 1
+            return {"evaluation": evaluation, "similarity": score, "exact": False, "reuse": reuse,
+                    "created": created}
+
+    def _best_candidate(self, signature, scope, now):
+        buckets = _band_keys(signature)
+        clause = " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets))
+        params = [value for band, bucket in enumerate(buckets) for value in (band, bucket)]
+        rows = self._conn.execute(
+            f"SELECT key, signature, evaluation, created FROM evaluations WHERE created >= ? AND scope = ? "
+            f"AND key IN (SELECT key FROM evaluation_bands WHERE {clause})",
+            [now - self.ttl_seconds, scope] + params
+        ).fetchall()
+        best = None
+        for key, stored, evaluation, created in rows:
+            score = similarity(signature, np.frombuffer(stored, dtype=np.uint32))
+            if best is None or score > best[1]:
+                best = (key, score, evaluation, created)
+        return best
+
+    def _touch(self, key, now):
+        self._conn.execute("UPDATE evaluations SET accessed = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+
+    def put(self, essay_text, evaluation, user=None):
+        """Store the evaluation of an essay for user (see lookup) and evict expired or excess entries"""
+        normalized = normalize(essay_text)
+        scope = _scope(user)
+        key = text_key(normalized, scope)
+        signature = minhash(normalized)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO evaluations (key, scope, signature, evaluation, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scope, signature.tobytes(), evaluation, now, now)
+            )
+            self._conn.execute("DELETE FROM evaluation_bands WHERE key = ?", (key,))
+            self._conn.executemany(
+                "INSERT INTO evaluation_bands (band, bucket, key) VALUES (?, ?, ?)",
+                [(band, bucket, key) for band, bucket in enumerate(_band_keys(signature))]
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM evaluations WHERE created < ?", (now - self.ttl_seconds,))
+        count = self._conn.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        if count > self.max_entries:
+            # Drop least recently used entries until we are back under the cap
+            self._conn.execute(
+                "DELETE FROM evaluations WHERE key IN (SELECT key FROM evaluations ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self._conn.execute("DELETE FROM evaluation_bands WHERE key NOT IN (SELECT key FROM evaluations)")
+
+    def clear(self):
+        """Remove every entry and reset the counters"""
+        with self._lock:
+            self._conn.execute("DELETE FROM evaluations")
+            self._conn.execute("DELETE FROM evaluation_bands")
+            self._conn.commit()
+            self.hits = 0
+            self.near_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return exact/near hit and miss counters and the number of entries"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Return the process-wide cache instance"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EvaluationCache()
+        return _cache
+
+def evaluate(essay_text, evaluate_fn, cache=None, force=False):
+    """
+    Return the cached evaluation of an essay, or evaluate and cache it.
+
+    Args:
+        essay_text (str): The essay
+        evaluate_fn (callable): Evaluates an essay text, e.g. openai_client.evaluate_essay
+        cache (EvaluationCache): Defaults to the process-wide cache
+        force (bool): Evaluate again even if a reusable evaluation exists
+
+    Returns:
+        tuple: (evaluation, match) where match is lookup()'s result, or None
+    """
+    cache = cache or get_cache()
+    match = None if force else cache.lookup(essay_text)
+    if match is not None and match["reuse"]:
+        return match["evaluation"], match
+    evaluation = evaluate_fn(essay_text)
+    cache.put(essay_text, evaluation)
+    return evaluation, match
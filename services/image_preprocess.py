@@ -1,10 +1,512 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
-def preprocess_image(image_bytes, use_grayscale=True, use_threshold=True, use_denoising=True, use_contrast_enhancement=False, use_morphological=False):
+from services import metrics
+
+# Default memory cap for a PreprocessCache (per session)
+DEFAULT_CACHE_BYTES = 128 * 1024 * 1024
+
+# Longest image side worth uploading to each OCR backend. OpenAI scales
+# images down to fit 2048x2048 before tokenizing them anyway; Vision keeps
+# gaining on small handwriting a bit above that. Tesseract wants letters
+# 20-30 pixels tall, about 300 DPI on an A4 page.
+UPLOAD_MAX_SIDE = {"Vision API": 2400, "OpenAI API": 2048, "Tesseract (local)": 3500}
+DEFAULT_UPLOAD_MAX_SIDE = 2048
+UPLOAD_JPEG_QUALITY = 85
+
+def _grayscale(img):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def _contrast_enhancement(img):
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    if img.ndim == 2:
+        # Apply CLAHE to grayscale image
+        return clahe.apply(img)
+    # For color images, apply CLAHE to L channel in LAB color space
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    l, a, b = cv2.split(lab)
+    l = clahe.apply(l)
+    lab = cv2.merge((l,a,b))
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+
+THRESHOLD_BLOCK_SIZE = 11
+THRESHOLD_C = 2
+
+def _threshold(img, block_size=THRESHOLD_BLOCK_SIZE, c=THRESHOLD_C):
+    return cv2.adaptiveThreshold(
+        img,
+        255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY,
+        block_size,
+        c
+    )
+
+MORPHOLOGICAL_KERNEL_SIZE = 2
+
+def _morphological(img, kernel_size=MORPHOLOGICAL_KERNEL_SIZE):
+    # Define kernel size for morphological operations
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    # Apply dilation followed by erosion to enhance text contours
+    img = cv2.dilate(img, kernel, iterations=1)
+    return cv2.erode(img, kernel, iterations=1)
+
+def _is_binary(img):
+    return img.ndim == 2 and not np.any((img != 0) & (img != 255))
+
+# Denoising strategies for the "denoise" step. Measured on a synthetic 12 MP
+# handwritten page (Gaussian noise, sigma 12), grayscale + binarization first:
+#
+#   method    time     background speckle   ink recall
+#   none      -        43.9%                 84.4%
+#   fast      0.003s   33.7%                 93.0%
+#   nlmeans   10.1s    43.9%                 84.4%
+#
+# With default parameters NL-means can't tell the 0/255 jumps of a binarized
+# image from text edges, so it costs seconds and changes nothing; a 3x3
+# median removes isolated speckles instead. On non-binarized images "fast"
+# uses an edge-preserving bilateral filter (0.05s vs 13s at 12 MP). Rerun
+# the benchmarks to compare on other inputs.
+DENOISE_METHODS = ("fast", "nlmeans")
+
+def _denoise(img, method="fast", binary=None):
+    if method == "fast":
+        if binary is None:
+            binary = _is_binary(img)
+        if binary:
+            return cv2.medianBlur(img, 3)
+        return cv2.bilateralFilter(img, 5, 40, 5)
+    if img.ndim == 2:
+        return cv2.fastNlMeansDenoising(img)
+    return cv2.fastNlMeansDenoisingColored(img)
+
+# Essay-region detection. The writing area of our forms is a block of evenly
+# spaced ruled lines; printed headers, barcodes and margins are outside it.
+# Lines are searched on a proxy whose longest side is CROP_PROXY_MAX_SIDE
+# pixels: smaller photos are enlarged to it, so the line sizes below (tuned
+# at that size) hold, and the bodies of small letters aren't taken for lines.
+CROP_PROXY_MAX_SIDE = 1600
+# A ruled line spans at least this fraction of the (proxy) page width, in
+# segments at least CROP_MIN_SEGMENT_FRACTION of it long
+CROP_MIN_LINE_FRACTION = 0.4
+CROP_MIN_SEGMENT_FRACTION = 0.06
+# Fewer lines than this and the page is left as is
+CROP_MIN_LINES = 5
+CROP_MAX_SKEW_DEGREES = 10
+# Consecutive lines of the writing area are this close to a whole number of
+# median spacings, up to CROP_MAX_GAP_SPACINGS (three lines in a row hidden
+# under the writing)
+CROP_SPACING_TOLERANCE = 0.25
+CROP_MAX_GAP_SPACINGS = 4
+# A writing area spanning less than this fraction of the rows between the
+# first and last ruled lines found is distrusted, and the page left whole
+CROP_MIN_SPAN_FRACTION = 0.8
+# Ruled lines on the proxy: at most this thick (pixels), at least this much
+# darker (gray levels) than the paper right above and below them
+CROP_LINE_MAX_THICKNESS = 4
+CROP_LINE_CONTRAST = 12
+CROP_LINE_BLUR = 9
+
+# Skew is searched coarse then fine, shearing the row profiles of this many
+# vertical strips of the ink instead of rotating it for every angle
+SKEW_STRIPS = 32
+SKEW_STEPS_DEGREES = (0.5, 0.1)
+
+def _rotate(img, angle, flags=cv2.INTER_LINEAR, border=cv2.BORDER_CONSTANT):
+    height, width = img.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(img, rotation, (width, height), flags=flags, borderMode=border)
+
+def _skew_angle(ink):
+    # Rotation (degrees, counterclockwise) that lines the ink up in rows:
+    # ruled lines give the sharpest horizontal projection profile when level
+    strips = np.array_split(ink, SKEW_STRIPS, axis=1)
+    profiles = np.stack([np.count_nonzero(strip, axis=1) for strip in strips]).astype(np.float64)
+    widths = np.array([strip.shape[1] for strip in strips])
+    centers = np.cumsum(widths) - widths / 2 - ink.shape[1] / 2
+
+    def sharpness(angle):
+        shifts = np.round(centers * np.tan(np.radians(angle))).astype(int)
+        profile = sum(np.roll(strip_profile, -shift) for strip_profile, shift in zip(profiles, shifts))
+        return float(np.square(np.diff(profile)).sum())
+
+    best, span = 0.0, CROP_MAX_SKEW_DEGREES
+    for step in SKEW_STEPS_DEGREES:
+        angles = np.arange(best - span, best + span + step / 2, step)
+        best = float(max(angles, key=sharpness))
+        span = step
+    # Rounded so that a level page gives exactly 0 and isn't resampled
+    return round(best, 2) + 0.0
+
+def _line_ink(gray):
+    # Ruled lines are faint, thin and horizontal: a horizontal blur averages
+    # the noise out of them, then the vertical black-hat keeps dark features
+    # only a few pixels tall, which leaves out the bodies of the letters
+    blurred = cv2.blur(gray, (CROP_LINE_BLUR, 1))
+    blackhat = cv2.morphologyEx(blurred, cv2.MORPH_BLACKHAT,
+                                cv2.getStructuringElement(cv2.MORPH_RECT, (1, CROP_LINE_MAX_THICKNESS * 2 + 1)))
+    _, ink = cv2.threshold(blackhat, CROP_LINE_CONTRAST, 255, cv2.THRESH_BINARY)
+    return ink
+
+def _ruled_lines(ink, min_length):
+    # (center row, left, right) of each row band with at least min_length
+    # pixels in long horizontal segments. Handwriting crossing a line breaks
+    # it into segments, so they are counted rather than required to be one;
+    # the short horizontal strokes of the letters are dropped. A line
+    # resampled by the leveling rotation can step between two rows, so rows
+    # are joined in pairs before looking for segments; the last vertical
+    # dilation gathers a line left a little tilted by the skew estimate.
+    segment = max(1, int(ink.shape[1] * CROP_MIN_SEGMENT_FRACTION))
+    ink = cv2.dilate(ink, cv2.getStructuringElement(cv2.MORPH_RECT, (1, 2)))
+    ink = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (segment, 1)))
+    ink = cv2.dilate(ink, cv2.getStructuringElement(cv2.MORPH_RECT, (1, CROP_LINE_MAX_THICKNESS + 1)))
+    rows = np.flatnonzero(np.count_nonzero(ink, axis=1) >= min_length)
+    lines = []
+    for run in np.split(rows, np.flatnonzero(np.diff(rows) > 1) + 1) if len(rows) else []:
+        columns = np.flatnonzero(ink[run].any(axis=0))
+        left, right = np.percentile(columns, (1, 99))
+        lines.append((float(run.mean()), int(left), int(right)))
+    return lines
+
+def _writing_area(lines):
+    # Longest chain of lines each a whole number of spacings (up to
+    # CROP_MAX_GAP_SPACINGS, for lines hidden under the handwriting) below the
+    # previous one. Lines off that grid, like strokes of the writing taken
+    # for lines, are skipped instead of breaking the chain.
+    if len(lines) < CROP_MIN_LINES:
+        return None
+    centers = np.array([line[0] for line in lines])
+    spacing = float(np.median(np.diff(centers)))
+    following = []
+    for center in centers:
+        offsets = (centers - center) / spacing
+        multiple = np.round(offsets)
+        on_grid = np.flatnonzero((multiple >= 1) & (multiple <= CROP_MAX_GAP_SPACINGS)
+                                 & (np.abs(offsets - multiple) <= CROP_SPACING_TOLERANCE))
+        following.append(int(on_grid[0]) if len(on_grid) else None)
+    best = []
+    for start in range(len(lines)):
+        chain = [start]
+        while following[chain[-1]] is not None:
+            chain.append(following[chain[-1]])
+        if len(chain) > len(best):
+            best = chain
+    if len(best) < CROP_MIN_LINES:
+        return None
+    # A short chain among many ruled lines is more likely a misreading than
+    # the writing area: cropping to it would cut handwriting off
+    if centers[best[-1]] - centers[best[0]] < CROP_MIN_SPAN_FRACTION * (centers[-1] - centers[0]):
+        return None
+    return [lines[i] for i in best], spacing
+
+def find_writing_region(img):
+    """
+    Locate the ruled writing area of an essay page.
+
+    The page is leveled on the angle that makes its horizontal projection
+    profile sharpest, then the longest run of evenly spaced ruled lines is
+    taken as the writing area, with room for the writing above the first
+    line and the descenders below the last one. When that run covers much
+    less than the ruled lines found, no area is returned rather than one
+    that could cut handwriting off.
+
+    Returns:
+        tuple: (rotation in degrees, counterclockwise, that levels the page,
+               (x0, y0, x1, y1) of the area in the leveled image), or None
+               if no ruled area was found
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    scale = CROP_PROXY_MAX_SIDE / max(gray.shape)
+    proxy = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    min_length = int(proxy.shape[1] * CROP_MIN_LINE_FRACTION)
+
+    angle = _skew_angle(_line_ink(proxy))
+    # Thin lines are found again on the leveled page: rotating the mask
+    # instead would break them into short steps
+    ink = _line_ink(_rotate(proxy, angle, border=cv2.BORDER_REPLICATE) if angle else proxy)
+    area = _writing_area(_ruled_lines(ink, min_length))
+    if area is None:
+        return None
+    lines, spacing = area
+    # The first line's writing sits above it and descenders hang below the last
+    x0 = min(line[1] for line in lines) - spacing / 2
+    x1 = max(line[2] for line in lines) + spacing / 2
+    y0 = lines[0][0] - spacing
+    y1 = lines[-1][0] + spacing / 2
+    height, width = gray.shape
+    x0, y0 = max(0, int(x0 / scale)), max(0, int(y0 / scale))
+    x1, y1 = min(width, int(np.ceil(x1 / scale))), min(height, int(np.ceil(y1 / scale)))
+    return angle, (x0, y0, x1, y1)
+
+def _crop(img):
+    region = find_writing_region(img)
+    if region is None:
+        return img
+    angle, (x0, y0, x1, y1) = region
+    if not angle:
+        return img[y0:y1, x0:x1].copy()
+    # Rotate straight into the crop, so only the pixels kept are interpolated
+    height, width = img.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    rotation[:, 2] -= (x0, y0)
+    return cv2.warpAffine(img, rotation, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+# Preprocessing steps by name, applied in the order they are planned
+STEP_FUNCTIONS = {
+    "crop": _crop,
+    "grayscale": _grayscale,
+    "contrast_enhancement": _contrast_enhancement,
+    "threshold": _threshold,
+    "morphological": _morphological,
+    "denoise": _denoise,
+}
+
+# Neighbourhood radius (in pixels, rounded up) each local step reads around a
+# pixel. Tiles overlap by this halo so their results stitch without seams.
+# CLAHE works on an 8x8 grid over the whole image, grayscale is cheap and the
+# crop looks at the whole page, so none of them is tiled.
+STEP_HALO = {
+    "threshold": 8,       # 11x11 Gaussian block (larger blocks add block_size // 2, see _step_halo)
+    "morphological": 2,   # 2x2 dilation then erosion (larger kernels add their extra size)
+    "denoise": 16,        # NL-means: 7x7 template within a 21x21 search window
+}
+
+# Tiling is off unless PREPROCESS_TILED=1: it only pays off with idle cores
+# to spare, and where it was measured (one core, or cores already busy with
+# other sessions) the tiled steps were slower, e.g. 5.8s -> 6.4s for NL-means
+# at 2000x3000. Turn it on only where `python -m benchmarks.run --only tiled`
+# shows a win; benchmarks/tiling_check.py checks the outputs are identical.
+# Once on, images with at least TILE_MIN_PIXELS pixels run their local steps
+# tile by tile.
+TILE_BY_DEFAULT = os.environ.get('PREPROCESS_TILED') == '1'
+TILE_MIN_PIXELS = 8_000_000
+TILE_SIZE = 1024
+TILE_WORKERS = os.cpu_count() or 1
+
+def run_tiled(fn, img, halo, tile_size=TILE_SIZE, workers=TILE_WORKERS):
+    """
+    Apply fn to overlapping tiles of img in a thread pool and stitch the result.
+
+    Each tile is extended by halo pixels on every side (clipped at the image
+    border) and only its core is written back, so the output matches fn(img)
+    as long as fn only reads pixels within halo of each output pixel. OpenCV
+    releases the GIL, so the tiles run on separate cores.
+    """
+    height, width = img.shape[:2]
+    out = None
+
+    def process(origin):
+        y, x = origin
+        y0, x0 = max(0, y - halo), max(0, x - halo)
+        y1, x1 = min(height, y + tile_size + halo), min(width, x + tile_size + halo)
+        result = fn(img[y0:y1, x0:x1])
+        core = result[y - y0:y - y0 + min(tile_size, height - y), x - x0:x - x0 + min(tile_size, width - x)]
+        return origin, core
+
+    origins = [(y, x) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+    with ThreadPoolExecutor(workers, thread_name_prefix='preprocess-tile') as pool:
+        for (y, x), core in pool.map(process, origins):
+            if out is None:
+                out = np.empty((height, width) + core.shape[2:], dtype=core.dtype)
+            out[y:y + core.shape[0], x:x + core.shape[1]] = core
+    return out
+
+def _step_halo(name, kwargs):
+    if name == "threshold":
+        return STEP_HALO[name] + max(0, kwargs.get("block_size", THRESHOLD_BLOCK_SIZE) - THRESHOLD_BLOCK_SIZE) // 2
+    if name == "morphological":
+        return STEP_HALO[name] + max(0, kwargs.get("kernel_size", MORPHOLOGICAL_KERNEL_SIZE) - MORPHOLOGICAL_KERNEL_SIZE)
+    return STEP_HALO[name]
+
+def _apply_step(name, params, img, tiled=None):
+    fn = STEP_FUNCTIONS[name]
+    if tiled is None:
+        tiled = TILE_BY_DEFAULT and TILE_WORKERS > 1 and img.shape[0] * img.shape[1] >= TILE_MIN_PIXELS
+    kwargs = dict(params)
+    if tiled and name in STEP_HALO:
+        if name == "denoise":
+            # Pick the fast filter from the whole image, not per tile
+            kwargs["binary"] = _is_binary(img)
+        return run_tiled(lambda tile: fn(tile, **kwargs), img, _step_halo(name, kwargs))
+    return fn(img, **kwargs)
+
+def plan_steps(use_grayscale=True, use_threshold=True, use_denoising=True, use_contrast_enhancement=False, use_morphological=False, denoise_method="fast",
+               threshold_block_size=THRESHOLD_BLOCK_SIZE, threshold_c=THRESHOLD_C, use_crop=False,
+               morphological_kernel_size=MORPHOLOGICAL_KERNEL_SIZE):
+    """
+    Return the ordered list of steps preprocess_image runs for the given flags.
+
+    Each step is a (name, params) tuple, where params is a tuple of keyword
+    argument pairs for the step function. Any prefix of the list identifies an
+    intermediate result, which is what PreprocessCache is keyed on. Parameters
+    left at their defaults are omitted, so default plans keep the same keys.
+    """
+    steps = []
+    if use_crop:
+        steps.append(("crop", ()))
+    if use_grayscale:
+        steps.append(("grayscale", ()))
+    if use_contrast_enhancement:
+        steps.append(("contrast_enhancement", ()))
+    if use_threshold and use_grayscale:  # Thresholding requires grayscale image
+        params = ()
+        if (threshold_block_size, threshold_c) != (THRESHOLD_BLOCK_SIZE, THRESHOLD_C):
+            params = (("block_size", threshold_block_size), ("c", threshold_c))
+        steps.append(("threshold", params))
+    if use_morphological and use_grayscale:
+        params = ()
+        if morphological_kernel_size != MORPHOLOGICAL_KERNEL_SIZE:
+            params = (("kernel_size", morphological_kernel_size),)
+        steps.append(("morphological", params))
+    if use_denoising:
+        steps.append(("denoise", (("method", denoise_method),)))
+    return steps
+
+def image_hash(image_bytes):
+    """Return a stable identifier for the image bytes"""
+    return hashlib.sha1(image_bytes).hexdigest()
+
+class PreprocessCache:
+    """
+    LRU cache of intermediate preprocessing results under a memory cap.
+
+    Keys are (image hash, tuple of steps already applied), so toggling one
+    filter only recomputes the steps after it. Cached arrays are made
+    read-only because they are shared between reruns.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        nbytes = value.nbytes if isinstance(value, np.ndarray) else len(value)
+        if nbytes > self.max_bytes:
+            return
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        with self._lock:
+            if key in self._entries:
+                old = self._entries.pop(key)
+                self.size -= old.nbytes if isinstance(old, np.ndarray) else len(old)
+            self._entries[key] = value
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes if isinstance(evicted, np.ndarray) else len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+def decode_image(image_bytes, cache=None, key=None):
+    """
+    Decode image bytes into a BGR array.
+
+    With a cache the decoded image is kept under (key, ()), the empty prefix
+    of every plan, so later calls for the same bytes don't decode them again.
+
+    Args:
+        image_bytes (bytes): Raw image bytes
+        cache (PreprocessCache): Optional cache of intermediate results
+        key (str): image_hash of image_bytes; computed when a cache is given without it
+
+    Returns:
+        numpy.ndarray: The BGR image (read-only if it went through the cache)
+    """
+    if cache is not None:
+        key = key or image_hash(image_bytes)
+        img = cache.get((key, ()))
+        if img is not None:
+            return img
+
+    with metrics.timed("preprocess", step="decode") as record:
+        record["bytes_in"] = len(image_bytes)
+        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise Exception("Failed to decode image")
+    if cache is not None:
+        cache.put((key, ()), img)
+    return img
+
+def downscale(img, max_side):
+    """Return img shrunk with area interpolation so its longest side is at most max_side"""
+    scale = max_side / max(img.shape[:2])
+    if scale >= 1:
+        return img
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def preprocess_array(img, use_grayscale=True, use_threshold=True, use_denoising=True, use_contrast_enhancement=False, use_morphological=False, denoise_method="fast",
+                     threshold_block_size=THRESHOLD_BLOCK_SIZE, threshold_c=THRESHOLD_C, use_crop=False,
+                     morphological_kernel_size=MORPHOLOGICAL_KERNEL_SIZE, cache=None, key=None, tiled=None):
+    """
+    Preprocess a decoded image: the array-in, array-out form of preprocess_image.
+
+    Nothing is encoded, so the result can be displayed as is (st.image with
+    channels="BGR") and encoded only once, for the OCR upload, by
+    encode_for_upload.
+
+    Args:
+        img (numpy.ndarray): BGR image, e.g. from decode_image
+        cache (PreprocessCache): Optional cache of intermediate results, used together with key;
+            only the steps after the longest cached prefix are computed
+        key (str): image_hash of the bytes img was decoded from
+
+    The other arguments are those of preprocess_image.
+
+    Returns:
+        numpy.ndarray: The processed image, single-channel after the grayscale step
+            (read-only if it came from or went into the cache)
+    """
+    steps = plan_steps(use_grayscale, use_threshold, use_denoising, use_contrast_enhancement, use_morphological, denoise_method,
+                       threshold_block_size, threshold_c, use_crop, morphological_kernel_size)
+    if key is None:
+        cache = None
+
+    # Start from the longest prefix of steps already computed for this image
+    start = 0
+    if cache is not None:
+        for i in range(len(steps), 0, -1):
+            cached = cache.get((key, tuple(steps[:i])))
+            if cached is not None:
+                img, start = cached, i
+                break
+
+    # Apply selected preprocessing steps
+    for i in range(start, len(steps)):
+        name, params = steps[i]
+        with metrics.timed("preprocess", step=name):
+            img = _apply_step(name, params, img, tiled)
+        if cache is not None:
+            cache.put((key, tuple(steps[:i + 1])), img)
+    return img
+
+def preprocess_image(image_bytes, use_grayscale=True, use_threshold=True, use_denoising=True, use_contrast_enhancement=False, use_morphological=False, denoise_method="fast",
+                     threshold_block_size=THRESHOLD_BLOCK_SIZE, threshold_c=THRESHOLD_C, use_crop=False,
+                     morphological_kernel_size=MORPHOLOGICAL_KERNEL_SIZE, cache=None, tiled=None):
     """
     Preprocess the image using OpenCV to improve OCR accuracy.
 
+    Decodes the bytes, runs preprocess_array and encodes the result as PNG.
+    Callers that go on to display or upload the image should use
+    decode_image and preprocess_array instead, and skip the PNG round trip.
+
     Args:
         image_bytes (bytes): Raw image bytes
         use_grayscale (bool): Whether to apply grayscale conversion
@@ -12,58 +514,185 @@ def preprocess_image(image_bytes, use_grayscale=True, use_threshold=True, use_de
         use_denoising (bool): Whether to apply denoising
         use_contrast_enhancement (bool): Whether to apply CLAHE for contrast enhancement
         use_morphological (bool): Whether to apply morphological operations (dilation and erosion)
+        denoise_method (str): One of DENOISE_METHODS; "fast" (median/bilateral filter) or
+            "nlmeans" (OpenCV's non-local means, much slower)
+        threshold_block_size (int): Odd side of the adaptive threshold neighbourhood, in pixels
+        threshold_c (float): Constant subtracted from the neighbourhood mean when thresholding
+        use_crop (bool): Whether to deskew the page and crop it to its ruled writing area,
+            leaving out printed headers, barcodes and margins (see find_writing_region)
+        morphological_kernel_size (int): Side of the square dilation/erosion kernel, in pixels
+        cache (PreprocessCache): Optional cache of intermediate results; only the steps
+            after the longest cached prefix are computed
+        tiled (bool): Run local steps on overlapping tiles in parallel; by default only
+            with PREPROCESS_TILED=1, for images with at least TILE_MIN_PIXELS pixels
+            on a multi-core machine
 
     Returns:
         bytes: Processed image bytes ready for OCR
     """
-    # Convert bytes to numpy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    options = dict(use_grayscale=use_grayscale, use_threshold=use_threshold, use_denoising=use_denoising,
+                   use_contrast_enhancement=use_contrast_enhancement, use_morphological=use_morphological,
+                   denoise_method=denoise_method, threshold_block_size=threshold_block_size,
+                   threshold_c=threshold_c, use_crop=use_crop, morphological_kernel_size=morphological_kernel_size)
+    key = image_hash(image_bytes) if cache is not None else None
+    steps = tuple(plan_steps(**options))
 
-    # Apply selected preprocessing steps
-    if use_grayscale:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if cache is not None:
+        encoded = cache.get((key, steps, 'png'))
+        if encoded is not None:
+            return encoded
 
-    if use_contrast_enhancement:
-        if use_grayscale:
-            # Apply CLAHE to grayscale image
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            img = clahe.apply(img)
-        else:
-            # For color images, apply CLAHE to L channel in LAB color space
-            lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-            l, a, b = cv2.split(lab)
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            l = clahe.apply(l)
-            lab = cv2.merge((l,a,b))
-            img = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+    img = decode_image(image_bytes, cache, key)
+    img = preprocess_array(img, **options, cache=cache, key=key, tiled=tiled)
 
-    if use_threshold and use_grayscale:  # Thresholding requires grayscale image
-        img = cv2.adaptiveThreshold(
-            img, 
-            255, 
-            cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 
-            11, 
-            2
-        )
+    # Convert back to bytes
+    with metrics.timed("preprocess", step="encode") as record:
+        success, processed_image = cv2.imencode('.png', img)
+        if not success:
+            raise Exception("Failed to encode processed image")
+        encoded = processed_image.tobytes()
+        record["bytes_out"] = len(encoded)
 
-    if use_morphological and use_grayscale:
-        # Define kernel size for morphological operations
-        kernel = np.ones((2,2), np.uint8)
-        # Apply dilation followed by erosion to enhance text contours
-        img = cv2.dilate(img, kernel, iterations=1)
-        img = cv2.erode(img, kernel, iterations=1)
+    if cache is not None:
+        cache.put((key, steps, 'png'), encoded)
+    return encoded
 
-    if use_denoising:
-        if use_grayscale:
-            img = cv2.fastNlMeansDenoising(img)
+# Longest side of the interactive preview. A page this size is processed in
+# tens of milliseconds, and the preview columns are narrower anyway.
+PREVIEW_MAX_SIDE = 1024
+
+def scale_options(options, scale):
+    """
+    Return preprocess_array keyword arguments with their sizes in pixels multiplied by scale.
+
+    The threshold block and the morphological kernel cover the same part of
+    the page on an image resized by scale, so a downscaled result looks like
+    the full-resolution one shrunk. Sizes are rounded to the nearest valid
+    value (odd blocks of at least 3 pixels, kernels of at least 1 pixel).
+
+    The threshold offset is scaled too: shrinking averages the pixel noise
+    down by about scale, and the offset is what keeps that noise from being
+    binarized, so a noisy page keeps about as many speckles in the preview
+    as in the result.
+    """
+    block_size = options.get("threshold_block_size", THRESHOLD_BLOCK_SIZE) * scale
+    kernel_size = options.get("morphological_kernel_size", MORPHOLOGICAL_KERNEL_SIZE) * scale
+    return {
+        **options,
+        "threshold_block_size": max(3, int(block_size // 2) * 2 + 1),
+        "threshold_c": round(options.get("threshold_c", THRESHOLD_C) * scale, 2),
+        "morphological_kernel_size": max(1, int(round(kernel_size))),
+    }
+
+def preprocess_preview(img, max_side=PREVIEW_MAX_SIDE, cache=None, key=None, **options):
+    """
+    Preprocess a downscaled copy of a decoded image, for the interactive preview.
+
+    The steps run on a proxy whose longest side is max_side, with their
+    sizes scaled to match (see scale_options), so a filter toggle redraws in
+    tens of milliseconds even on a 12 MP photo; the full-resolution pass is
+    left for the extraction. The crop is the exception: ruled lines are too
+    thin to find on the proxy, so the page is cropped at full resolution
+    (once per image, cached where the extraction picks it up) and then shrunk.
+
+    Args:
+        img (numpy.ndarray): BGR image, e.g. from decode_image
+        max_side (int): Longest side of the preview, in pixels
+        cache (PreprocessCache): Optional cache of intermediate results, used together with key
+        key (str): image_hash of the bytes img was decoded from
+        **options: preprocess_array keyword arguments, at full resolution
+
+    Returns:
+        tuple: (the original shrunk to max_side, the preprocessed preview)
+    """
+    if key is None:
+        cache = None
+    preview_key = f"{key}:preview{max_side}" if key is not None else None
+    original = cache.get((preview_key, ())) if cache is not None else None
+    if original is None:
+        original = downscale(img, max_side)
+        if cache is not None:
+            cache.put((preview_key, ()), original)
+
+    source, source_key = img, preview_key
+    if options.get("use_crop"):
+        source = preprocess_array(img, use_crop=True, use_grayscale=False, use_threshold=False, use_denoising=False,
+                                  cache=cache, key=key)
+        source_key = f"{key}:crop:preview{max_side}" if key is not None else None
+    scale = min(1.0, max_side / max(source.shape[:2]))
+    proxy = original if source is img else downscale(source, max_side)
+    options = scale_options({**options, "use_crop": False}, scale)
+    return original, preprocess_array(proxy, **options, cache=cache, key=source_key)
+
+def guess_mime_type(image_bytes):
+    """Return the MIME type of PNG, JPEG, WebP or GIF bytes from their signature"""
+    if image_bytes.startswith(b'\x89PNG'):
+        return "image/png"
+    if image_bytes.startswith(b'\xff\xd8'):
+        return "image/jpeg"
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return "image/webp"
+    if image_bytes.startswith(b'GIF8'):
+        return "image/gif"
+    return "application/octet-stream"
+
+def encode_for_upload(image, backend=None, max_side=None):
+    """
+    Re-encode an image into a compact upload for an OCR backend.
+
+    The image is downscaled so its longest side fits the backend's limit.
+    Binarized images become 1-bit PNGs and everything else a JPEG. The
+    original bytes are kept if re-encoding doesn't make them smaller.
+
+    Args:
+        image (bytes or numpy.ndarray): Image bytes, original or from preprocess_image, or an
+            array from decode_image or preprocess_array, which is encoded without a decode
+        backend (str): Name of the OCR backend, used to pick the size limit
+        max_side (int): Overrides the backend's longest side limit
+
+    Returns:
+        tuple: (encoded bytes, MIME type, stats dict with original_bytes, encoded_bytes and bytes_saved;
+               for an array original_bytes is the size of its pixels)
+    """
+    is_array = isinstance(image, np.ndarray)
+    original_bytes = image.nbytes if is_array else len(image)
+    with metrics.timed("upload_encode", backend=backend) as record:
+        record["bytes_in"] = original_bytes
+        max_side = max_side or UPLOAD_MAX_SIDE.get(backend, DEFAULT_UPLOAD_MAX_SIDE)
+        if is_array:
+            img = image
         else:
-            img = cv2.fastNlMeansDenoisingColored(img)
+            img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_UNCHANGED)
+            if img is None:
+                raise Exception("Failed to decode image")
+            if img.ndim == 3 and img.shape[2] == 4:
+                img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
 
-    # Convert back to bytes
-    success, processed_image = cv2.imencode('.png', img)
-    if not success:
-        raise Exception("Failed to encode processed image")
+        binary = _is_binary(img)
+        scale = max_side / max(img.shape[:2])
+        if scale < 1:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            if binary:
+                # Area interpolation blurs the edges; bring the image back to two levels
+                _, img = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
+
+        if binary:
+            success, encoded = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_BILEVEL, 1])
+            mime_type = "image/png"
+        else:
+            success, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, UPLOAD_JPEG_QUALITY])
+            mime_type = "image/jpeg"
+        if not success:
+            raise Exception("Failed to encode image for upload")
+
+        encoded = encoded.tobytes()
+        if not is_array and scale >= 1 and len(encoded) >= len(image):
+            encoded, mime_type = image, guess_mime_type(image)
+        record["bytes_out"] = len(encoded)
 
-    return processed_image.tobytes()
\ No newline at end of file
+    stats = {
+        "original_bytes": original_bytes,
+        "encoded_bytes": len(encoded),
+        "bytes_saved": original_bytes - len(encoded),
+    }
+    return encoded, mime_type, stats
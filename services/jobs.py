@@ -0,0 +1,407 @@
+"""
+Background jobs for text extraction and essay evaluation.
+
+Views submit jobs to a queue kept in a local SQLite file and poll their
+status, so a rerun or a page change no longer cancels the work. A separate
+pool of worker processes claims queued jobs one at a time, which bounds the
+number of concurrent OCR/assistant runs independently of the number of open
+sessions. Start the pool next to the Streamlit server (from the project
+root, so the workers find .streamlit/secrets.toml):
+
+    python -m services.jobs --workers 4
+
+Workers send a heartbeat while they run; jobs left "running" by a worker
+that stopped sending heartbeats go back to the queue, up to MAX_ATTEMPTS.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from services import metrics, rate_limit
+
+DEFAULT_PATH = os.environ.get('JOBS_DB_PATH', os.path.join('.cache', 'jobs.sqlite3'))
+DEFAULT_WORKERS = 2
+POLL_INTERVAL_SECONDS = 1.0
+HEARTBEAT_INTERVAL_SECONDS = 5.0
+# A worker without a heartbeat for this long is considered dead
+WORKER_TIMEOUT_SECONDS = 60.0
+MAX_ATTEMPTS = 3
+# Finished jobs (and their files) are removed after this long
+RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+KINDS = ("extract", "evaluate")
+STATUSES = ("queued", "running", "done", "error")
+
+class JobQueue:
+    """SQLite-backed job queue shared by the web sessions and the workers"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly where needed
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        if path != ':memory:':
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                user_id TEXT,
+                label TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created);
+            CREATE INDEX IF NOT EXISTS jobs_user_created ON jobs (user_id, created);
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (job_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS workers (
+                name TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                heartbeat REAL NOT NULL
+            );
+        """)
+
+    def submit(self, kind, payload, files=(), user_id=None, label=None):
+        """
+        Queue a job.
+
+        Args:
+            kind (str): One of KINDS
+            payload (dict): JSON-serializable arguments of the job
+            files (iterable): (file name, bytes) pairs stored with the job, e.g. the essay images
+            user_id (str): Owner of the job, used to list a user's jobs
+            label (str): Short description shown in the views
+
+        Returns:
+            str: The job id
+        """
+        if kind not in KINDS:
+            raise Exception(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, kind, user_id, label, payload, status, created) "
+                    "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                    (job_id, kind, None if user_id is None else str(user_id), label,
+                     json.dumps(payload), time.time())
+                )
+                self._conn.executemany(
+                    "INSERT INTO job_files (job_id, position, name, data) VALUES (?, ?, ?, ?)",
+                    [(job_id, position, name, sqlite3.Binary(data)) for position, (name, data) in enumerate(files)]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def get(self, job_id):
+        """Return the job as a dict (without its files), or None if it does not exist"""
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_from_row(row) if row else None
+
+    def list(self, user_id=None, limit=20):
+        """Return the most recent jobs, optionally only those of one user"""
+        query = f"SELECT {_JOB_COLUMNS} FROM jobs"
+        params = ()
+        if user_id is not None:
+            query += " WHERE user_id = ?"
+            params = (str(user_id),)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created DESC LIMIT ?", params + (limit,)).fetchall()
+        return [_job_from_row(row) for row in rows]
+
+    def files(self, job_id):
+        """Return the (file name, bytes) pairs stored with a job, in order"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, data FROM job_files WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+        return [(name, bytes(data)) for name, data in rows]
+
+    def claim(self, worker):
+        """
+        Atomically move the oldest queued job to "running" and return it.
+
+        Returns:
+            dict: The claimed job, or None if the queue is empty
+        """
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so two workers can't claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    f"SELECT {_JOB_COLUMNS} FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, started = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (worker, time.time(), row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = _job_from_row(row)
+        job.update(status="running", worker=worker, attempts=job["attempts"] + 1)
+        return job
+
+    def complete(self, job_id, result):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished = ? WHERE id = ?",
+                (result, time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'error', error = ?, finished = ? WHERE id = ?",
+                (error, time.time(), job_id)
+            )
+
+    def heartbeat(self, worker):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO workers (name, pid, heartbeat) VALUES (?, ?, ?)",
+                (worker, os.getpid(), time.time())
+            )
+
+    def unregister(self, worker):
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE name = ?", (worker,))
+
+    def active_workers(self, timeout=WORKER_TIMEOUT_SECONDS):
+        """Return the number of workers that sent a heartbeat recently"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE heartbeat >= ?", (time.time() - timeout,)
+            ).fetchone()[0]
+
+    def recover(self, timeout=WORKER_TIMEOUT_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """
+        Requeue the jobs of dead workers and drop old finished jobs.
+
+        Returns:
+            int: Number of jobs put back in the queue
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - timeout,))
+                orphaned = "status = 'running' AND (worker IS NULL OR worker NOT IN (SELECT name FROM workers))"
+                self._conn.execute(
+                    f"UPDATE jobs SET status = 'error', error = 'Processamento interrompido', finished = ? "
+                    f"WHERE {orphaned} AND attempts >= ?",
+                    (now, max_attempts)
+                )
+                requeued = self._conn.execute(
+                    f"UPDATE jobs SET status = 'queued', worker = NULL, started = NULL WHERE {orphaned}"
+                ).rowcount
+                self._conn.execute(
+                    "DELETE FROM job_files WHERE job_id IN "
+                    "(SELECT id FROM jobs WHERE status IN ('done', 'error') AND finished < ?)",
+                    (now - RETENTION_SECONDS,)
+                )
+                self._conn.execute(
+                    "DELETE FROM jobs WHERE status IN ('done', 'error') AND finished < ?",
+                    (now - RETENTION_SECONDS,)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return requeued
+
+    def stats(self):
+        """Return the number of jobs per status and the number of active workers"""
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        stats = {status: counts.get(status, 0) for status in STATUSES}
+        stats["workers"] = self.active_workers()
+        return stats
+
+_JOB_COLUMNS = "id, kind, user_id, label, payload, status, result, error, attempts, worker, created, started, finished"
+
+def _job_from_row(row):
+    job = dict(zip(_JOB_COLUMNS.split(', '), row))
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+    """Return the process-wide queue instance"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
+
+def submit_extraction(files, api_option, preprocess_options=None, user_id=None, label=None, queue=None):
+    """
+    Queue the extraction of one essay.
+
+    Args:
+        files (list): (file name, bytes) pairs of the essay images and/or PDFs, in page order
+        api_option (str): One of ocr.API_OPTIONS
+        preprocess_options (dict): Keyword arguments for preprocess_image, image_quality.AUTO, or None for
+            the originals
+    """
+    queue = queue or get_queue()
+    payload = {"api_option": api_option, "preprocess_options": preprocess_options}
+    return queue.submit("extract", payload, files=files, user_id=user_id, label=label)
+
+def submit_evaluation(essay_text, user_id=None, label=None, force=False, queue=None):
+    """Queue the evaluation of an essay by the OpenAI assistant (reusing cached evaluations unless force)"""
+    queue = queue or get_queue()
+    return queue.submit("evaluate", {"essay_text": essay_text, "force": force}, user_id=user_id, label=label)
+
+def _run_extract(job, queue):
+    from services import multipage
+
+    pages = list(multipage.iter_pages(queue.files(job["id"])))
+    if not pages:
+        raise Exception("Nenhuma imagem enviada")
+    payload = job["payload"]
+    return multipage.extract_text(pages, payload["api_option"], preprocess_options=payload["preprocess_options"])
+
+def _run_evaluate(job, queue):
+    from services import evaluation_cache, openai_client
+
+    payload = job["payload"]
+    evaluation, _ = evaluation_cache.evaluate(payload["essay_text"], openai_client.evaluate_essay,
+                                              force=payload.get("force", False))
+    return evaluation
+
+HANDLERS = {
+    "extract": _run_extract,
+    "evaluate": _run_evaluate,
+}
+
+def run_job(job, queue):
+    """Run a claimed job and store its result or error"""
+    try:
+        with metrics.timed("job", kind=job["kind"]), rate_limit.user_scope(job["user_id"]):
+            result = HANDLERS[job["kind"]](job, queue)
+    except Exception as e:
+        queue.fail(job["id"], str(e))
+    else:
+        queue.complete(job["id"], result)
+
+def work(path=DEFAULT_PATH, worker=None, stop=None, poll_interval=POLL_INTERVAL_SECONDS):
+    """
+    Claim and run jobs until stop is set.
+
+    Args:
+        path (str): Queue database
+        worker (str): Worker name, defaults to host-pid
+        stop (threading.Event): Set to finish after the current job
+        poll_interval (float): Seconds to wait when the queue is empty
+    """
+    queue = JobQueue(path)
+    worker = worker or f"{os.uname().nodename}-{os.getpid()}"
+    stop = stop or threading.Event()
+    queue.heartbeat(worker)
+
+    # Heartbeats keep flowing while a long job (e.g. an assistant run) is in progress
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL_SECONDS):
+            queue.heartbeat(worker)
+
+    threading.Thread(target=beat, name='heartbeat', daemon=True).start()
+    try:
+        while not stop.is_set():
+            job = queue.claim(worker)
+            if job is None:
+                stop.wait(poll_interval)
+                continue
+            run_job(job, queue)
+    finally:
+        stop.set()
+        queue.unregister(worker)
+
+def _worker_main(path, name):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The pid keeps a restarted worker from passing for the dead one, whose
+    # running job recover() would then never requeue
+    work(path, f"{name}-{os.getpid()}", stop)
+
+def run_pool(workers=DEFAULT_WORKERS, path=DEFAULT_PATH):
+    """Run a pool of worker processes, restarting any that die, until interrupted"""
+    queue = JobQueue(path)
+    processes = {}
+
+    def start(index):
+        name = f"{os.uname().nodename}-worker{index}"
+        dead = processes.get(index)
+        if dead is not None:
+            # Its running job goes back to the queue on the next recover(),
+            # without waiting for the heartbeat timeout
+            queue.unregister(f"{name}-{dead.pid}")
+        process = multiprocessing.Process(target=_worker_main, args=(path, name), name=name, daemon=True)
+        process.start()
+        processes[index] = process
+
+    for index in range(workers):
+        start(index)
+    print(f"{workers} worker(s) processando a fila {path}", flush=True)
+    try:
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            queue.recover()
+            for index, process in list(processes.items()):
+                if not process.is_alive():
+                    start(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Let the workers finish their current job
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Executa os trabalhos em segundo plano de extração e avaliação.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Número de processos")
+    parser.add_argument("--db", default=DEFAULT_PATH, help="Arquivo SQLite da fila")
+    args = parser.parse_args(argv)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    run_pool(args.workers, args.db)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
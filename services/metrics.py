@@ -0,0 +1,287 @@
+"""
+Lightweight instrumentation of the hot paths.
+
+Every observation records a stage name, labels (backend, step, ...), its
+duration, optional byte counts and an outcome ("ok", "error", "hit", ...).
+Observations are aggregated in memory per (stage, labels) with a bounded
+window of recent durations for p50/p95/p99, and can be exported:
+
+- as one JSON log line per observation, when METRICS_JSON_LOG is set
+  ("1" for stderr or a file path);
+- as Prometheus text exposition, with render_prometheus() or to the file
+  in METRICS_FILE, rewritten at most every METRICS_FILE_INTERVAL seconds.
+
+The Streamlit server and the job workers may share one METRICS_FILE: each
+process saves its own series to METRICS_FILE.<pid>.json, and METRICS_FILE
+is rewritten with the series of every process merged.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Number of recent durations kept per series to compute percentiles
+WINDOW_SIZE = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_FILE_INTERVAL = float(os.environ.get('METRICS_FILE_INTERVAL', '10'))
+# Series files of processes that stopped writing this long ago are dropped
+METRICS_FILE_MAX_AGE = float(os.environ.get('METRICS_FILE_MAX_AGE', str(24 * 60 * 60)))
+
+logger = logging.getLogger("palavra_mestra.metrics")
+
+def _configure_json_log():
+    target = os.environ.get('METRICS_JSON_LOG')
+    if not target or logger.handlers:
+        return
+    handler = logging.StreamHandler() if target == '1' else logging.FileHandler(target, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_configure_json_log()
+
+class _Series:
+    __slots__ = ("count", "total_seconds", "outcomes", "bytes_in", "bytes_out", "durations")
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.outcomes = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.durations = deque(maxlen=WINDOW_SIZE)
+
+_series = {}
+_lock = threading.Lock()
+_last_file_write = 0.0
+
+def observe(stage, seconds, outcome="ok", bytes_in=None, bytes_out=None, error=None, **labels):
+    """
+    Record one observation of a stage.
+
+    Args:
+        stage (str): Stage name, e.g. "ocr" or "preprocess"
+        seconds (float): Duration of the stage
+        outcome (str): "ok", "error" or a stage-specific outcome such as "hit"/"miss"
+        bytes_in (int): Size of the stage input, if meaningful
+        bytes_out (int): Size of the stage output, if meaningful
+        error (str): Error type, only written to the JSON log to keep series cardinality low
+        **labels: Extra dimensions, e.g. backend="Vision API"
+    """
+    key = (stage, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        series = _series.get(key)
+        if series is None:
+            series = _series[key] = _Series()
+        series.count += 1
+        series.total_seconds += seconds
+        series.outcomes[outcome] = series.outcomes.get(outcome, 0) + 1
+        series.bytes_in += bytes_in or 0
+        series.bytes_out += bytes_out or 0
+        series.durations.append(seconds)
+
+    if logger.isEnabledFor(logging.INFO):
+        entry = {"ts": round(time.time(), 3), "stage": stage, "seconds": round(seconds, 6), "outcome": outcome}
+        if bytes_in is not None:
+            entry["bytes_in"] = bytes_in
+        if bytes_out is not None:
+            entry["bytes_out"] = bytes_out
+        if error is not None:
+            entry["error"] = error
+        entry.update(labels)
+        logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+
+    if METRICS_FILE:
+        _maybe_write_file()
+
+@contextmanager
+def timed(stage, **labels):
+    """
+    Time a block of code as one observation of stage.
+
+    The yielded dict can be filled with "bytes_in", "bytes_out" and
+    "outcome"; an exception marks the observation as "error" and is re-raised.
+
+        with metrics.timed("ocr", backend="Vision API") as record:
+            record["bytes_in"] = len(image_content)
+            text = process_image(image_content)
+    """
+    record = {}
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["outcome"] = "error"
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        observe(
+            stage,
+            time.perf_counter() - start,
+            outcome=record.get("outcome", "ok"),
+            bytes_in=record.get("bytes_in"),
+            bytes_out=record.get("bytes_out"),
+            error=record.get("error"),
+            **labels
+        )
+
+def _snapshot():
+    with _lock:
+        return {key: (series.count, series.total_seconds, dict(series.outcomes),
+                      series.bytes_in, series.bytes_out, list(series.durations))
+                for key, series in _series.items()}
+
+def _process_path(path, pid=None):
+    return f"{path}.{os.getpid() if pid is None else pid}.json"
+
+def _read_process_files(path, now):
+    """Yield the series saved by the other processes sharing path"""
+    own = _process_path(path)
+    for process_path in glob.glob(f"{glob.escape(path)}.*.json"):
+        if process_path == own:
+            continue
+        try:
+            if now - os.path.getmtime(process_path) > METRICS_FILE_MAX_AGE:
+                os.remove(process_path)
+                continue
+            with open(process_path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            # Removed or replaced while listing; its process writes it again soon
+            continue
+        yield {(stage, tuple(tuple(label) for label in labels)): tuple(values) for stage, labels, *values in saved}
+
+def _merged(path=None):
+    """Return this process' series, plus those saved next to path by the other processes"""
+    items = _snapshot()
+    if path is None:
+        return items
+    for other in _read_process_files(path, time.time()):
+        for key, (count, total, outcomes, bytes_in, bytes_out, durations) in other.items():
+            if key not in items:
+                items[key] = (count, total, outcomes, bytes_in, bytes_out, durations)
+                continue
+            mine = items[key]
+            merged_outcomes = dict(mine[2])
+            for outcome, n in outcomes.items():
+                merged_outcomes[outcome] = merged_outcomes.get(outcome, 0) + n
+            items[key] = (mine[0] + count, mine[1] + total, merged_outcomes,
+                          mine[3] + bytes_in, mine[4] + bytes_out, mine[5] + durations)
+    return items
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def _items(path):
+    return [(key, count, total, outcomes, bytes_in, bytes_out, sorted(durations))
+            for key, (count, total, outcomes, bytes_in, bytes_out, durations) in _merged(path).items()]
+
+def summary(path=None):
+    """
+    Return one dict per (stage, labels) series with counts, outcomes, bytes and p50/p95/p99.
+
+    Args:
+        path (str): A METRICS_FILE, to include the series of every process writing it
+    """
+    items = _items(path)
+    rows = []
+    for (stage, labels), count, total, outcomes, bytes_in, bytes_out, durations in sorted(items):
+        row = {"stage": stage, **dict(labels), "count": count, "total_seconds": total,
+               "outcomes": outcomes, "bytes_in": bytes_in, "bytes_out": bytes_out}
+        for q in QUANTILES:
+            row[f"p{int(q * 100)}"] = _quantile(durations, q)
+        rows.append(row)
+    return rows
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels
+    )
+    return "{" + escaped + "}"
+
+def render_prometheus(path=None):
+    """
+    Return all series in the Prometheus text exposition format.
+
+    Args:
+        path (str): A METRICS_FILE, to include the series of every process writing it
+    """
+    items = _items(path)
+    lines = [
+        "# HELP palavra_stage_duration_seconds Duration of each processing stage.",
+        "# TYPE palavra_stage_duration_seconds summary",
+    ]
+    for (stage, labels), count, total, _, _, _, durations in sorted(items):
+        base = (("stage", stage),) + labels
+        for q in QUANTILES:
+            lines.append(f"palavra_stage_duration_seconds{_format_labels(base + (('quantile', str(q)),))} "
+                         f"{_quantile(durations, q):.6f}")
+        lines.append(f"palavra_stage_duration_seconds_sum{_format_labels(base)} {total:.6f}")
+        lines.append(f"palavra_stage_duration_seconds_count{_format_labels(base)} {count}")
+
+    lines += [
+        "# HELP palavra_stage_outcomes_total Observations of each stage by outcome.",
+        "# TYPE palavra_stage_outcomes_total counter",
+    ]
+    for (stage, labels), _, _, outcomes, _, _, _ in sorted(items):
+        for outcome, n in sorted(outcomes.items()):
+            lines.append(f"palavra_stage_outcomes_total"
+                         f"{_format_labels((('stage', stage),) + labels + (('outcome', outcome),))} {n}")
+
+    lines += [
+        "# HELP palavra_stage_bytes_total Bytes consumed and produced by each stage.",
+        "# TYPE palavra_stage_bytes_total counter",
+    ]
+    for (stage, labels), _, _, _, bytes_in, bytes_out, _ in sorted(items):
+        base = (("stage", stage),) + labels
+        if bytes_in:
+            lines.append(f"palavra_stage_bytes_total{_format_labels(base + (('direction', 'in'),))} {bytes_in}")
+        if bytes_out:
+            lines.append(f"palavra_stage_bytes_total{_format_labels(base + (('direction', 'out'),))} {bytes_out}")
+    return '\n'.join(lines) + '\n'
+
+def _write_atomically(path, text):
+    # Every process has its own temporary file, so concurrent writers never mix their output
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def write_prometheus(path):
+    """
+    Save this process' series next to path and atomically write the merged
+    render_prometheus(path) to it (e.g. for node_exporter's textfile collector).
+    """
+    saved = [[stage, [list(label) for label in labels], *values] for (stage, labels), values in _snapshot().items()]
+    _write_atomically(_process_path(path), json.dumps(saved, default=str))
+    _write_atomically(path, render_prometheus(path))
+
+def _maybe_write_file():
+    global _last_file_write
+    now = time.monotonic()
+    with _lock:
+        if now - _last_file_write < METRICS_FILE_INTERVAL:
+            return
+        _last_file_write = now
+    try:
+        write_prometheus(METRICS_FILE)
+    except OSError as e:
+        logger.warning("Could not write metrics file %s: %s", METRICS_FILE, e)
+
+def reset():
+    """Forget every observation"""
+    with _lock:
+        _series.clear()
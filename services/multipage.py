@@ -0,0 +1,152 @@
+"""
+Text extraction for essays spanning several pages.
+
+Pages come from several image files and/or PDFs. They are preprocessed in
+parallel, and with the Vision API they are packed into as few
+batch_annotate_images requests as the API limits allow. Each request is sent
+as soon as it is full, while later pages are still being prepared. The
+per-page transcripts are joined back in page order.
+"""
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from services import image_preprocess, image_quality, metrics, ocr, ocr_cache, visionai_client
+
+DEFAULT_WORKERS = 4
+PDF_RENDER_DPI = 200
+
+def is_pdf(name, data):
+    return name.lower().endswith('.pdf') or data[:5] == b'%PDF-'
+
+def render_pdf(pdf_bytes, dpi=PDF_RENDER_DPI):
+    """
+    Yield every page of a PDF as PNG bytes.
+
+    Pages are rendered one at a time because PDFium is not thread-safe.
+    """
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        raise Exception("O suporte a PDF requer o pacote pypdfium2.")
+
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            try:
+                pixels = page.render(scale=dpi / 72).to_numpy()
+            finally:
+                page.close()
+            if pixels.ndim == 3 and pixels.shape[2] == 4:
+                pixels = cv2.cvtColor(pixels, cv2.COLOR_BGRA2BGR)
+            success, encoded = cv2.imencode('.png', pixels)
+            if not success:
+                raise Exception("Failed to encode PDF page")
+            yield encoded.tobytes()
+    finally:
+        pdf.close()
+
+def iter_pages(files):
+    """
+    Yield (name, image_bytes) for every page of the given files, in order.
+
+    Args:
+        files (iterable): (file name, bytes) pairs of images and/or PDFs
+    """
+    for name, data in files:
+        if is_pdf(name, data):
+            for number, page in enumerate(render_pdf(data), start=1):
+                yield f"{name} (página {number})", page
+        else:
+            yield name, data
+
+def _join_pages(texts):
+    texts = [text for text in texts if text]
+    if not texts:
+        return "No handwritten text detected in the image."
+    return '\n'.join(texts)
+
+def _vision_batches(prepared):
+    # Group (index, upload) pairs into requests within the API limits
+    batch, size = [], 0
+    for index, upload in prepared:
+        upload_size = visionai_client.request_size(upload)
+        if batch and (len(batch) == visionai_client.MAX_IMAGES_PER_REQUEST
+                      or size + upload_size > visionai_client.MAX_REQUEST_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append((index, upload))
+        size += upload_size
+    if batch:
+        yield batch
+
+def _annotate(batch, client):
+    with metrics.timed("ocr", backend="Vision API", mode="batch") as record:
+        record["bytes_in"] = sum(len(upload) for _, upload in batch)
+        documents = visionai_client.annotate_batch([upload for _, upload in batch], client=client)
+    return [(index, document.text() if document.words else "") for (index, _), document in zip(batch, documents)]
+
+def extract_text(pages, api_option, preprocess_options=None, workers=DEFAULT_WORKERS, client=None):
+    """
+    Extract one ordered transcript from several pages.
+
+    Pages already in the OCR cache are not sent again. With the Vision API the
+    remaining pages go in batch_annotate_images requests; with the other APIs
+    each page is extracted concurrently.
+
+    Args:
+        pages (list): (name, image_bytes) pairs in reading order, e.g. from iter_pages
+        api_option (str): One of ocr.API_OPTIONS
+        preprocess_options (dict): Keyword arguments for preprocess_image, image_quality.AUTO to choose
+            them for each page, or None for the originals
+        workers (int): Number of pages prepared (or extracted) concurrently
+        client: Vision annotator client for batches, e.g. visionai_client.StubAnnotatorClient
+
+    Returns:
+        str: The transcript of all pages, in order
+    """
+    cache = ocr_cache.get_cache()
+    keys = [ocr_cache.make_key(image_bytes, preprocess_options, api_option) for _, image_bytes in pages]
+    texts = [ocr.cached_text(key, api_option) for key in keys]
+    missing = [index for index, text in enumerate(texts) if text is None]
+
+    def preprocess(index):
+        # Preprocessed pages stay arrays: they are encoded once, for the upload
+        image_bytes = pages[index][1]
+        if preprocess_options is None:
+            return image_bytes
+        img = image_preprocess.decode_image(image_bytes)
+        options = image_quality.resolve_options(img, preprocess_options)
+        return image_preprocess.preprocess_array(img, **options)
+
+    if api_option != "Vision API":
+        def extract(index):
+            return ocr.extract_text(preprocess(index), api_option, cache_key=keys[index], lookup=False)
+
+        with ThreadPoolExecutor(workers, thread_name_prefix='pagina') as pool:
+            # Copies of the caller's context keep its rate_limit.user_scope in the pool threads
+            futures = [pool.submit(contextvars.copy_context().run, extract, index) for index in missing]
+            for index, future in zip(missing, futures):
+                texts[index] = future.result()
+        return _join_pages(texts)
+
+    def prepare(index):
+        upload, _, _ = image_preprocess.encode_for_upload(preprocess(index), backend=api_option)
+        return index, upload
+
+    with ThreadPoolExecutor(workers, thread_name_prefix='pagina') as prepare_pool, \
+            ThreadPoolExecutor(2, thread_name_prefix='vision-batch') as request_pool:
+        # pool.map yields pages in order as they are ready, so each request is
+        # sent while the following pages are still being preprocessed
+        requests = [
+            request_pool.submit(_annotate, batch, client)
+            for batch in _vision_batches(prepare_pool.map(prepare, missing))
+        ]
+        for request in requests:
+            for index, text in request.result():
+                texts[index] = text
+                cache.put(keys[index], api_option, text)
+
+    return _join_pages(texts)
@@ -0,0 +1,219 @@
+import abc
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services import image_preprocess, metrics, ocr_cache, openai_client, page_bands, tesseract_client, visionai_client
+
+logger = logging.getLogger(__name__)
+
+# Send the secondary request if the primary backend hasn't answered after this many seconds
+HEDGE_AFTER_SECONDS = 8.0
+
+# Threads running the blocking clients. The pool lives as long as the process:
+# asyncio.run joins its default executor before returning, so with
+# asyncio.to_thread a hedged extraction would still wait for the losing request
+BLOCKING_WORKERS = 32
+_executor = ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix='ocr')
+
+async def _run_blocking(fn, *args):
+    # Like asyncio.to_thread, with the caller's context (e.g. rate_limit.user_scope),
+    # but on _executor, which nothing waits for when the event loop closes
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, contextvars.copy_context().run, fn, *args)
+
+class OCRBackend(abc.ABC):
+    """Common async interface of the text extraction backends"""
+
+    name = None
+
+    @abc.abstractmethod
+    async def extract(self, image_content):
+        """
+        Extract text from an image.
+
+        Args:
+            image_content (bytes or numpy.ndarray): The image content in bytes, or a
+                decoded/preprocessed array, encoded once for the upload
+
+        Returns:
+            str: Extracted text from the image
+        """
+
+class _UploadBackend(OCRBackend):
+    """Backend that re-encodes the image to a compact upload before calling a blocking client"""
+
+    @abc.abstractmethod
+    def _process_image(self, upload):
+        """Send the encoded upload to the client and return its text"""
+
+    def _extract(self, image_content):
+        upload, mime_type, stats = image_preprocess.encode_for_upload(image_content, backend=self.name)
+        logger.info("%s upload: %s, %d -> %d bytes (%d saved)", self.name, mime_type,
+                    stats["original_bytes"], stats["encoded_bytes"], stats["bytes_saved"])
+        with metrics.timed("ocr", backend=self.name) as record:
+            record["bytes_in"] = len(upload)
+            text = self._process_image(upload)
+            record["bytes_out"] = len(text.encode('utf-8'))
+        return text
+
+    async def extract(self, image_content):
+        return await _run_blocking(self._extract, image_content)
+
+class VisionBackend(_UploadBackend):
+    name = "Vision API"
+
+    def _process_image(self, upload):
+        return visionai_client.process_image(upload)
+
+class OpenAIBackend(_UploadBackend):
+    name = "OpenAI API"
+
+    def _process_image(self, upload):
+        return openai_client.process_image(upload)
+
+class TesseractBackend(_UploadBackend):
+    """Local engine in a process pool: no network, no cost per essay"""
+
+    name = "Tesseract (local)"
+
+    def _process_image(self, upload):
+        return tesseract_client.process_image(upload)
+
+class OpenAIBandsBackend(OpenAIBackend):
+    """
+    OpenAI backend that splits the page into horizontal bands (see page_bands)
+    and transcribes them with concurrent requests, so a long essay takes about
+    as long as its slowest band and isn't truncated at the token cap.
+    """
+
+    name = "OpenAI API (faixas)"
+
+    def __init__(self, bands=page_bands.DEFAULT_BANDS):
+        self.bands = bands
+
+    def _process_image(self, upload):
+        text = openai_client.process_image(upload, prompt=openai_client.BAND_EXTRACTION_PROMPT)
+        return "" if text == openai_client.NO_TEXT_MESSAGE else text
+
+    async def extract(self, image_content):
+        bands = await _run_blocking(page_bands.split_image, image_content, self.bands)
+        # Each band is encoded and sent in its own thread; gather keeps them in page order
+        texts = await asyncio.gather(*(_run_blocking(self._extract, band) for band in bands))
+        return page_bands.merge_transcripts(texts) or openai_client.NO_TEXT_MESSAGE
+
+class FakeBackend(OCRBackend):
+    """Offline backend returning a fixed text after a delay, for local testing"""
+
+    def __init__(self, text="Texto de teste.", delay=0.0, error=None, name="Fake"):
+        self.text = text
+        self.delay = delay
+        self.error = error
+        self.name = name
+        self.calls = 0
+
+    async def extract(self, image_content):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise Exception(self.error)
+        return self.text
+
+async def hedged_extract(image_content, primary, secondary, hedge_after=HEDGE_AFTER_SECONDS):
+    """
+    Extract text with primary, firing secondary too if primary is slow or fails.
+
+    Whichever backend answers successfully first wins. The other request is
+    cancelled, although a blocking client call already running in a thread
+    still finishes in the background and its result is discarded.
+
+    Args:
+        image_content (bytes or numpy.ndarray): The image content in bytes, or an array
+        primary (OCRBackend): Backend tried first
+        secondary (OCRBackend): Backend fired after hedge_after seconds
+        hedge_after (float): Latency threshold before hedging
+
+    Returns:
+        tuple: (name of the winning backend, extracted text)
+    """
+    tasks = {asyncio.create_task(primary.extract(image_content)): primary}
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+    first_error = None
+    for task in done:
+        if task.exception() is None:
+            return primary.name, task.result()
+        first_error = task.exception()
+        del tasks[task]
+
+    tasks[asyncio.create_task(secondary.extract(image_content))] = secondary
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                backend = tasks.pop(task)
+                if task.exception() is None:
+                    return backend.name, task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+BACKENDS = {backend.name: backend for backend in (VisionBackend(), OpenAIBackend(), OpenAIBandsBackend(),
+                                                   TesseractBackend())}
+
+# Vision API first, OpenAI API fired only when Vision is slow or fails
+HEDGED_OPTION = "Vision API + OpenAI API (redundante)"
+
+# Text extraction APIs available in the application
+API_OPTIONS = list(BACKENDS) + [HEDGED_OPTION]
+
+async def extract_text_async(image_content, api_option):
+    """Async version of extract_text, without the cache"""
+    if api_option == HEDGED_OPTION:
+        _, text = await hedged_extract(image_content, BACKENDS["Vision API"], BACKENDS["OpenAI API"])
+        return text
+    # Default to OpenAI API
+    backend = BACKENDS.get(api_option, BACKENDS["OpenAI API"])
+    return await backend.extract(image_content)
+
+def cached_text(cache_key, api_option):
+    """Return the cached text of an extraction, or None, recording the lookup in the ocr_cache metric"""
+    start = time.perf_counter()
+    text = ocr_cache.get_cache().get(cache_key)
+    metrics.observe("ocr_cache", time.perf_counter() - start,
+                    outcome="miss" if text is None else "hit", backend=api_option)
+    return text
+
+def extract_text(image_content, api_option, cache_key=None, lookup=True):
+    """
+    Extract text from an image using the selected API.
+
+    Results are kept in the OCR cache, so extracting the same image again
+    doesn't call the API.
+
+    Args:
+        image_content (bytes or numpy.ndarray): The image content in bytes, or an array from
+            image_preprocess.preprocess_array
+        api_option (str): One of API_OPTIONS
+        cache_key (str): Key from ocr_cache.make_key; defaults to a key for image_content as is
+            (pass one for arrays, which have no stable encoded form)
+        lookup (bool): Look cache_key up before extracting; False when the caller already
+            missed it with cached_text, so the miss isn't counted twice
+
+    Returns:
+        str: Extracted text from the image
+    """
+    if cache_key is None:
+        cache_key = ocr_cache.make_key(image_content, None, api_option)
+    if lookup:
+        text = cached_text(cache_key, api_option)
+        if text is not None:
+            return text
+
+    text = asyncio.run(extract_text_async(image_content, api_option))
+
+    ocr_cache.get_cache().put(cache_key, api_option, text)
+    return text
@@ -0,0 +1,157 @@
+"""
+Persistent cache for text extraction results.
+
+Entries are keyed by the hash of the original image bytes, the preprocessing
+flags applied to it and the extraction backend, and live in a local SQLite
+file. Old entries expire after a TTL and the least recently used ones are
+evicted once the stored text exceeds a size cap.
+
+A hit only reads: the access times it refreshes are kept in memory and
+written together, by the next put (before it evicts) or once
+ACCESS_FLUSH_ENTRIES of them or ACCESS_FLUSH_SECONDS have piled up.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.environ.get('OCR_CACHE_PATH', os.path.join('.cache', 'ocr_cache.sqlite3'))
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+ACCESS_FLUSH_ENTRIES = 64
+ACCESS_FLUSH_SECONDS = 30.0
+
+def make_key(image_bytes, preprocess_options, backend):
+    """
+    Build the cache key for an extraction.
+
+    Args:
+        image_bytes (bytes): The original (not preprocessed) image bytes
+        preprocess_options (dict): Flags given to preprocess_image, or None for the original image
+        backend (str): Name of the text extraction API
+
+    Returns:
+        str: Hex digest identifying the extraction
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    flags = json.dumps(preprocess_options, sort_keys=True, default=str)
+    return hashlib.sha256(f"{digest}|{flags}|{backend}".encode('utf-8')).hexdigest()
+
+class OCRCache:
+    """SQLite-backed extraction cache with TTL and size-based eviction"""
+
+    def __init__(self, path=DEFAULT_PATH, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> last access time not yet written
+        self._accessed = {}
+        self._last_flush = time.monotonic()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_cache (
+                key TEXT PRIMARY KEY,
+                backend TEXT NOT NULL,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_accessed ON ocr_cache (accessed)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Return the cached text for key, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM ocr_cache WHERE key = ? AND created >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = now
+            if (len(self._accessed) >= ACCESS_FLUSH_ENTRIES
+                    or time.monotonic() - self._last_flush >= ACCESS_FLUSH_SECONDS):
+                self._flush_accessed()
+                self._conn.commit()
+            return row[0]
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self._conn.executemany("UPDATE ocr_cache SET accessed = ? WHERE key = ?",
+                                   [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+        self._last_flush = time.monotonic()
+
+    def put(self, key, backend, text):
+        """Store an extraction result and evict expired or excess entries"""
+        now = time.time()
+        size = len(text.encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, backend, text, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, backend, text, size, now, now)
+            )
+            self._flush_accessed()
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM ocr_cache WHERE created < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we are back under the cap
+        excess = total - self.max_bytes
+        for key, size in self._conn.execute("SELECT key, size FROM ocr_cache ORDER BY accessed").fetchall():
+            if excess <= 0:
+                break
+            self._conn.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+            excess -= size
+
+    def clear(self):
+        """Remove every entry and reset the counters"""
+        with self._lock:
+            self._conn.execute("DELETE FROM ocr_cache")
+            self._conn.commit()
+            self._accessed.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and storage usage"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_cache"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Return the process-wide cache instance"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = OCRCache()
+        return _cache
@@ -1,28 +1,72 @@
 from http import client
 import streamlit as st
 import base64
-from openai import OpenAI
-from openai import OpenAIError
+import time
+from services import clients, metrics, rate_limit
+
+def _create_openai_client():
+    # The openai package is only imported once an OpenAI call is made
+    from openai import OpenAI
 
-def get_openai_client():
-    """Initialize OpenAI client"""
     openai_api_key = st.secrets["OPENAI_API_KEY"]
     if not openai_api_key:
         raise Exception("OpenAI API key not found in environment variables")
-    return OpenAI(api_key=openai_api_key)
+    # Retries are done by the rate limiter, which also charges them to the budget
+    return OpenAI(api_key=openai_api_key, max_retries=0)
+
+def get_openai_client():
+    """Return the shared OpenAI client (created once per process)"""
+    return clients.get_client("openai", _create_openai_client)
+
+# Token estimates charged to the rate limiter before the real usage is known
+IMAGE_TOKENS_ESTIMATE = 765  # a 2048x1536 upload in high detail
+EXTRACTION_MAX_TOKENS = 1000
+EVALUATION_TOKENS_ESTIMATE = 6000  # assistant instructions and evaluation, besides the essay
 
-def process_image(image_content):
+def _total_tokens(response):
+    usage = getattr(response, "usage", None)
+    return usage.total_tokens if usage else None
+
+def _raise_api_error(e):
+    if getattr(e, "status_code", None) == 429:
+        raise Exception("Limite de uso da OpenAI atingido. Por favor, tente novamente em alguns instantes.")
+    raise Exception(f"Erro ao communicar com a OpenAI API: {str(e)}")
+
+EXTRACTION_PROMPT = (
+    "This is an image of a handwritten essay in Brazilian Portuguese. "
+    "Note that there are some digital characters in the image, but extract only the handwritten text from this image, trying to be as accurate as possible. "
+    "Do not alter the text by making any interpretations. "
+    "Just extract the handwritten text. "
+    "The answer should be only the extracted text in a clear and legible format."
+)
+NO_TEXT_MESSAGE = "Nenhum texto manuscrito detectado na imagem."
+# For one horizontal band of a page (see page_bands)
+BAND_EXTRACTION_PROMPT = (
+    "This is a horizontal strip cut from an image of a handwritten essay in Brazilian Portuguese. "
+    "Extract only the handwritten text in this strip, line by line, trying to be as accurate as possible. "
+    "Skip any line cut off at the top or bottom edge of the strip. "
+    "Do not alter the text by making any interpretations. "
+    "The answer should be only the extracted text, or nothing if the strip has no handwriting."
+)
+
+def process_image(image_content, user=None, prompt=EXTRACTION_PROMPT):
     """
     Extract text from image using OpenAI's Vision model
+
+    The request waits for its turn in the shared rate limiter, queued under
+    user (or rate_limit.user_scope's user).
     """
+    from services import image_preprocess
+
     try:
         client = get_openai_client()
         
         # Convert image bytes to base64
         base64_image = base64.b64encode(image_content).decode('utf-8')
+        mime_type = image_preprocess.guess_mime_type(image_content)
         
         # Call OpenAI API with vision model
-        response = client.chat.completions.create(
+        response = rate_limit.get_limiter().call(lambda: client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -30,81 +74,181 @@ def process_image(image_content):
                     "content": [
                         {
                             "type": "text",
-                            "text": "This is an image of a handwritten essay in Brazilian Portuguese. "
-                                    "Note that there are some digital characters in the image, but extract only the handwritten text from this image, trying to be as accurate as possible. "
-                                    "Do not alter the text by making any interpretations. "
-                                    "Just extract the handwritten text. "
-                                    "The answer should be only the extracted text in a clear and legible format."
+                            "text": prompt
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": f"data:{mime_type};base64,{base64_image}"
                             }
                         }
                     ]
                 }
             ],
-            max_tokens=1000
-        )
+            max_tokens=EXTRACTION_MAX_TOKENS
+        ), user=user, tokens=IMAGE_TOKENS_ESTIMATE + EXTRACTION_MAX_TOKENS, usage=_total_tokens)
         
         # Extract the text from response
         extracted_text = response.choices[0].message.content
         
         if not extracted_text or extracted_text.strip() == "":
-            return "Nenhum texto manuscrito detectado na imagem."
+            return NO_TEXT_MESSAGE
             
         return extracted_text
         
     except Exception as e:
         raise Exception(f"Erro ao processar imagem com OpenAI: {str(e)}")
 
-def evaluate_essay(essay_text):
+# Assistant run settings
+EVALUATION_TIMEOUT_SECONDS = 180
+POLL_INITIAL_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 5.0
+RUN_TERMINAL_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete", "requires_action")
+
+def _get_assistant_id():
+    # Acessa diretamente o Assitente pré-criado na OpenAI
+    assistant_id = st.secrets["OPENAI_ASSISTANT_ID"]
+    if not assistant_id:
+        raise Exception("O ID do Assistente da OpenAI não está configurado.")
+    return assistant_id
+
+def _check_run_status(run):
+    """Raise a user-facing error for any terminal status other than completed"""
+    if run.status == "completed":
+        return
+    if run.status == "failed":
+        raise Exception("Assistente de IA falhou em processar a redação. Por favor, tente novamente.")
+    if run.status == "requires_action":
+        raise Exception("O assistente solicitou uma ação não suportada por este aplicativo.")
+    raise Exception(f"A avaliação foi interrompida (status: {run.status}). Por favor, tente novamente.")
+
+def _cancel_run(client, thread_id, run_id):
+    from openai import OpenAIError
+
+    try:
+        client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+    except OpenAIError:
+        pass
+
+def _evaluation_tokens(essay_text):
+    return EVALUATION_TOKENS_ESTIMATE + rate_limit.estimate_tokens(essay_text)
+
+def evaluate_essay(essay_text, timeout=EVALUATION_TIMEOUT_SECONDS, user=None):
     """
     Send the essay text to a specific OpenAI Assistant for evaluation
+
+    The run status is polled with exponential backoff until it reaches a
+    terminal state; the run is cancelled if it takes longer than timeout.
+    Every request goes through the shared rate limiter, queued under user.
     """
+    from openai import OpenAIError
+
     try:
         client = get_openai_client()
-        # Acessa diretamente o Assitente pré-criado na OpenAI
-        ASSISTANT_ID = st.secrets["OPENAI_ASSISTANT_ID"]
-        if not ASSISTANT_ID:
-            raise Exception("O ID do Assistente da OpenAI não está configurado.")
-
-        # Create a thread
-        thread = client.beta.threads.create()
-
-        # Add message to thread
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=essay_text
-        )
+        assistant_id = _get_assistant_id()
+        limiter = rate_limit.get_limiter()
+        estimated_tokens = _evaluation_tokens(essay_text)
 
-        # Run the assistant
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=ASSISTANT_ID
-        )
+        # Create the thread with the essay and run the assistant in one request
+        with metrics.timed("evaluate", phase="run") as record:
+            record["bytes_in"] = len(essay_text.encode('utf-8'))
+            run = limiter.call(lambda: client.beta.threads.create_and_run(
+                assistant_id=assistant_id,
+                thread={"messages": [{"role": "user", "content": essay_text}]}
+            ), user=user, tokens=estimated_tokens)
 
-        # Wait for the run to complete
-        while run.status not in ["completed", "failed"]:
-            run = client.beta.threads.runs.retrieve(
-                thread_id=thread.id,
-                run_id=run.id
-            )
+        # Wait for the run to finish
+        with metrics.timed("evaluate", phase="poll") as record:
+            deadline = time.monotonic() + timeout
+            interval = POLL_INITIAL_INTERVAL
+            while run.status not in RUN_TERMINAL_STATUSES:
+                if time.monotonic() >= deadline:
+                    _cancel_run(client, run.thread_id, run.id)
+                    raise Exception("Tempo limite excedido ao aguardar a avaliação da redação.")
+                time.sleep(interval)
+                interval = min(interval * 2, POLL_MAX_INTERVAL)
+                run = limiter.call(lambda: client.beta.threads.runs.retrieve(
+                    thread_id=run.thread_id,
+                    run_id=run.id
+                ), user=user)
+            record["outcome"] = run.status
 
-        if run.status == "failed":
-            raise Exception("Assistente de IA falhou em processar a redação. Por favor, tente novamente.")
+        limiter.settle(estimated_tokens, _total_tokens(run))
+        _check_run_status(run)
 
         # Get the assistant's response
-        messages = client.beta.threads.messages.list(
-            thread_id=thread.id
-        )
+        with metrics.timed("evaluate", phase="messages"):
+            messages = limiter.call(lambda: client.beta.threads.messages.list(
+                thread_id=run.thread_id,
+                run_id=run.id
+            ), user=user)
 
         # Return the latest assistant message
         return messages.data[0].content[0].text.value
 
     except OpenAIError as e:
-        raise Exception(f"Erro ao communicar com a OpenAI API: {str(e)}")
+        _raise_api_error(e)
+    except Exception as e:
+        raise Exception(f"Um erro inesperado ocorreu: {str(e)}")
+
+def evaluate_essay_stream(essay_text, timeout=EVALUATION_TIMEOUT_SECONDS, user=None):
+    """
+    Evaluate the essay like evaluate_essay, yielding the assistant's text as it is generated.
+
+    Meant to be passed to st.write_stream. The run is cancelled if it takes
+    longer than timeout, and any terminal status other than completed is
+    raised as an error once the stream ends.
+
+    Yields:
+        str: Chunks of the evaluation text
+    """
+    from openai import OpenAIError
+
+    try:
+        client = get_openai_client().with_options(timeout=timeout)
+        assistant_id = _get_assistant_id()
+        limiter = rate_limit.get_limiter()
+        estimated_tokens = _evaluation_tokens(essay_text)
+        start = time.monotonic()
+        deadline = start + timeout
+        run = None
+        first_token = True
+
+        manager = client.beta.threads.create_and_run_stream(
+            assistant_id=assistant_id,
+            thread={"messages": [{"role": "user", "content": essay_text}]}
+        )
+        # Entering the manager sends the request, so that is what waits for
+        # the budget and is retried; a stream that already started is not
+        stream = limiter.call(manager.__enter__, user=user, tokens=estimated_tokens)
+        try:
+            for event in stream:
+                if event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step"):
+                    run = event.data
+                elif event.event == "thread.message.delta":
+                    for block in event.data.delta.content or []:
+                        if block.type == "text" and block.text and block.text.value:
+                            if first_token:
+                                metrics.observe("evaluate", time.monotonic() - start, phase="first_token")
+                                first_token = False
+                            yield block.text.value
+                elif event.event == "error":
+                    raise Exception(event.data.message)
+
+                if time.monotonic() >= deadline:
+                    if run is not None:
+                        _cancel_run(client, run.thread_id, run.id)
+                    raise Exception("Tempo limite excedido ao aguardar a avaliação da redação.")
+        finally:
+            manager.__exit__(None, None, None)
+
+        if run is None or run.status not in RUN_TERMINAL_STATUSES:
+            raise Exception("A conexão com o assistente foi encerrada antes do fim da avaliação.")
+        metrics.observe("evaluate", time.monotonic() - start, outcome=run.status, phase="stream")
+        limiter.settle(estimated_tokens, _total_tokens(run))
+        _check_run_status(run)
+
+    except OpenAIError as e:
+        _raise_api_error(e)
     except Exception as e:
-        raise Exception(f"Um erro inesperado ocorreu: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Um erro inesperado ocorreu: {str(e)}")
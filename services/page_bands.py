@@ -0,0 +1,160 @@
+"""
+Split a page into horizontal bands and merge their transcripts back.
+
+A long essay sent as one image is transcribed in a single slow request and
+can hit the completion token cap. Split into bands, the page is transcribed
+by concurrent requests, so the latency is roughly that of the slowest band
+and each band has the whole token cap to itself.
+
+Cuts are placed in the emptiest row near each equal split, which on an
+essay is the gap between two lines of writing. When a cut has to go
+through the writing, the bands around it overlap by about a line, so that
+line is whole in both of them, and merge_transcripts drops it from the
+second transcript.
+"""
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+import cv2
+import numpy as np
+
+DEFAULT_BANDS = 3
+# Bands are at least this tall (pixels), so short pages are split less
+MIN_BAND_HEIGHT = 400
+# Cuts are searched this fraction of a band above and below the equal split
+CUT_SEARCH_FRACTION = 0.25
+# A cut row with at most this fraction of ink is a clean gap between lines
+CLEAN_GAP_FRACTION = 0.01
+# Bands around a cut through the writing overlap by this fraction of the page
+# height on each side (about a line on a 30-line essay form)
+OVERLAP_FRACTION = 0.035
+PROFILE_MAX_SIDE = 1024
+
+# Lines at the end of a transcript compared with the start of the next one
+MERGE_MAX_LINES = 3
+# Each repeated line must be this similar to its first transcription, and
+# the repeated lines this long together, so short common lines don't match
+MERGE_MIN_SIMILARITY = 0.8
+MERGE_MIN_CHARS = 12
+
+def _ink_profile(gray):
+    # Fraction of ink per row, on a proxy; Otsu separates ink from paper
+    scale = min(1.0, PROFILE_MAX_SIDE / max(gray.shape))
+    proxy = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    _, ink = cv2.threshold(proxy, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    # Ruled lines are ink too, but belong to the gaps: drop long horizontal runs
+    long_runs = cv2.morphologyEx(ink, cv2.MORPH_OPEN,
+                                 cv2.getStructuringElement(cv2.MORPH_RECT, (max(1, proxy.shape[1] // 8), 1)))
+    profile = np.count_nonzero(ink & ~long_runs, axis=1) / proxy.shape[1]
+    # Back to full-resolution rows
+    return np.interp(np.arange(gray.shape[0]), (np.arange(len(profile)) + 0.5) / scale - 0.5, profile)
+
+def find_cuts(gray, bands=DEFAULT_BANDS):
+    """
+    Choose the rows where a page is cut into bands.
+
+    Returns:
+        list: (row, clean) for each cut, top to bottom; clean is False when
+              the cut goes through the writing
+    """
+    height = gray.shape[0]
+    bands = max(1, min(bands, height // MIN_BAND_HEIGHT))
+    if bands == 1:
+        return []
+    profile = _ink_profile(gray)
+    band_height = height / bands
+    search = int(band_height * CUT_SEARCH_FRACTION)
+    cuts = []
+    for index in range(1, bands):
+        target = int(index * band_height)
+        low, high = target - search, target + search + 1
+        row = low + int(np.argmin(profile[low:high]))
+        cuts.append((row, bool(profile[row] <= CLEAN_GAP_FRACTION)))
+    return cuts
+
+def split_image(image, bands=DEFAULT_BANDS):
+    """
+    Cut a page into horizontal bands.
+
+    Args:
+        image (bytes or numpy.ndarray): The page, original or from preprocess_image, or an
+            array from preprocess_array
+        bands (int): Number of bands wanted; fewer on pages shorter than
+            bands * MIN_BAND_HEIGHT
+
+    Returns:
+        list: Bands, top to bottom. Bands of an array are views of it, left for
+              encode_for_upload to encode; bands of bytes are encoded (PNG if the
+              page is binarized, JPEG otherwise)
+    """
+    is_array = isinstance(image, np.ndarray)
+    if is_array:
+        img = image
+    else:
+        img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise Exception("Failed to decode image")
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    cuts = find_cuts(gray, bands)
+    if not cuts:
+        return [image]
+
+    height = img.shape[0]
+    overlap = int(height * OVERLAP_FRACTION)
+    binary = img.ndim == 2 and not np.any((img != 0) & (img != 255))
+    encoded = []
+    for index in range(len(cuts) + 1):
+        top, bottom = 0, height
+        if index > 0:
+            row, clean = cuts[index - 1]
+            top = row if clean else max(0, row - overlap)
+        if index < len(cuts):
+            row, clean = cuts[index]
+            bottom = row if clean else min(height, row + overlap)
+        band = img[top:bottom]
+        if is_array:
+            encoded.append(band)
+            continue
+        if binary:
+            success, data = cv2.imencode('.png', band, [cv2.IMWRITE_PNG_BILEVEL, 1])
+        else:
+            success, data = cv2.imencode('.jpg', band, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        if not success:
+            raise Exception("Failed to encode image band")
+        encoded.append(data.tobytes())
+    return encoded
+
+def _normalize_line(line):
+    line = unicodedata.normalize('NFKC', line).casefold()
+    return re.sub(r'[^\w]+', ' ', line).strip()
+
+def _overlap_lines(previous, following):
+    # Number of lines at the start of following repeating the end of previous
+    for count in range(min(MERGE_MAX_LINES, len(previous), len(following)), 0, -1):
+        pairs = [(_normalize_line(a), _normalize_line(b)) for a, b in zip(previous[-count:], following[:count])]
+        if sum(len(a) for a, _ in pairs) < MERGE_MIN_CHARS:
+            continue
+        if all(SequenceMatcher(None, a, b, autojunk=False).ratio() >= MERGE_MIN_SIMILARITY for a, b in pairs):
+            return count
+    return 0
+
+def merge_transcripts(texts):
+    """
+    Join the transcripts of consecutive bands, dropping the repeated lines.
+
+    The lines at the start of each transcript that (nearly) repeat the last
+    lines of the previous one, as written twice across an overlap, are
+    removed. Comparison ignores case and punctuation and tolerates small
+    transcription differences.
+
+    Returns:
+        str: The transcript of the whole page
+    """
+    merged = []
+    for text in texts:
+        lines = text.strip().splitlines()
+        merged += lines[_overlap_lines(merged, lines):]
+    return '\n'.join(merged)
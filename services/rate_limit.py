@@ -0,0 +1,328 @@
+"""
+Shared scheduler in front of every OpenAI request.
+
+Requests-per-minute and tokens-per-minute budgets are enforced with two
+token buckets. The bucket levels live in a small SQLite file, so the
+Streamlit server and every background job worker (services.jobs) draw from
+the same budget. Inside a process, waiting calls are served round-robin per
+user: one user submitting a whole class can't starve the others. Calls that
+fail with 429 or 5xx are retried with jittered exponential backoff (or after
+the Retry-After the API asks for), paying for their budget again.
+
+Token costs are estimated before the call and settled against the usage the
+API reports, so the buckets track the real consumption.
+
+The user a call is queued under is taken from user_scope(), so the views
+only need to wrap their work once:
+
+    with rate_limit.user_scope(st.session_state.user.id):
+        text = ocr.extract_text(image_bytes, "OpenAI API")
+"""
+import contextvars
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from services import metrics
+
+DEFAULT_PATH = os.environ.get('RATE_LIMIT_DB_PATH', os.path.join('.cache', 'rate_limit.sqlite3'))
+# Budgets of the whole deployment; keep them a little under the account's quota
+DEFAULT_RPM = int(os.environ.get('OPENAI_RPM', '500'))
+DEFAULT_TPM = int(os.environ.get('OPENAI_TPM', '200000'))
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# Longest a waiter sleeps before checking the buckets again
+MAX_WAIT_SLICE_SECONDS = 1.0
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = ("APIConnectionError", "APITimeoutError")
+
+# Recent waits kept to report queueing delay
+WAIT_WINDOW = 256
+
+_current_user = contextvars.ContextVar("rate_limit_user", default=None)
+
+@contextmanager
+def user_scope(user):
+    """Queue the OpenAI calls made inside the block (and in tasks copying its context) under user"""
+    token = _current_user.set(None if user is None else str(user))
+    try:
+        yield
+    finally:
+        _current_user.reset(token)
+
+def current_user():
+    return _current_user.get()
+
+class BudgetStore:
+    """Token bucket levels kept in SQLite and shared by every process"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                level REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def _refilled(self, name, capacity, now):
+        row = self._conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        level, updated = row
+        return min(capacity, level + (now - updated) * capacity / 60.0)
+
+    def take(self, costs):
+        """
+        Take every cost from its bucket, or nothing if any bucket is short.
+
+        Args:
+            costs (dict): bucket name -> (amount, capacity per minute)
+
+        Returns:
+            float: 0 if the budget was taken, else the seconds until it should be available
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                levels = {name: self._refilled(name, capacity, now) for name, (_, capacity) in costs.items()}
+                wait = 0.0
+                for name, (amount, capacity) in costs.items():
+                    # Requests larger than a whole bucket go through once the bucket is full
+                    needed = min(amount, capacity)
+                    if levels[name] < needed:
+                        wait = max(wait, (needed - levels[name]) * 60.0 / capacity)
+                if wait == 0.0:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                        [(name, levels[name] - amount, now) for name, (amount, _) in costs.items()]
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def adjust(self, name, amount, capacity):
+        """Add amount (negative to charge more) to a bucket, e.g. to settle an estimate"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                level = min(capacity, self._refilled(name, capacity, now) + amount)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)", (name, level, now)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def levels(self, capacities):
+        now = time.time()
+        with self._lock:
+            return {name: self._refilled(name, capacity, now) for name, capacity in capacities.items()}
+
+class RateLimiter:
+    """
+    Token-bucket scheduler with per-user fair queuing and retries.
+
+        limiter = rate_limit.get_limiter()
+        response = limiter.call(lambda: client.chat.completions.create(...),
+                                user=user_id, tokens=1500, usage=lambda r: r.usage.total_tokens)
+    """
+
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, store=None, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS, sleep=time.sleep):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.store = store or BudgetStore()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self._cond = threading.Condition()
+        # user -> deque of tickets; the order of the keys is the round-robin order
+        self._queues = OrderedDict()
+        self._in_flight = 0
+        self._waits = deque(maxlen=WAIT_WINDOW)
+        self._retries = 0
+        self._throttled = 0
+
+    def _is_head(self, user, ticket):
+        return next(iter(self._queues)) == user and self._queues[user][0] is ticket
+
+    def _advance(self, user):
+        # The served user moves to the back of the rotation if it has more calls waiting
+        queue = self._queues.pop(user)
+        queue.popleft()
+        if queue:
+            self._queues[user] = queue
+
+    @contextmanager
+    def acquire(self, user=None, tokens=0):
+        """
+        Wait for this user's turn and for one request plus tokens of budget.
+
+        Args:
+            user: Key for fair queuing, e.g. the Supabase user id; defaults to user_scope's
+            tokens (int): Estimated tokens of the call
+        """
+        user = current_user() if user is None else str(user)
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._queues.setdefault(user, deque()).append(ticket)
+            try:
+                while True:
+                    if self._is_head(user, ticket):
+                        wait = self.store.take({"requests": (1, self.rpm), "tokens": (tokens, self.tpm)})
+                        if wait == 0.0:
+                            break
+                        self._throttled += 1
+                        self._cond.wait(min(wait, MAX_WAIT_SLICE_SECONDS))
+                    else:
+                        self._cond.wait(MAX_WAIT_SLICE_SECONDS)
+            except BaseException:
+                self._queues[user].remove(ticket)
+                if not self._queues[user]:
+                    del self._queues[user]
+                self._cond.notify_all()
+                raise
+            self._advance(user)
+            self._in_flight += 1
+            waited = time.monotonic() - start
+            self._waits.append(waited)
+            self._cond.notify_all()
+        metrics.observe("rate_limit", waited, outcome="throttled" if waited > 0.01 else "ok")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+
+    def settle(self, estimated, actual):
+        """Correct the tokens bucket once the real usage of a call is known"""
+        if actual is not None and actual != estimated:
+            self.store.adjust("tokens", estimated - actual, self.tpm)
+
+    def _backoff(self, attempt, error):
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Full jitter: spreads the retries of many sessions hitting the limit together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, fn, user=None, tokens=0, usage=None):
+        """
+        Run fn under the budget, retrying 429/5xx with jittered exponential backoff.
+
+        Args:
+            fn (callable): Makes the request
+            user: Key for fair queuing; defaults to user_scope's
+            tokens (int): Estimated tokens of the request
+            usage (callable): Returns the tokens really used from fn's result, or None
+
+        Returns:
+            Whatever fn returns
+        """
+        attempt = 0
+        while True:
+            with self.acquire(user, tokens):
+                try:
+                    result = fn()
+                except Exception as e:
+                    if not is_retryable(e) or attempt >= self.max_retries:
+                        raise
+                    error = e
+                else:
+                    if usage is not None:
+                        try:
+                            self.settle(tokens, usage(result))
+                        except Exception:
+                            pass
+                    return result
+            delay = self._backoff(attempt, error)
+            attempt += 1
+            with self._cond:
+                self._retries += 1
+            metrics.observe("rate_limit", delay, outcome="retry", status=getattr(error, "status_code", None))
+            self._sleep(delay)
+
+    def stats(self):
+        """
+        Return the current queue depth, waits and bucket levels of this process.
+
+        Returns:
+            dict: waiting, users_waiting, in_flight, wait_p50/wait_p95 (s), retries,
+                  throttled, requests_available, tokens_available
+        """
+        with self._cond:
+            waiting = sum(len(queue) for queue in self._queues.values())
+            users_waiting = len(self._queues)
+            in_flight = self._in_flight
+            waits = sorted(self._waits)
+            retries, throttled = self._retries, self._throttled
+        levels = self.store.levels({"requests": self.rpm, "tokens": self.tpm})
+        return {
+            "waiting": waiting,
+            "users_waiting": users_waiting,
+            "in_flight": in_flight,
+            "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "retries": retries,
+            "throttled": throttled,
+            "requests_available": levels["requests"],
+            "tokens_available": levels["tokens"],
+        }
+
+def is_retryable(error):
+    """Whether an OpenAI error is a rate limit, server error or connection problem"""
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def estimate_tokens(text):
+    """Rough token count of Portuguese text (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    """Return the process-wide limiter"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
@@ -1,10 +1,15 @@
 import streamlit as st
-from supabase import create_client
 
 def get_supabase_connection():
-    # Inicialização do cliente Supabase
-    supabase = create_client(
-        st.secrets["SUPABASE_URL"],
-        st.secrets["SUPABASE_KEY"]
-    )
-    return supabase
\ No newline at end of file
+    # The Supabase client holds the logged-in user's auth session, so it can't
+    # be shared across sessions; create it once per session instead of per rerun
+    if "supabase" not in st.session_state:
+        # Imported on first use to keep it out of the app's cold start
+        from supabase import create_client
+
+        # Inicialização do cliente Supabase
+        st.session_state.supabase = create_client(
+            st.secrets["SUPABASE_URL"],
+            st.secrets["SUPABASE_KEY"]
+        )
+    return st.session_state.supabase
@@ -0,0 +1,147 @@
+"""
+Local text extraction with the Tesseract OCR engine.
+
+Unlike the Vision and OpenAI backends this one needs no network or API key,
+so it works offline and costs nothing per essay. Tesseract is CPU-bound, so
+pages are recognized in a pool of worker processes. Each worker loads the
+Portuguese model once, when it starts, and reuses it for every page:
+
+- with tesserocr (bindings to the Tesseract library) the model stays loaded
+  in the worker between pages;
+- otherwise pytesseract runs the tesseract executable for each page, which
+  reloads the model every time but still runs one page per core.
+
+Daemonic processes, like the background job workers, can't start a pool;
+there the engine is loaded once in the process itself.
+
+The system packages tesseract-ocr and tesseract-ocr-por provide the engine
+and the Portuguese data (see packages.txt and the Dockerfile).
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+TESSERACT_LANG = os.environ.get('TESSERACT_LANG', 'por')
+TESSERACT_WORKERS = int(os.environ.get('TESSERACT_WORKERS', os.cpu_count() or 1))
+# Page segmentation mode 6: a single uniform block of text, as on an essay form
+TESSERACT_PSM = 6
+TIMEOUT_SECONDS = 120
+
+NO_TEXT_MESSAGE = "Nenhum texto manuscrito detectado na imagem."
+START_ERROR_MESSAGE = ("Falha ao iniciar o Tesseract. Verifique se o tesseract-ocr, os dados "
+                       f"'{TESSERACT_LANG}' e o pacote pytesseract (ou tesserocr) estão instalados.")
+
+# Engine of this worker process, loaded by _init_worker
+_engine = None
+
+def _init_worker(lang):
+    global _engine
+    # Imported now rather than on the worker's first page
+    import cv2  # noqa: F401
+
+    try:
+        import tesserocr
+    except ImportError:
+        import pytesseract
+        # Fails here, once per worker, if the executable is missing
+        pytesseract.get_tesseract_version()
+        _engine = ("pytesseract", pytesseract, lang)
+        return
+    api = tesserocr.PyTessBaseAPI(lang=lang, psm=tesserocr.PSM(TESSERACT_PSM))
+    _engine = ("tesserocr", api, lang)
+
+def _recognize(image_content):
+    # Runs in a worker process
+    import cv2
+    import numpy as np
+
+    gray = cv2.imdecode(np.frombuffer(image_content, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise Exception("Failed to decode image")
+    kind, engine, lang = _engine
+    if kind == "tesserocr":
+        height, width = gray.shape
+        engine.SetImageBytes(gray.tobytes(), width, height, 1, width)
+        return engine.GetUTF8Text()
+    return engine.image_to_string(gray, lang=lang, config=f"--psm {TESSERACT_PSM}")
+
+def _ping():
+    return os.getpid()
+
+def _create_pool():
+    # Spawned, not forked: the parent runs Streamlit and client threads
+    pool = ProcessPoolExecutor(TESSERACT_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(TESSERACT_LANG,))
+    # Submitted together, the pings start every worker (and load its model) now
+    # instead of on the first essays
+    for _ in range(TESSERACT_WORKERS):
+        pool.submit(_ping)
+    return pool
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide pool of Tesseract workers, starting it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _create_pool()
+        return _pool
+
+def shutdown():
+    """Stop the workers; the next call starts a new pool"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# Serializes the engine when it runs in this process: a tesserocr API
+# recognizes one page at a time
+_in_process_lock = threading.Lock()
+
+def _start_in_process():
+    with _in_process_lock:
+        if _engine is None:
+            _init_worker(TESSERACT_LANG)
+
+def process_image(image_content):
+    """
+    Extract text from an image with Tesseract, in the worker pool.
+
+    Args:
+        image_content (bytes): The image content in bytes
+
+    Returns:
+        str: Extracted text from the image
+    """
+    in_process = multiprocessing.current_process().daemon
+    if in_process:
+        try:
+            _start_in_process()
+        except Exception:
+            raise Exception(START_ERROR_MESSAGE)
+    try:
+        if in_process:
+            with _in_process_lock:
+                text = _recognize(image_content)
+        else:
+            future = get_pool().submit(_recognize, image_content)
+            text = future.result(timeout=TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        raise Exception(f"O Tesseract não terminou em {TIMEOUT_SECONDS}s.")
+    except BrokenProcessPool:
+        # A worker failed to start (no tesserocr/pytesseract, no executable or
+        # no language data): start a new pool on the next call
+        shutdown()
+        raise Exception(START_ERROR_MESSAGE)
+    except Exception as e:
+        raise Exception(f"Erro ao processar imagem com o Tesseract: {str(e)}")
+
+    # Tesseract keeps the line breaks of the page; drop its blank lines
+    text = '\n'.join(line.strip() for line in text.splitlines() if line.strip())
+    return text or NO_TEXT_MESSAGE
@@ -0,0 +1,92 @@
+import os
+import threading
+import streamlit as st
+from cachetools import TTLCache
+from services import metrics
+
+DEFAULT_CONFIG = {"text_extraction_api": "Vision API"}
+
+# Settings are cached per user for a few minutes and refreshed on save
+SETTINGS_CACHE_TTL_SECONDS = 300
+_settings_cache = TTLCache(maxsize=1024, ttl=SETTINGS_CACHE_TTL_SECONDS)
+_settings_lock = threading.Lock()
+
+def load_config(supabase, user_id):
+    """Load user-specific configuration from Supabase, served from the cache when fresh"""
+    with _settings_lock:
+        cached = _settings_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+
+    try:
+        # Development logging
+        if os.environ.get('STREAMLIT_ENV') == 'development':
+            st.write(f"[DEBUG] Attempting to load config for user_id: {user_id}")
+
+        # Use the public schema for Supabase tables
+        with metrics.timed("supabase", query="user_settings.select"):
+            response = supabase.table('user_settings').select('settings').eq('user_id', user_id).execute()
+
+        if os.environ.get('STREAMLIT_ENV') == 'development':
+            st.write(f"[DEBUG] Load response: {response}")
+
+        if response.data and len(response.data) > 0:
+            config = response.data[0]['settings']
+        else:
+            config = dict(DEFAULT_CONFIG)  # default configuration
+
+        with _settings_lock:
+            _settings_cache[user_id] = config
+        return dict(config)
+    except Exception as e:
+        st.error(f"Erro ao carregar configurações: {str(e)}")
+        if os.environ.get('STREAMLIT_ENV') == 'development':
+            st.write(f"[DEBUG] Detailed error while loading config: {type(e).__name__}: {str(e)}")
+        return dict(DEFAULT_CONFIG)
+
+def save_config(supabase, user_id, config):
+    """
+    Save user-specific configuration to Supabase with a single upsert.
+
+    Relies on a unique constraint on user_settings.user_id.
+    """
+    try:
+        if os.environ.get('STREAMLIT_ENV') == 'development':
+            st.write(f"[DEBUG] Attempting to save config for user_id: {user_id}")
+            st.write(f"[DEBUG] Config to save: {config}")
+
+        # Validate config data
+        if not isinstance(config, dict):
+            raise ValueError("Configuration must be a dictionary")
+
+        # Drop the cached copy first so a failed save can't leave it stale
+        invalidate(user_id)
+
+        # Insert or update the user's record in one round trip
+        with metrics.timed("supabase", query="user_settings.upsert"):
+            response = supabase.table('user_settings')\
+                .upsert({'user_id': user_id, 'settings': config}, on_conflict='user_id')\
+                .execute()
+
+        if os.environ.get('STREAMLIT_ENV') == 'development':
+            st.write(f"[DEBUG] Save response: {response}")
+
+        if response.data:
+            with _settings_lock:
+                _settings_cache[user_id] = dict(config)
+            return True
+        return False
+    except Exception as e:
+        detailed_error = f"{type(e).__name__}: {str(e)}"
+        st.error(f"Erro ao salvar configurações: {detailed_error}")
+        if os.environ.get('STREAMLIT_ENV') == 'development':
+            st.write(f"[DEBUG] Detailed error while saving config: {detailed_error}")
+        return False
+
+def invalidate(user_id=None):
+    """Forget the cached settings of one user, or of everyone"""
+    with _settings_lock:
+        if user_id is None:
+            _settings_cache.clear()
+        else:
+            _settings_cache.pop(user_id, None)
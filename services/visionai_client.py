@@ -1,90 +1,292 @@
 
 import streamlit as st 
-from google.cloud import vision
 import os
 import re
+from array import array
+from services import clients
+
+def _create_vision_client():
+    # google.cloud.vision (gRPC, protobuf) is only imported once a Vision call is made
+    from google.cloud import vision
+
+    # Local Deploy:
+    #os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = r'util/palavra-mestra.json'
+    # Streamlit Cloud Deploy:
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = st.secrets["visionapi"]['palavra-mestra']
+    return vision.ImageAnnotatorClient()
 
 def get_vision_client():
     """
-    Create and return an authenticated Vision API client
+    Return the shared authenticated Vision API client (created once per process)
     """
     try:
-        # Local Deploy:
-        #os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = r'util/palavra-mestra.json'
-        # Streamlit Cloud Deploy:
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = st.secrets["visionapi"]['palavra-mestra']
-        # Return authenticated client
-        return vision.ImageAnnotatorClient()
+        return clients.get_client("vision", _create_vision_client)
     except Exception as e:
         raise Exception(f"Falha ao inicializar o cliente Vision: {str(e)}")
     
-def process_image(image_content):
+class VisionDocument:
     """
-    Process the image using Google Cloud Vision API and extract text.
+    Compact result of one document_text_detection call.
+
+    Words, confidences and bounding boxes are stored in flat arrays instead
+    of the nested protobuf tree, so the plain text, the confidence report and
+    any later analysis all come from a single API call. Paragraph i holds
+    words[paragraph_starts[i]:paragraph_starts[i + 1]] and block j holds
+    paragraphs[block_starts[j]:block_starts[j + 1]].
+    """
+
+    __slots__ = (
+        "words", "word_confidences", "word_boxes",
+        "paragraph_starts", "paragraph_confidences",
+        "block_starts", "block_confidences", "block_pages",
+    )
+
+    def __init__(self):
+        self.words = []
+        self.word_confidences = array('f')
+        self.word_boxes = array('i')  # x0, y0, x1, y1 per word
+        self.paragraph_starts = array('I')
+        self.paragraph_confidences = array('f')
+        self.block_starts = array('I')
+        self.block_confidences = array('f')
+        self.block_pages = array('I')
+
+    @classmethod
+    def from_annotation(cls, annotation, page_offset=0):
+        """Build the compact document from a full_text_annotation, walking it once"""
+        doc = cls()
+        doc.extend(annotation, page_offset)
+        return doc
+
+    def extend(self, annotation, page_offset=0):
+        """Append the pages of another full_text_annotation"""
+        # Walk the raw protobuf message: proto-plus wrappers make every
+        # attribute access several times slower
+        if hasattr(type(annotation), 'pb'):
+            annotation = type(annotation).pb(annotation)
+        for page_index, page in enumerate(annotation.pages, start=page_offset):
+            for block in page.blocks:
+                self.block_starts.append(len(self.paragraph_confidences))
+                self.block_confidences.append(block.confidence)
+                self.block_pages.append(page_index)
+                for paragraph in block.paragraphs:
+                    self.paragraph_starts.append(len(self.words))
+                    self.paragraph_confidences.append(paragraph.confidence)
+                    for word in paragraph.words:
+                        self.words.append(''.join([symbol.text for symbol in word.symbols]))
+                        self.word_confidences.append(word.confidence)
+                        vertices = word.bounding_box.vertices
+                        if vertices:
+                            xs = [v.x for v in vertices]
+                            ys = [v.y for v in vertices]
+                            self.word_boxes.extend((min(xs), min(ys), max(xs), max(ys)))
+                        else:
+                            self.word_boxes.extend((0, 0, 0, 0))
+
+    def _paragraph_range(self, index):
+        end = self.paragraph_starts[index + 1] if index + 1 < len(self.paragraph_starts) else len(self.words)
+        return range(self.paragraph_starts[index], end)
+
+    def _block_range(self, index):
+        end = self.block_starts[index + 1] if index + 1 < len(self.block_starts) else len(self.paragraph_starts)
+        return range(self.block_starts[index], end)
+
+    def word_box(self, index):
+        """Return the (x0, y0, x1, y1) bounding box of a word"""
+        return tuple(self.word_boxes[4 * index:4 * index + 4])
+
+    def paragraphs(self):
+        """Return the words of each paragraph, in reading order"""
+        return [[self.words[i] for i in self._paragraph_range(p)] for p in range(len(self.paragraph_starts))]
+
+    def text(self):
+        """Return the plain text, one cleaned line per paragraph"""
+        # Every paragraph is kept; word_confidences allows filtering by confidence
+        paragraphs = [
+            # Clean the formatting of each paragraph separately
+            clean_text_formatting(' '.join(words))
+            for words in self.paragraphs() if words
+        ]
+
+        if not paragraphs:
+            return "No handwritten text detected in the image."
+
+        # Join paragraphs with newlines to create clear separation
+        return '\n'.join(paragraphs)
+
+    def confidence_markdown(self):
+        """Return the block/paragraph/word confidence report"""
+        parts = []
+        for b in range(len(self.block_starts)):
+            parts.append(f"\n\nBlock confidence: {self.block_confidences[b]}\n")
+            parts.append("\n")
+            for p in self._block_range(b):
+                parts.append(f"Paragraph confidence: {self.paragraph_confidences[p]}\n")
+                parts.append("\n")
+                for w in self._paragraph_range(p):
+                    parts.append(f"Word text: {self.words[w]} (confidence: {self.word_confidences[w]})\n")
+                    parts.append("\n")
+                parts.append('\n')
+        return ''.join(parts)
+
+def _check_response(response):
+    if response.error.message:
+        raise Exception(
+            f'{response.error.message}\nFor more info on error messages, check: '
+            'https://cloud.google.com/apis/design/errors')
+
+def extract_document(image_content):
+    """
+    Run document text detection once and return the compact structured result.
 
     Args:
         image_content (bytes): The image content in bytes
 
     Returns:
-        str: Extracted text from the image
+        VisionDocument: Words, confidences and bounding boxes of the image
     """
-    try:
-        # Get authenticated client
-        client = get_vision_client()
+    from google.cloud import vision
 
-        # Create image object
-        image = vision.Image(content=image_content)
+    # Get authenticated client
+    client = get_vision_client()
 
-        # Configure image context with language hints
-        image_context = vision.ImageContext(
-            language_hints=['pt-BR']  # Set Portuguese (Brazil) as primary language
-        )
+    # Create image object
+    image = vision.Image(content=image_content)
+
+    # Configure image context with language hints
+    image_context = vision.ImageContext(
+        language_hints=['pt-BR']  # Set Portuguese (Brazil) as primary language
+    )
+
+    # Perform handwritten text detection with language hints
+    response = client.document_text_detection(
+        image=image,
+        image_context=image_context
+    )
+    _check_response(response)
+
+    # Get full text annotations
+    return VisionDocument.from_annotation(response.full_text_annotation)
+
+# Limits of a single images:annotate request. Content is sent base64
+# encoded, so the request size is about 4/3 of the raw image bytes.
+MAX_IMAGES_PER_REQUEST = 16
+MAX_REQUEST_BYTES = 10 * 1024 * 1024
+
+def request_size(image_content):
+    """Return the approximate size an image adds to an annotate request"""
+    return (len(image_content) + 2) // 3 * 4
+
+def annotate_batch(pages_content, client=None):
+    """
+    Run document text detection on several images in one batch_annotate_images call.
+
+    The caller must keep the batch within MAX_IMAGES_PER_REQUEST and
+    MAX_REQUEST_BYTES (see request_size).
 
-        # Perform handwritten text detection with language hints
-        response = client.document_text_detection(
-            image=image,
+    Args:
+        pages_content (list): Image bytes of each page, in order
+        client: Annotator client; defaults to the shared Vision client
+
+    Returns:
+        list: One VisionDocument per page, in the same order
+    """
+    from google.cloud import vision
+
+    client = client or get_vision_client()
+    image_context = vision.ImageContext(language_hints=['pt-BR'])
+    feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+    requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(content=content),
+            features=[feature],
             image_context=image_context
         )
-        # Get full text annotations
-        document = response.full_text_annotation
+        for content in pages_content
+    ]
+    response = client.batch_annotate_images(requests=requests)
 
-        if response.error.message:
-            raise Exception(
-                f'{response.error.message}\nFor more info on error messages, check: '
-                'https://cloud.google.com/apis/design/errors')
+    documents = []
+    for page_response in response.responses:
+        _check_response(page_response)
+        documents.append(VisionDocument.from_annotation(page_response.full_text_annotation))
+    return documents
 
-        # Extract only handwritten text based on confidence scores
-        paragraphs = []
+def _annotation_from_text(text):
+    from google.cloud import vision
 
-        for page in document.pages:
-            for block in page.blocks:
-                # Handwritten text typically has lower confidence scores
-                # We'll consider text with confidence < 0.5 as handwritten
-                # since printed text usually has very high confidence (>0.9)
-                #if block.confidence < 0.98:
-                    # Process each paragraph separately
-                for paragraph in block.paragraphs:
-                    paragraph_text = []
-                    for word in paragraph.words:
-                        word_text = ''.join([
-                            symbol.text for symbol in word.symbols
-                        ])
-                        paragraph_text.append(word_text)
+    # One block per line, one paragraph per block
+    blocks = []
+    for line in text.splitlines():
+        words = [
+            vision.Word(confidence=0.9, symbols=[vision.Symbol(text=char, confidence=0.9) for char in word])
+            for word in line.split()
+        ]
+        if words:
+            blocks.append(vision.Block(confidence=0.9, paragraphs=[vision.Paragraph(confidence=0.9, words=words)]))
+    return vision.TextAnnotation(pages=[vision.Page(blocks=blocks)], text=text)
 
-                    if paragraph_text:
-                        # Clean the formatting of each paragraph separately
-                        clean_paragraph = clean_text_formatting(' '.join(paragraph_text))
-                        paragraphs.append(clean_paragraph)
+class StubAnnotatorClient:
+    """
+    Offline stand-in for vision.ImageAnnotatorClient.
 
-        if not paragraphs:
-            return "No handwritten text detected in the image."
+    Answers document_text_detection and batch_annotate_images with the text
+    returned by text_for(image_content), one paragraph per line, and records
+    every batch it receives in self.batches.
+    """
 
-        # Join paragraphs with double newlines to create clear separation
-        return '\n'.join(paragraphs)
+    def __init__(self, text_for=None):
+        self.text_for = text_for or (lambda content: f"Texto de uma página com {len(content)} bytes")
+        self.batches = []
+
+    def _annotate(self, content):
+        from google.cloud import vision
+
+        return vision.AnnotateImageResponse(full_text_annotation=_annotation_from_text(self.text_for(content)))
+
+    def document_text_detection(self, image, image_context=None):
+        return self._annotate(image.content)
+
+    def batch_annotate_images(self, requests):
+        requests = list(requests)
+        if len(requests) > MAX_IMAGES_PER_REQUEST:
+            raise Exception(f"Too many images in request: {len(requests)}")
+        if sum(request_size(request.image.content) for request in requests) > MAX_REQUEST_BYTES:
+            raise Exception("Request payload size exceeds the limit")
+        self.batches.append([request.image.content for request in requests])
+        from google.cloud import vision
+
+        return vision.BatchAnnotateImagesResponse(
+            responses=[self._annotate(request.image.content) for request in requests]
+        )
 
+def process_image(image_content):
+    """
+    Process the image using Google Cloud Vision API and extract text.
+
+    Args:
+        image_content (bytes): The image content in bytes
+
+    Returns:
+        str: Extracted text from the image
+    """
+    try:
+        return extract_document(image_content).text()
     except Exception as e:
         raise Exception(f"Error processing image: {str(e)}")
 
+def document_to_text(document):
+    """
+    Walk a Vision full_text_annotation and join its paragraphs into plain text.
+
+    Args:
+        document: The full_text_annotation of a document_text_detection response
+
+    Returns:
+        str: One cleaned line per paragraph
+    """
+    return VisionDocument.from_annotation(document).text()
+
 def clean_text_formatting(text):
     """
     Clean the text formatting by removing spaces before punctuation
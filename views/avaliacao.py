@@ -1,6 +1,8 @@
 import streamlit as st
 import os
 import services.openai_client as openai_client
+import services.jobs as jobs
+import services.evaluation_cache as evaluation_cache
 
 if 'logged_in' not in st.session_state or not st.session_state.logged_in:
     st.warning("Por favor, faça login para acessar o aplicativo.")
@@ -39,22 +41,69 @@ essay_text = st.text_area(
     height=300,
     placeholder="Cole sua redação aqui..."
 )
+background = st.toggle(
+    "Avaliar em segundo plano",
+    help="A avaliação continua mesmo se você sair da página; o resultado aparece em 'Avaliações em segundo plano'"
+)
+force = st.checkbox(
+    "Reavaliar mesmo que a redação já tenha sido avaliada",
+    help="Por padrão, uma redação idêntica ou quase idêntica a uma já avaliada recebe a avaliação anterior"
+)
 # Evaluation button
 if st.button("Avaliar Redação", type="primary", disabled=not essay_text):
     if not essay_text:
         st.error("Por favor, insira uma redação para avaliar.")
+    elif background:
+        label = " ".join(essay_text.split())[:60]
+        jobs.submit_evaluation(essay_text, user_id=st.session_state.user.id, label=label, force=force)
+        st.success("Avaliação enviada para a fila.")
     else:
         try:
-            with st.spinner("Analisando sua redação... Por favor, aguarde."):
-                evaluation = openai_client.evaluate_essay(essay_text)
+            cache = evaluation_cache.get_cache()
+            match = None if force else cache.lookup(essay_text, user=st.session_state.user.id)
             st.info("Resultado da Avaliação")
-            st.markdown('<div class="evaluation-result">', unsafe_allow_html=True)
-            st.markdown(evaluation)
-            st.markdown('</div>', unsafe_allow_html=True)
+            if match and match["reuse"]:
+                st.caption("Avaliação reaproveitada de uma redação "
+                           + ("idêntica." if match["exact"] else f"quase idêntica ({match['similarity']:.0%} de similaridade).")
+                           + " Marque 'Reavaliar' para uma nova avaliação.")
+                st.markdown('<div class="evaluation-result">', unsafe_allow_html=True)
+                st.markdown(match["evaluation"])
+                st.markdown('</div>', unsafe_allow_html=True)
+            else:
+                if match:
+                    st.warning(f"Esta redação é muito parecida ({match['similarity']:.0%} de similaridade) "
+                               "com uma redação já avaliada.")
+                st.markdown('<div class="evaluation-result">', unsafe_allow_html=True)
+                # Render the evaluation as the assistant writes it
+                evaluation = st.write_stream(
+                    openai_client.evaluate_essay_stream(essay_text, user=st.session_state.user.id)
+                )
+                st.markdown('</div>', unsafe_allow_html=True)
+                cache.put(essay_text, evaluation, user=st.session_state.user.id)
 
         except Exception as e:
             st.error(f"Ocorreu um erro: {str(e)}")
             if "api_key" in str(e).lower():
                 st.warning("Por favor, verifique se sua chave de API da OpenAI está configurada corretamente.")
             elif "assistant" in str(e).lower():
-                st.warning("Por favor, verifique se o ID do assistente OpenAI está configurado corretamente.")
\ No newline at end of file
+                st.warning("Por favor, verifique se o ID do assistente OpenAI está configurado corretamente.")
+
+JOB_STATUS_LABELS = {"queued": "⏳ Na fila", "running": "⚙️ Avaliando", "done": "✅ Concluída", "error": "❌ Erro"}
+
+@st.fragment(run_every=3)
+def show_background_jobs():
+    # Reruns on its own every few seconds, without rerunning the whole page
+    recent = [job for job in jobs.get_queue().list(user_id=st.session_state.user.id) if job["kind"] == "evaluate"]
+    if not recent:
+        return
+    st.subheader("Avaliações em segundo plano")
+    if not jobs.get_queue().active_workers():
+        st.warning("Nenhum processador de fila ativo. Inicie-o com: python -m services.jobs")
+    for job in recent:
+        with st.expander(f"{JOB_STATUS_LABELS[job['status']]} — {job['label']}"):
+            if job["status"] == "error":
+                st.error(job["error"])
+            elif job["status"] == "done":
+                st.markdown(job["result"])
+
+show_background_jobs()
@@ -1,4 +1,31 @@
 import streamlit as st
+import services.metrics as metrics
+import services.rate_limit as rate_limit
 
 st.title('Dashboard')
-st.write('Bem vindo!')
\ No newline at end of file
+st.write('Bem vindo!')
+
+if st.session_state.get("role") == "admin":
+    with st.expander("📈 Desempenho"):
+        # With METRICS_FILE set, the job workers' measurements are included too
+        rows = metrics.summary(metrics.METRICS_FILE)
+        if rows:
+            st.dataframe(
+                [{**row, "outcomes": ", ".join(f"{k}: {v}" for k, v in row["outcomes"].items())} for row in rows],
+                use_container_width=True
+            )
+        else:
+            st.write("Nenhuma medição registrada ainda.")
+        limiter = rate_limit.get_limiter().stats()
+        st.caption(
+            f"Fila da OpenAI neste processo: {limiter['waiting']} chamada(s) de {limiter['users_waiting']} "
+            f"usuário(s) aguardando, {limiter['in_flight']} em andamento, espera p95 de "
+            f"{limiter['wait_p95']:.1f}s, {limiter['retries']} nova(s) tentativa(s). Orçamento disponível: "
+            f"{limiter['requests_available']:.0f} requisições e {limiter['tokens_available']:.0f} tokens."
+        )
+        st.download_button(
+            label="Baixar métricas (Prometheus)",
+            data=metrics.render_prometheus(metrics.METRICS_FILE),
+            file_name="metrics.prom",
+            mime="text/plain"
+        )
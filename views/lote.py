@@ -0,0 +1,104 @@
+import streamlit as st
+import services.batch as batch
+import services.ocr as ocr
+import services.rate_limit as rate_limit
+
+if 'logged_in' not in st.session_state or not st.session_state.logged_in:
+    st.warning("Por favor, faça login para acessar o aplicativo.")
+    st.stop()
+
+st.title("📚 Correção em Lote")
+st.markdown("""
+Envie as redações de uma turma inteira de uma só vez, em um arquivo ZIP ou selecionando várias imagens.
+""")
+
+with st.expander("ℹ️ Como usar"):
+    st.markdown("""
+    1. Envie um arquivo ZIP com as imagens das redações ou selecione várias imagens
+    2. Escolha a API de extração e o número de processamentos simultâneos
+    3. Clique no botão 'Processar Lote'
+    4. Acompanhe os resultados à medida que cada redação é concluída
+    5. Baixe o arquivo ZIP ou CSV com as transcrições e avaliações
+
+    Formatos de imagem suportados: PNG, JPG, JPEG
+    """)
+
+col1, col2 = st.columns(2)
+with col1:
+    api_option = st.selectbox(
+        "Selecionar API para extração de texto",
+        options=ocr.API_OPTIONS,
+        help="Escolha qual API será utilizada para extrair texto das imagens"
+    )
+    workers = st.slider("Processamentos simultâneos", min_value=1, max_value=16, value=batch.DEFAULT_WORKERS)
+with col2:
+    preprocessing = st.selectbox(
+        "Pré-processamento",
+        options=["Automático", "Padrão", "Nenhum"],
+        help="Automático: escolhido para cada imagem pela nitidez, contraste, ruído e espessura do traço. "
+             "Padrão: escala de cinza, binarização e redução de ruído"
+    )
+    use_crop = st.checkbox("Recortar área da redação", value=False,
+                           help="Envia apenas a área com as linhas da redação, sem cabeçalho e margens")
+    evaluate = st.checkbox("Avaliar redações", value=True)
+
+uploaded_files = st.file_uploader(
+    "Escolha o arquivo ZIP ou as imagens",
+    type=["zip", "png", "jpg", "jpeg"],
+    accept_multiple_files=True,
+)
+
+def _uploaded_images(files):
+    for uploaded in files:
+        if uploaded.name.lower().endswith('.zip'):
+            yield from batch.iter_images(uploaded)
+        else:
+            yield uploaded.name, uploaded.getvalue()
+
+if uploaded_files and st.button("Processar Lote", type="primary"):
+    results = []
+    progress = st.progress(0.0, text="Processando redações...")
+    total = sum(batch.count_images(f) if f.name.lower().endswith('.zip') else 1 for f in uploaded_files)
+
+    # OpenAI requests of the whole batch share this user's turn in the rate limiter
+    with rate_limit.user_scope(st.session_state.user.id):
+        for index, result in enumerate(batch.run_batch(
+            _uploaded_images(uploaded_files),
+            api_option,
+            preprocess_options={
+                "Automático": {"auto": True, "use_crop": use_crop},
+                "Padrão": {**batch.DEFAULT_PREPROCESS_OPTIONS, "use_crop": use_crop},
+                "Nenhum": None,
+            }[preprocessing],
+            evaluate=evaluate,
+            workers=workers,
+        )):
+            results.append(result)
+            progress.progress(len(results) / max(total, 1), text=f"{len(results)} de {total} redações concluídas")
+            icon = "❌" if result["erro"] else "✅"
+            with st.expander(f"{icon} {result['arquivo']}"):
+                if result["erro"]:
+                    st.error(result["erro"])
+                st.text_area("Texto Extraído", result["texto"], height=200, key=f"texto_{index}")
+                if result["avaliacao"]:
+                    st.markdown(result["avaliacao"])
+
+    st.session_state.batch_results = results
+
+if st.session_state.get("batch_results"):
+    results = st.session_state.batch_results
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button(
+            label="Baixar resultados (ZIP)",
+            data=batch.results_to_zip(results),
+            file_name="resultados.zip",
+            mime="application/zip"
+        )
+    with col2:
+        st.download_button(
+            label="Baixar planilha (CSV)",
+            data=batch.results_to_csv(results),
+            file_name="resultados.csv",
+            mime="text/csv"
+        )
@@ -1,9 +1,13 @@
 import streamlit as st
-import io
-from PIL import Image
 import services.image_preprocess as image_preprocess
-import services.visionai_client as visionai_client
-import services.openai_client as openai_client
+import services.image_quality as image_quality
+import services.ocr as ocr
+import services.ocr_cache as ocr_cache
+import services.multipage as multipage
+import services.jobs as jobs
+import services.rate_limit as rate_limit
+import services.supabase_client as supabase_client
+import services.user_settings as user_settings
 
 if 'logged_in' not in st.session_state or not st.session_state.logged_in:
     st.warning("Por favor, faça login para acessar o aplicativo.")
@@ -12,17 +16,24 @@ if 'logged_in' not in st.session_state or not st.session_state.logged_in:
 st.title("✍️ Extração de Texto Manuscrito")
 st.markdown("""
 Faça o upload de uma imagem de uma redação contendo texto manuscrito para transcreve-lo em texto digital.
+Redações com mais de uma página podem ser enviadas em várias imagens ou em um PDF.
 """)
-# supabase = supabase_client.get_supabase_connection()
-# user_id = st.session_state.user.id
-# ia_selected = settings.load_config(supabase, user_id)["text_extraction_api"]
+# Default API from the user's settings (cached per user, so cheap on every rerun)
+supabase = supabase_client.get_supabase_connection()
+user_id = st.session_state.user.id
+ia_selected = user_settings.load_config(supabase, user_id).get("text_extraction_api")
 # API Selection
 api_option = st.selectbox(
     "Selecionar API para extração de texto",
-    options=["Vision API", "OpenAI API"],
+    options=ocr.API_OPTIONS,
+    index=ocr.API_OPTIONS.index(ia_selected) if ia_selected in ocr.API_OPTIONS else 0,
     help="Escolha qual API será utilizada para extrair texto das imagens"
 )
 st.info(f"AI selecionada: **{api_option}**")
+background = st.toggle(
+    "Processar em segundo plano",
+    help="A extração continua mesmo se você sair da página; o resultado aparece em 'Extrações em segundo plano'"
+)
 
 # Add usage instructions
 with st.expander("ℹ️ Como usar"):
@@ -34,30 +45,50 @@ with st.expander("ℹ️ Como usar"):
     5. Visualize o texto extraído
     6. Se desejar, clique no botão 'Baixar texto extraído'
                 
-    Formatos de imagem suportados: PNG, JPG, JPEG
+    Formatos suportados: PNG, JPG, JPEG e PDF (várias páginas)
     """)
 
 # Add image preprocessing options
 st.subheader("Opções de Pré-processamento")
+auto_mode = st.radio(
+    "Modo",
+    ("Automático", "Manual"),
+    horizontal=True,
+    help="No modo automático os filtros são escolhidos pela nitidez, contraste, ruído e espessura do traço da imagem"
+) == "Automático"
+use_crop = st.checkbox(
+    "Recortar área da redação", value=False,
+    help="Endireita a imagem e mantém apenas a área com as linhas da redação, sem cabeçalho, código de barras "
+         "e margens. Imagens sem linhas são mantidas inteiras"
+)
 
 col1, col2 = st.columns(2)
 
 with col1:
-    use_grayscale = st.checkbox("Aplicar escala de cinza", value=True)
-    use_threshold = st.checkbox("Aplicar binarização", value=True,
+    use_grayscale = st.checkbox("Aplicar escala de cinza", value=True, disabled=auto_mode)
+    use_threshold = st.checkbox("Aplicar binarização", value=True, disabled=auto_mode,
                                 help="Para esse filtro funcionar, é obrigatório aplicar a escala de cinza")
-    use_denoising = st.checkbox("Aplicar redução de ruído", value=True)
+    use_denoising = st.checkbox("Aplicar redução de ruído", value=True, disabled=auto_mode)
 
 with col2:
-    use_contrast = st.checkbox("Aumentar contraste (CLAHE)", value=False)
-    use_morphological = st.checkbox("Aplicar dilatação e erosão", value=False,
+    use_contrast = st.checkbox("Aumentar contraste (CLAHE)", value=False, disabled=auto_mode)
+    use_morphological = st.checkbox("Aplicar dilatação e erosão", value=False, disabled=auto_mode,
                                     help="Ajuda a reforçar os contornos das letras")
+    denoise_method = st.selectbox(
+        "Método de redução de ruído",
+        options=image_preprocess.DENOISE_METHODS,
+        format_func=lambda method: {"fast": "Rápido (mediana/bilateral)", "nlmeans": "Alta qualidade (lento)"}[method],
+        disabled=auto_mode or not use_denoising,
+        help="O método rápido é indicado para imagens grandes e binarizadas"
+    )
 
 # File uploader
-uploaded_file = st.file_uploader(
-    "Escolha um arquivo de imagem", 
-    type=["png", "jpg", "jpeg"],
-    help="Selecione uma imagem da redação manuscrita para extração do texto."
+uploaded_files = st.file_uploader(
+    "Escolha os arquivos da redação",
+    type=["png", "jpg", "jpeg", "pdf"],
+    accept_multiple_files=True,
+    help="Selecione uma imagem da redação manuscrita para extração do texto, "
+         "ou várias imagens / um PDF para redações com mais de uma página."
 )
 st.html(
         """
@@ -81,32 +112,118 @@ st.html(
         """
     )
 
-if uploaded_file is not None:
+def show_extracted_text(extracted_text):
+    # Display results
+    st.text_area("Texto Extraído", extracted_text, height=800)
+    cache_stats = ocr_cache.get_cache().stats()
+    st.caption(f"Cache de extração: {cache_stats['hits']} acertos, {cache_stats['misses']} falhas")
+
+    # Add download button for extracted text
+    st.download_button(
+        label="Baixar texto extraído",
+        data=extracted_text,
+        file_name="texto_extraido.txt",
+        mime="text/plain"
+    )
+
+def show_array(img):
+    st.image(img, channels="BGR" if img.ndim == 3 else "RGB", use_container_width=True)
+
+def show_auto_options(options, quality):
+    filters = [label for flag, label in (
+        ("use_crop", "recorte da área da redação"),
+        ("use_grayscale", "escala de cinza"),
+        ("use_threshold", "binarização"),
+        ("use_denoising", "redução de ruído"),
+        ("use_contrast_enhancement", "contraste (CLAHE)"),
+        ("use_morphological", "dilatação e erosão"),
+    ) if options[flag]]
+    if options["use_threshold"]:
+        filters[filters.index("binarização")] += (f" (bloco {options['threshold_block_size']}, "
+                                                  f"c {options['threshold_c']})")
+    st.info(f"Pré-processamento automático: {', '.join(filters)}")
+    st.caption(f"Nitidez {quality['sharpness']:.0f} · contraste {quality['contrast']:.0f} · "
+               f"ruído {quality['noise_sigma']:.1f} · traço {quality['stroke_width']:.1f}px")
+
+preprocess_options = {"auto": True, "use_crop": use_crop} if auto_mode else {
+    "use_crop": use_crop,
+    "use_grayscale": use_grayscale,
+    "use_threshold": use_threshold,
+    "use_denoising": use_denoising,
+    "use_contrast_enhancement": use_contrast,
+    "use_morphological": use_morphological,
+    "denoise_method": denoise_method,
+}
+
+single_image = len(uploaded_files) == 1 and not uploaded_files[0].name.lower().endswith('.pdf')
+
+if uploaded_files and not single_image:
     try:
-        # Get the original image
+        st.subheader("Redação com várias páginas")
+        st.write(f"{len(uploaded_files)} arquivo(s) selecionado(s), processados na ordem em que foram enviados.")
+        use_preprocessed = st.radio(
+            "Selecione as imagens para extrair o texto:",
+            ("Imagens Pré-processadas", "Imagens Originais")
+        ) == "Imagens Pré-processadas"
+
+        if st.button("Extrair Texto"):
+            if background:
+                jobs.submit_extraction(
+                    [(f.name, f.getvalue()) for f in uploaded_files], api_option,
+                    preprocess_options=preprocess_options if use_preprocessed else None,
+                    user_id=user_id, label=f"{uploaded_files[0].name} (+{len(uploaded_files) - 1} arquivo(s))"
+                )
+                st.success("Extração enviada para a fila.")
+            else:
+                with st.spinner('Processando páginas...'), rate_limit.user_scope(user_id):
+                    pages = list(multipage.iter_pages((f.name, f.getvalue()) for f in uploaded_files))
+                    extracted_text = multipage.extract_text(
+                        pages, api_option, preprocess_options=preprocess_options if use_preprocessed else None
+                    )
+                st.caption(f"{len(pages)} página(s) processada(s)")
+                show_extracted_text(extracted_text)
+
+    except Exception as e:
+        st.error(f"Erro ao processar as páginas: {str(e)}")
+        st.error("Certifique-se que você tenha selecionado imagens ou um PDF válidos.")
+
+elif uploaded_files:
+    uploaded_file = uploaded_files[0]
+    try:
+        # Intermediate results are kept per session as arrays, so the upload
+        # is decoded once and toggling a filter only recomputes the steps after it
+        if 'preprocess_cache' not in st.session_state:
+            st.session_state.preprocess_cache = image_preprocess.PreprocessCache()
+        preprocess_cache = st.session_state.preprocess_cache
         image_bytes = uploaded_file.getvalue()
-        original_image = Image.open(uploaded_file)
-
-        # Get the preprocessed image with selected filters
-        processed_bytes = image_preprocess.preprocess_image(
-            image_bytes,
-            use_grayscale=use_grayscale,
-            use_threshold=use_threshold,
-            use_denoising=use_denoising,
-            use_contrast_enhancement=use_contrast,
-            use_morphological=use_morphological
+        image_key = image_preprocess.image_hash(image_bytes)
+        original_image = image_preprocess.decode_image(image_bytes, preprocess_cache, image_key)
+
+        if auto_mode:
+            # Measured once per uploaded file, not on every rerun
+            if st.session_state.get('auto_preprocess', (None,))[0] != uploaded_file.file_id:
+                st.session_state.auto_preprocess = (uploaded_file.file_id,) + image_quality.auto_options(original_image)
+            _, auto_options, quality = st.session_state.auto_preprocess
+            preprocess_options = {**auto_options, "use_crop": use_crop}
+            show_auto_options(preprocess_options, quality)
+
+        # Preview the selected filters on a low-resolution copy, so toggling
+        # them redraws at once; the full-resolution pass runs on extraction
+        original_preview, processed_preview = image_preprocess.preprocess_preview(
+            original_image, cache=preprocess_cache, key=image_key, **preprocess_options
         )
-        processed_image = Image.open(io.BytesIO(processed_bytes))
 
         # Display both images side by side
         st.subheader("Comparação de Imagens")
         col1, col2 = st.columns(2)
         with col1:
             st.write("Imagem Original:")
-            st.image(original_image, use_container_width=True)
+            show_array(original_preview)
         with col2:
             st.write("Imagem Pré-processada:")
-            st.image(processed_image, use_container_width=True)
+            show_array(processed_preview)
+        st.caption("Pré-visualização em resolução reduzida; a imagem é processada em resolução completa "
+                   "ao extrair o texto.")
 
         # Add option to choose which image to process
         image_choice = st.radio(
@@ -116,27 +233,51 @@ if uploaded_file is not None:
 
         # Add process button
         if st.button("Extrair Texto"):
-            with st.spinner('Processando imagem...'):
-                # Select which image to process
-                img_to_process = image_bytes if image_choice == "Imagem Original" else processed_bytes
-
-                # Process the image using selected API
-                if api_option == 'Vision API':
-                    extracted_text = visionai_client.process_image(img_to_process)
-                else:  # Default to OpenAI API
-                    extracted_text = openai_client.process_image(img_to_process)
-
-            # Display results
-            st.text_area("Texto Extraído", extracted_text, height=800)
-
-            # Add download button for extracted text
-            st.download_button(
-                label="Baixar texto extraído",
-                data=extracted_text,
-                file_name="texto_extraido.txt",
-                mime="text/plain"
-            )
+            # Select which image to process
+            options_used = None if image_choice == "Imagem Original" else preprocess_options
+
+            if background:
+                # The worker preprocesses the original again, with the same options
+                jobs.submit_extraction([(uploaded_file.name, image_bytes)], api_option,
+                                       preprocess_options=options_used, user_id=user_id,
+                                       label=uploaded_file.name)
+                st.success("Extração enviada para a fila.")
+            else:
+                with st.spinner('Processando imagem...'), rate_limit.user_scope(user_id):
+                    img_to_process = image_bytes
+                    if options_used is not None:
+                        # The full-resolution pass; the preview only ran on a reduced copy
+                        img_to_process = image_preprocess.preprocess_array(
+                            original_image, **options_used, cache=preprocess_cache, key=image_key
+                        )
+                    # Process the image using selected API (cached by original image, filters and API)
+                    cache_key = ocr_cache.make_key(image_bytes, options_used, api_option)
+                    extracted_text = ocr.extract_text(img_to_process, api_option, cache_key=cache_key)
+
+                show_extracted_text(extracted_text)
 
     except Exception as e:
         st.error(f"Erro ao processar a imagem: {str(e)}")
-        st.error("Certifique-se que você tenha selecionado uma imagem válida.")
\ No newline at end of file
+        st.error("Certifique-se que você tenha selecionado uma imagem válida.")
+
+JOB_STATUS_LABELS = {"queued": "⏳ Na fila", "running": "⚙️ Processando", "done": "✅ Concluída", "error": "❌ Erro"}
+
+@st.fragment(run_every=3)
+def show_background_jobs():
+    # Reruns on its own every few seconds, without rerunning the whole page
+    recent = [job for job in jobs.get_queue().list(user_id=user_id) if job["kind"] == "extract"]
+    if not recent:
+        return
+    st.subheader("Extrações em segundo plano")
+    if not jobs.get_queue().active_workers():
+        st.warning("Nenhum processador de fila ativo. Inicie-o com: python -m services.jobs")
+    for job in recent:
+        with st.expander(f"{JOB_STATUS_LABELS[job['status']]} — {job['label']} ({job['payload']['api_option']})"):
+            if job["status"] == "error":
+                st.error(job["error"])
+            elif job["status"] == "done":
+                st.text_area("Texto Extraído", job["result"], height=400, key=f"job_{job['id']}")
+                st.download_button("Baixar texto extraído", data=job["result"], file_name="texto_extraido.txt",
+                                   mime="text/plain", key=f"download_{job['id']}")
+
+show_background_jobs()
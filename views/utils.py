@@ -5,6 +5,7 @@ from google.cloud import vision
 import re
 import cv2
 import numpy as np
+import services.visionai_client as visionai_client
 
 def get_vision_client():
     """
@@ -166,51 +167,16 @@ def clean_text_formatting(text):
     text = ' '.join(text.split())
     return text
 
-def exibir_texto(image_content):
-    markdown = ""
-    try:
-        # Get authenticated client
-        client = get_vision_client()
-
-        # Create image object
-        image = vision.Image(content=image_content)
-
-        # Configure image context with language hints
-        image_context = vision.ImageContext(
-            language_hints=['pt-BR']  # Set Portuguese (Brazil) as primary language
-        )
-
-        # Perform handwritten text detection with language hints
-        response = client.document_text_detection(
-            image=image,
-            image_context=image_context
-        )
-        # Get full text annotations
-        document = response.full_text_annotation
-
-        if response.error.message:
-            raise Exception(
-                f'{response.error.message}\nFor more info on error messages, check: '
-                'https://cloud.google.com/apis/design/errors')
-        
-        for page in document.pages:
-            for block in page.blocks:
-                markdown += f"\n\nBlock confidence: {block.confidence}\n"
-                markdown += "\n"
-
-                for paragraph in block.paragraphs:
-                    markdown += f"Paragraph confidence: {paragraph.confidence}\n"
-                    markdown += "\n"
-
-                    for word in paragraph.words:
-                        word_text = "".join([symbol.text for symbol in word.symbols])
-                        markdown += f"Word text: {word_text} (confidence: {word.confidence})\n"
-                        markdown += "\n"
-
-                        # for symbol in word.symbols:
-                        #     markdown += f"\tSymbol: {symbol.text} (confidence: {symbol.confidence})\n"
-                    markdown += '\n'
+def exibir_texto(image_content=None, document=None):
+    """
+    Build the block/paragraph/word confidence report of an image.
 
-        return markdown
+    Pass the VisionDocument from visionai_client.extract_document to reuse
+    the text extraction call instead of querying Vision again.
+    """
+    try:
+        if document is None:
+            document = visionai_client.extract_document(image_content)
+        return document.confidence_markdown()
     except Exception as e:
         raise Exception(f"Error processing image: {str(e)}")